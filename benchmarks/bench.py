@@ -0,0 +1,487 @@
+#!/usr/bin/env python
+"""
+Benchmarks of loading, converting, and serving profiles.
+
+Synthetic profiles of a chosen size and shape are written to a temporary
+directory, then each step snakeviz takes to show them is timed:
+parsing the file, building the stats table, call graph, and call tree
+payloads, rendering viz.html, and requests to an in-process server.
+The size of each payload and the peak memory used by each step are
+recorded too.
+
+Results can be saved with ``--json`` and compared to a saved run with
+``--compare``, so the same benchmarks run on two commits show what
+changed between them::
+
+    git checkout main && python benchmarks/bench.py --json main.json
+    git checkout my-branch && python benchmarks/bench.py --compare main.json
+
+The snakeviz next to this directory is benchmarked, not an installed one.
+
+"""
+
+import argparse
+import gzip
+import json
+import marshal
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from snakeviz import VERSION  # noqa: E402
+
+# name -> (functions, fan-out, recursion depth)
+PRESETS = {
+    'small': (1000, 4, 0),
+    'medium': (10000, 8, 3),
+    'large': (50000, 16, 5),
+}
+
+# relative change in time past which --compare calls a benchmark
+# faster or slower rather than noise
+THRESHOLD = 0.1
+
+
+def synthetic_stats(functions, fanout, recursion, seed=0):
+    """
+    Make the statistics dictionary of a `pstats.Stats` for a program
+    with `functions` functions.
+
+    Function 0 is the root and function i is called by function
+    (i - 1) // fanout, so the call graph is a tree `fanout` wide.
+    One in ten functions is also called from an earlier function
+    elsewhere in the tree, and with `recursion` above zero one in ten
+    calls itself that many levels deep.
+
+    """
+    rng = random.Random(seed)
+    keys = [
+        (f'/synthetic/package{i // 1000}/module{i // 50}.py',
+         (i % 50) * 20 + 1, f'function_{i}')
+        for i in range(functions)]
+
+    ncalls = [1] + [rng.randint(1, 100) for _ in range(functions - 1)]
+    tottime = [rng.expovariate(1000) for _ in range(functions)]
+    cumtime = list(tottime)
+    # parents come before their children, so going backwards adds
+    # each function's cumulative time to its parent's before the
+    # parent's own is passed up
+    for i in range(functions - 1, 0, -1):
+        cumtime[(i - 1) // fanout] += cumtime[i]
+
+    stats = {}
+    for i, key in enumerate(keys):
+        cc = ncalls[i]
+        nc = cc * (recursion + 1) if recursion and i % 10 == 5 else cc
+        callers = {}
+        if i:
+            parent = keys[(i - 1) // fanout]
+            if i % 10 == 3 and i > fanout + 1:
+                # called from two places, half the calls each
+                other = keys[rng.randrange((i - 1) // fanout)]
+                half = (cc // 2, cc // 2, tottime[i] / 2, cumtime[i] / 2)
+                callers[parent] = callers[other] = half
+            else:
+                callers[parent] = (cc, cc, tottime[i], cumtime[i])
+        if nc > cc:
+            callers[key] = (nc - cc, 0, 0.0, 0.0)
+        stats[key] = (cc, nc, tottime[i], cumtime[i], callers)
+    return stats
+
+
+def write_profile(path, stats):
+    # the same format as pstats.Stats.dump_stats
+    with open(path, 'wb') as f:
+        marshal.dump(stats, f)
+
+
+def measure(func, setup=None, repeat=5):
+    """
+    Time `func` `repeat` times, each time called with the result of
+    `setup` if it's given, then once more while tracing memory.
+
+    Returns a dictionary with the median and minimum time in seconds,
+    the peak memory allocated in bytes, and the size in bytes of what
+    `func` returned, if it's a string or list of strings.
+
+    """
+    times = []
+    for _ in range(repeat):
+        args = (setup(),) if setup else ()
+        start = time.perf_counter()
+        result = func(*args)
+        times.append(time.perf_counter() - start)
+
+    args = (setup(),) if setup else ()
+    tracemalloc.start()
+    try:
+        func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    measurement = {
+        'time': statistics.median(times), 'min': min(times), 'peak': peak}
+    if isinstance(result, str):
+        result = [result]
+    if isinstance(result, list) and all(isinstance(r, str) for r in result):
+        data = ''.join(result).encode('utf-8')
+        measurement['size'] = len(data)
+        measurement['gzip_size'] = len(gzip.compress(data, 6))
+    return measurement
+
+
+def bench_conversion(path, repeat):
+    """
+    Benchmark reading the profile at `path` and making the payloads
+    the page asks for.
+
+    """
+    from tornado.escape import json_encode
+
+    from snakeviz.cache import (
+        CachedProfile, DEFAULT_CUTOFF, DEFAULT_DEPTH, DEFAULT_TABLE_COLUMN)
+    from snakeviz.profiles import read_profile
+    from snakeviz.stats import (
+        CallerHierarchy, Hierarchy, compact_stats, find_root, iter_json_stats,
+        iter_table_rows, json_array_chunks, json_object_chunks,
+        stats_columns)
+
+    stats = read_profile(path)
+    columns = stats_columns(stats)
+    root = find_root(stats)
+    # the function with the most time of its own, whose callers
+    # someone looking for a hot spot would want to see
+    hot = max(stats.stats, key=lambda k: stats.stats[k][2])
+    st = os.stat(path)
+
+    def fresh_callees():
+        # pstats only works out the callees once per Stats
+        stats.all_callees = None
+        return stats
+
+    def table_page(profile):
+        return profile.table_page(DEFAULT_TABLE_COLUMN, True, '', 0, 25)[1]
+
+    return {
+        'parse': measure(lambda: read_profile(path), repeat=repeat),
+        'columns': measure(lambda: stats_columns(stats), repeat=repeat),
+        'table_rows': measure(
+            lambda: list(json_array_chunks(iter_table_rows(None, columns))),
+            repeat=repeat),
+        'table_page': measure(
+            lambda p: json_encode(table_page(p)),
+            setup=lambda: CachedProfile(path, st.st_mtime_ns, st.st_size),
+            repeat=repeat),
+        'callees': measure(
+            lambda s: list(json_object_chunks(iter_json_stats(s))),
+            setup=fresh_callees, repeat=repeat),
+        'compact': measure(
+            lambda s: json_encode(compact_stats(s)),
+            setup=fresh_callees, repeat=repeat),
+        'find_root': measure(find_root, setup=fresh_callees, repeat=repeat),
+        'hierarchy': measure(
+            lambda s: json_encode(
+                Hierarchy(s, root, DEFAULT_CUTOFF).tree(DEFAULT_DEPTH)),
+            setup=fresh_callees, repeat=repeat),
+        'callers': measure(
+            lambda: json_encode(
+                CallerHierarchy(stats, hot, DEFAULT_CUTOFF).tree(
+                    DEFAULT_DEPTH)),
+            repeat=repeat),
+        'prepare': measure(
+            lambda p: p.prepare(),
+            setup=lambda: CachedProfile(path, st.st_mtime_ns, st.st_size),
+            repeat=repeat),
+    }
+
+
+def bench_render(path, repeat):
+    """
+    Benchmark rendering viz.html the way `VizHandler` does.
+
+    """
+    from tornado.template import Loader
+    from tornado.web import StaticFileHandler
+
+    from snakeviz.main import script, settings, stylesheet
+
+    class Handler:
+        # what script and stylesheet use of a RequestHandler
+        def static_url(self, name):
+            return StaticFileHandler.make_static_url(settings, name)
+
+    handler = Handler()
+    quoted = quote(path, safe='')
+    template = Loader(settings['template_path']).load('viz.html')
+
+    def render():
+        return template.generate(
+            profile_name=path, diff=False, export=False,
+            table_url='/snakeviz/api/table/' + quoted,
+            hierarchy_url='/snakeviz/api/hierarchy/' + quoted,
+            live_url='/snakeviz/api/live/' + quoted,
+            script=lambda name: script(handler, name),
+            stylesheet=lambda name: stylesheet(handler, name),
+        ).decode('utf-8')
+
+    return {'render': measure(render, repeat=repeat)}
+
+
+def bench_http(path, repeat):
+    """
+    Benchmark requests to a server running in this process, the time
+    until the whole response has arrived and its size with the gzip
+    compression the server applies.
+
+    ``cold`` requests are made with an empty profile cache so they
+    include reading the profile, ``warm`` ones are answered from it.
+
+    """
+    from tornado.httpclient import AsyncHTTPClient
+    from tornado.httpserver import HTTPServer
+    from tornado.ioloop import IOLoop
+    from tornado.testing import bind_unused_port
+
+    from snakeviz.main import app, profile_cache
+
+    quoted = quote(path, safe='')
+    table_query = (
+        '?draw=1&start=0&length=25&order[0][column]=1&order[0][dir]=desc'
+        '&search[value]=')
+    urls = {
+        'http_page': '/snakeviz/' + quote(path),
+        'http_table': '/snakeviz/api/table/' + quoted + table_query,
+        'http_hierarchy': '/snakeviz/api/hierarchy/' + quoted,
+        'http_compact': '/snakeviz/api/callees/' + quoted + '?format=compact',
+    }
+
+    async def run():
+        sock, port = bind_unused_port()
+        server = HTTPServer(app)
+        server.add_sockets([sock])
+        client = AsyncHTTPClient()
+
+        async def fetch(url):
+            start = time.perf_counter()
+            response = await client.fetch(
+                f'http://127.0.0.1:{port}{url}', decompress_response=False,
+                headers={'Accept-Encoding': 'gzip'})
+            return time.perf_counter() - start, len(response.body)
+
+        results = {}
+        try:
+            for name, url in urls.items():
+                for state in ('cold', 'warm'):
+                    if name == 'http_page' and state == 'warm':
+                        # the page doesn't use the profile
+                        continue
+                    times = []
+                    for _ in range(repeat):
+                        if state == 'cold':
+                            profile_cache.clear()
+                        else:
+                            await fetch(url)
+                        elapsed, size = await fetch(url)
+                        times.append(elapsed)
+                    key = name if name == 'http_page' else f'{name}_{state}'
+                    results[key] = {
+                        'time': statistics.median(times), 'min': min(times),
+                        'gzip_size': size}
+        finally:
+            server.stop()
+            profile_cache.clear()
+        return results
+
+    return IOLoop.current().run_sync(run)
+
+
+def run_case(name, functions, fanout, recursion, repeat, tmpdir):
+    path = os.path.join(tmpdir, name + '.prof')
+    write_profile(path, synthetic_stats(functions, fanout, recursion))
+
+    results = {'file': {'size': os.path.getsize(path)}}
+    results.update(bench_conversion(path, repeat))
+    results.update(bench_render(path, repeat))
+    results.update(bench_http(path, repeat))
+    return results
+
+
+def _commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def _format_time(seconds):
+    if seconds is None:
+        return ''
+    if seconds < 1e-3:
+        return '{:.1f} us'.format(seconds * 1e6)
+    if seconds < 1:
+        return '{:.1f} ms'.format(seconds * 1e3)
+    return '{:.2f} s'.format(seconds)
+
+
+def _format_bytes(n):
+    if n is None:
+        return ''
+    for unit in ('B', 'KiB', 'MiB'):
+        if n < 1024:
+            return '{:.0f} {}'.format(n, unit) if unit == 'B' \
+                else '{:.1f} {}'.format(n, unit)
+        n /= 1024
+    return '{:.1f} GiB'.format(n)
+
+
+def print_results(report, file=None):
+    header = ('benchmark', 'time', 'min', 'peak mem', 'size', 'gzip size')
+    print('snakeviz {} ({}), Python {}'.format(
+        report['meta']['version'], report['meta']['commit'] or 'no commit',
+        report['meta']['python']), file=file)
+    for case, results in report['results'].items():
+        print('\n' + case, file=file)
+        rows = [header]
+        for name, m in results.items():
+            rows.append((
+                name, _format_time(m.get('time')), _format_time(m.get('min')),
+                _format_bytes(m.get('peak')), _format_bytes(m.get('size')),
+                _format_bytes(m.get('gzip_size'))))
+        _print_table(rows, file)
+
+
+def print_comparison(base, report, file=None):
+    """
+    Print the time of each benchmark in `report` next to its time in
+    `base`, and whether it got faster or slower.
+
+    """
+    print('{} ({}) -> {} ({})'.format(
+        base['meta']['commit'] or 'base', base['meta']['version'],
+        report['meta']['commit'] or 'this run', report['meta']['version']),
+        file=file)
+    for case, results in report['results'].items():
+        old_results = base['results'].get(case)
+        if old_results is None:
+            continue
+        print('\n' + case, file=file)
+        rows = [('benchmark', 'base', 'now', 'ratio', '')]
+        for name, m in results.items():
+            old = old_results.get(name, {}).get('time')
+            new = m.get('time')
+            if old is None or new is None:
+                continue
+            ratio = new / old if old else float('inf')
+            change = ''
+            if ratio > 1 + THRESHOLD:
+                change = 'slower'
+            elif ratio < 1 - THRESHOLD:
+                change = 'faster'
+            rows.append((
+                name, _format_time(old), _format_time(new),
+                '{:.2f}'.format(ratio), change))
+        _print_table(rows, file)
+
+
+def _print_table(rows, file):
+    widths = [max(len(r[i]) for r in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(
+            cell.ljust(w) if i == 0 else cell.rjust(w)
+            for i, (cell, w) in enumerate(zip(row, widths))).rstrip(),
+            file=file)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark loading, converting, and serving profiles.')
+    parser.add_argument(
+        '--preset', action='append', choices=sorted(PRESETS),
+        help='profile sizes to benchmark, may be given more than once '
+             '(default: small and medium)')
+    parser.add_argument(
+        '--functions', type=int,
+        help='benchmark a profile with this many functions '
+             'instead of the presets')
+    parser.add_argument(
+        '--fanout', type=int, default=8,
+        help='number of functions each function calls (default: %(default)s)')
+    parser.add_argument(
+        '--recursion', type=int, default=0,
+        help='depth of recursive calls (default: %(default)s)')
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=5,
+        help='number of times each benchmark is run (default: %(default)s)')
+    parser.add_argument(
+        '--json', metavar='FILE', help='save the results to FILE')
+    parser.add_argument(
+        '--compare', metavar='FILE',
+        help='compare the results to those saved in FILE by --json')
+    args = parser.parse_args(argv)
+
+    if args.functions is not None:
+        if args.functions < 1 or args.fanout < 1 or args.recursion < 0:
+            parser.error('--functions and --fanout must be at least 1 '
+                         'and --recursion at least 0')
+        args.cases = {
+            f'{args.functions}x{args.fanout}r{args.recursion}':
+                (args.functions, args.fanout, args.recursion)}
+    else:
+        args.cases = {
+            name: PRESETS[name] for name in args.preset or ('small', 'medium')}
+    if args.repeat < 1:
+        parser.error('--repeat must be at least 1')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    report = {
+        'meta': {
+            'version': VERSION,
+            'commit': _commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        },
+        'results': {},
+    }
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, (functions, fanout, recursion) in args.cases.items():
+            print(f'running {name}...', file=sys.stderr)
+            report['results'][name] = run_case(
+                name, functions, fanout, recursion, args.repeat, tmpdir)
+
+    print_results(report)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            base = json.load(f)
+        print()
+        print_comparison(base, report)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,3 +1,12 @@
-from .ipymagic import *
+from .profiler import Profiler, profile, profiled
+
+__all__ = ['Profiler', 'profile', 'profiled']
 
 VERSION = version = __version__ = '2.3.dev.0'
+
+
+def load_ipython_extension(ipython):
+    """Called when user runs %load_ext snakeviz"""
+    # imported here so that IPython isn't imported along with snakeviz
+    from .ipymagic import load_ipython_extension
+    load_ipython_extension(ipython)
@@ -0,0 +1,630 @@
+"""
+This module contains an in-process cache of loaded profiles so that
+repeat requests for the same file don't have to parse and convert it again.
+
+"""
+
+import asyncio
+import os.path
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+
+from tornado.escape import json_encode
+from tornado.ioloop import IOLoop
+
+from .compress import compress_chunks
+from .profiles import load_stats, profile_paths
+from .prune import prune_stats
+from .stats import (
+    calc_callees, stats_columns, column_order, filter_order, iter_table_rows,
+    iter_json_stats, compact_stats, find_root, Hierarchy, CallerHierarchy,
+    diff_columns, iter_diff_rows, json_array_chunks, json_object_chunks)
+
+# stats table columns in the order they appear in viz.html,
+# the last is the filename:lineno(function) column
+TABLE_COLUMNS = (
+    'ncalls', 'tottime', 'tottime_percall', 'cumtime', 'cumtime_percall',
+    'display_name')
+
+# columns of the stats table comparing two profiles, see iter_diff_rows
+DIFF_TABLE_COLUMNS = (
+    'display_name',
+    'base_cumtime', 'new_cumtime', 'delta_cumtime',
+    'base_tottime', 'new_tottime', 'delta_tottime',
+    'base_ncalls', 'new_ncalls', 'delta_ncalls')
+
+# number of call trees kept per profile, see CachedProfile.hierarchy
+MAX_HIERARCHIES = 32
+
+# number of compressed payloads kept per profile, see compressed
+MAX_COMPRESSED = 16
+
+# what viz.html shows first: the call tree for this depth and cutoff,
+# and the stats table sorted by this column
+DEFAULT_DEPTH = 10
+DEFAULT_CUTOFF = 0.001
+DEFAULT_TABLE_COLUMN = 'tottime'
+
+
+class _TablePages:
+    """
+    Sorted, searched pages of a stats table for classes with a `columns`
+    dictionary whose rows are generated by `_table_rows`.
+
+    """
+    @cached_property
+    def table_names(self):
+        """
+        Lower-cased filename:lineno(function) for each table row,
+        used for sorting and searching.
+
+        """
+        return [
+            '{}:{}({})'.format(os.path.basename(k[0]), k[1], k[2]).lower()
+            for k in self.columns['keys']]
+
+    def table_page(self, column, descending, search, start, length):
+        """
+        Return a page of the stats table sorted by `column` (one of
+        `table_columns`) and limited to rows whose
+        filename:lineno(function) contains every word of `search`,
+        ignoring case.
+
+        Returns the number of matching rows and the rows in the page.
+        A `length` of -1 returns all matching rows.
+
+        """
+        order = self._order(column)
+        if descending:
+            order = order[::-1]
+
+        words = search.lower().split()
+        if words:
+            order = filter_order(order, [
+                all(w in name for w in words) for name in self.table_names])
+
+        stop = None if length < 0 else start + length
+        page = list(order[start:stop])
+        return len(order), list(self._table_rows(page))
+
+    def _order(self, column):
+        # sort orders are computed once per column and reused for
+        # every page
+        if column not in self._orders:
+            if column == 'display_name':
+                values = self.table_names
+            else:
+                values = self.columns[column]
+            self._orders[column] = column_order(values)
+            self._grown()
+        return self._orders[column]
+
+
+class _CompressedPayloads:
+    """
+    Compressed payloads for classes with an `OrderedDict` called
+    `_compressed` and a lock for it called `_compressed_lock`.
+
+    """
+    def compressed(self, name, encoding, build):
+        """
+        Return the payload `name` compressed with `encoding`, calling
+        `build` for its chunks and compressing them only the first time
+        it's asked for. The most recently used payloads are kept.
+
+        """
+        key = (name, encoding)
+        with self._compressed_lock:
+            body = self._compressed.get(key)
+            if body is not None:
+                self._compressed.move_to_end(key)
+                return body
+
+        body = compress_chunks(build(), encoding)
+        with self._compressed_lock:
+            self._compressed[key] = body
+            while len(self._compressed) > MAX_COMPRESSED:
+                self._compressed.popitem(last=False)
+        self._grown()
+        return body
+
+
+class CachedProfile(_TablePages, _CompressedPayloads):
+    """
+    A parsed profile along with the JSON payloads rendered from it.
+
+    Payloads are stored as lists of strings that join together to make
+    the complete JSON document so that they can be built and sent
+    a piece at a time.
+
+    `path` is either the path of a single profile or a tuple of paths
+    to profiles that are merged together, in which case `mtime` and `size`
+    are the latest modification time and the total size of the files.
+    The files are parsed and merged by `processes` worker processes,
+    then pruned by `prune_stats` with the keyword arguments in `prune`,
+    if it's given.
+
+    If `disk` is given it is a `DiskEntry` that payloads are saved to
+    as they are built and loaded from when the profile is seen again.
+    In that case the profile itself is only parsed once it's needed
+    for something that isn't in the disk cache.
+
+    `on_grow`, if given, is called with no arguments whenever something
+    new is kept, so that `nbytes` can be checked against a limit.
+
+    """
+    table_columns = TABLE_COLUMNS
+
+    def __init__(self, path, mtime, size, disk=None, processes=1,
+                 prune=None, on_grow=None):
+        self.path = path
+        self.paths = (path,) if isinstance(path, str) else path
+        self.mtime = mtime
+        self.size = size
+        self.disk = disk
+        self.processes = processes
+        self.prune = prune
+        self.on_grow = on_grow
+        self._orders = {}
+        self._payloads = {}
+        self._root_trees = OrderedDict()
+        self._payloads_lock = threading.Lock()
+        self._hierarchies = OrderedDict()
+        self._hierarchies_lock = threading.Lock()
+        self._compressed = OrderedDict()
+        self._compressed_lock = threading.Lock()
+        self._stats = None
+        self._stats_lock = threading.Lock()
+
+        meta = disk.read_meta() if disk is not None else None
+        self.from_disk = (
+            meta is not None and meta.get('paths') == list(self.paths))
+
+        if self.from_disk:
+            self.root = tuple(meta['root'])
+        else:
+            # parse right away so that invalid profiles fail to load
+            self.stats
+            if disk is not None:
+                disk.write_meta(
+                    {'paths': list(self.paths), 'root': self.root})
+
+    @property
+    def stats(self):
+        with self._stats_lock:
+            if self._stats is None:
+                stats = load_stats(list(self.paths), self.processes)
+                if self.prune:
+                    stats = prune_stats(stats, **self.prune)
+                # the stats are shared between threads from here on,
+                # so the call graph is built while only this one has them
+                calc_callees(stats)
+                self._stats = stats
+            return self._stats
+
+    def _persisted(self, name, build):
+        # a payload from the disk cache if it's there, otherwise build
+        # it and save it there for next time
+        if self.disk is not None:
+            chunks = self.disk.read_payload(name)
+            if chunks is not None:
+                return chunks
+
+        chunks = list(build())
+        if self.disk is not None:
+            self.disk.write_payload(name, chunks)
+        return chunks
+
+    def _payload(self, name, build):
+        # like _persisted, but the payload is also kept in memory
+        with self._payloads_lock:
+            chunks = self._payloads.get(name)
+        if chunks is None:
+            chunks = self._persisted(name, build)
+            with self._payloads_lock:
+                chunks = self._payloads.setdefault(name, chunks)
+            self._grown()
+        return chunks
+
+    def _grown(self):
+        if self.on_grow is not None:
+            self.on_grow()
+
+    @cached_property
+    def columns(self):
+        if self.disk is not None:
+            columns = self.disk.read_columns()
+            if columns is not None:
+                return columns
+
+        columns = stats_columns(self.stats)
+        if self.disk is not None:
+            self.disk.write_columns(columns)
+        return columns
+
+    @property
+    def table_rows(self):
+        return self._payload('table', lambda: json_array_chunks(
+            iter_table_rows(None, self.columns)))
+
+    def _table_rows(self, indices):
+        return iter_table_rows(None, self.columns, indices)
+
+    @property
+    def callees(self):
+        return self._payload(
+            'callees', lambda: json_object_chunks(iter_json_stats(self.stats)))
+
+    @property
+    def compact_callees(self):
+        return self._payload(
+            'compact', lambda: [json_encode(compact_stats(self.stats))])
+
+    def hierarchy(self, root, depth, cutoff, parent_name=None, callers=False):
+        """
+        Return the JSON of `build_hierarchy` as a list of strings.
+        A `root` of None means the root of the whole profile.
+
+        The most recently used trees are kept for each root, parent name,
+        cutoff and direction, so changing the depth or going back to an
+        earlier root only builds the levels that haven't been built before.
+        Trees from the root of the profile are what the page draws first,
+        so their JSON is also kept, in the disk cache if there is one
+        and otherwise in memory.
+
+        """
+        def build():
+            tree = self._hierarchy(
+                root or self.root, cutoff, parent_name, callers)
+            chunks = [json_encode(tree.tree(depth))]
+            # the tree may have been built deeper
+            self._grown()
+            return chunks
+
+        if not callers and parent_name is None and root in (None, self.root):
+            if self.disk is not None:
+                return self._persisted(f'hierarchy-{depth}-{cutoff}', build)
+            return self._root_tree(depth, cutoff, build)
+        return build()
+
+    def _root_tree(self, depth, cutoff, build):
+        key = (depth, cutoff)
+        with self._payloads_lock:
+            chunks = self._root_trees.get(key)
+            if chunks is not None:
+                self._root_trees.move_to_end(key)
+                return chunks
+        chunks = build()
+        with self._payloads_lock:
+            self._root_trees[key] = chunks
+            while len(self._root_trees) > MAX_HIERARCHIES:
+                self._root_trees.popitem(last=False)
+        self._grown()
+        return chunks
+
+    def prepare(self):
+        """
+        Build what a page showing the profile asks for first,
+        so that it's ready by the time the page loads.
+
+        """
+        self.table_page(DEFAULT_TABLE_COLUMN, True, '', 0, 25)
+        self.hierarchy(None, DEFAULT_DEPTH, DEFAULT_CUTOFF)
+
+    def _hierarchy(self, root, cutoff, parent_name, callers=False):
+        stats = self.stats
+        key = (root, cutoff, parent_name, callers)
+        with self._hierarchies_lock:
+            tree = self._hierarchies.get(key)
+            if tree is None:
+                cls = CallerHierarchy if callers else Hierarchy
+                tree = self._hierarchies[key] = cls(
+                    stats, root, cutoff, parent_name)
+                if len(self._hierarchies) > MAX_HIERARCHIES:
+                    self._hierarchies.popitem(last=False)
+            self._hierarchies.move_to_end(key)
+        return tree
+
+    @cached_property
+    def func_keys(self):
+        """
+        Map function names as they appear in the JSON payloads
+        back to keys in `self.stats.stats`.
+
+        """
+        return {'{}:{}({})'.format(*k): k for k in self.columns['keys']}
+
+    @cached_property
+    def root(self):
+        return find_root(self.stats)
+
+    @property
+    def nbytes(self):
+        # We can't cheaply measure a Stats instance, but it scales
+        # with the size of the file it was loaded from.
+        # Payloads streamed from the disk cache aren't held in memory.
+        nbytes = (self.size if self._stats is not None else 0) + sum(
+            len(chunk)
+            for p in list(self._payloads.values()) if isinstance(p, list)
+            for chunk in p)
+        nbytes += sum(
+            len(chunk) for p in list(self._root_trees.values()) for chunk in p)
+        if 'columns' in self.__dict__:
+            # six numeric columns plus one sort order for each
+            nbytes += 96 * len(self.columns['keys'])
+        # each node of a call tree is a small dictionary
+        nbytes += 500 * sum(h.nodes for h in list(self._hierarchies.values()))
+        nbytes += sum(len(b) for b in list(self._compressed.values()))
+        return nbytes
+
+
+class CachedDiff(_TablePages, _CompressedPayloads):
+    """
+    The changes from profile `base` to profile `new`,
+    both `CachedProfile` instances.
+
+    The stats table compares every function in either profile.
+    The call trees are those of `new` with each node's ``delta``
+    giving the change in its function's cumulative time.
+
+    """
+    table_columns = DIFF_TABLE_COLUMNS
+
+    def __init__(self, base, new):
+        self.base = base
+        self.new = new
+        self._orders = {}
+        self._compressed = OrderedDict()
+        self._compressed_lock = threading.Lock()
+
+    def _grown(self):
+        # diffs aren't counted towards the cache's size
+        pass
+
+    @cached_property
+    def columns(self):
+        return diff_columns(self.base.columns, self.new.columns)
+
+    @cached_property
+    def table_rows(self):
+        return list(json_array_chunks(iter_diff_rows(self.columns)))
+
+    def _table_rows(self, indices):
+        return iter_diff_rows(self.columns, indices)
+
+    @property
+    def func_keys(self):
+        return self.new.func_keys
+
+    @cached_property
+    def cumtime_deltas(self):
+        """
+        Map function names to their change in cumulative time.
+
+        """
+        return dict(zip(
+            ('{}:{}({})'.format(*k) for k in self.columns['keys']),
+            map(float, self.columns['delta_cumtime'])))
+
+    def hierarchy(self, root, depth, cutoff, parent_name=None, callers=False):
+        """
+        Like `CachedProfile.hierarchy` for `new`, with a ``delta`` for
+        each node.
+
+        """
+        tree = self.new._hierarchy(
+            root or self.new.root, cutoff, parent_name, callers)
+        tree = tree.tree(depth)
+
+        deltas = self.cumtime_deltas
+        nodes = [tree]
+        while nodes:
+            node = nodes.pop()
+            node['delta'] = deltas.get(node['name'], 0)
+            nodes.extend(node.get('children', ()))
+        return [json_encode(tree)]
+
+
+class ProfileCache:
+    """
+    A bounded, least-recently-used cache of `CachedProfile` instances.
+
+    Entries are keyed by absolute path and are reloaded whenever the
+    modification time or size of the file on disk changes.
+    Names that match several files, see `profile_paths`, are keyed by
+    the tuple of their paths and the merged profile is cached as one entry.
+
+    Parameters
+    ----------
+    max_entries : int
+        Maximum number of profiles to keep.
+    max_bytes : int
+        Approximate maximum memory used by cached profiles.
+        The most recently loaded profile is always kept,
+        even if it alone is larger than this.
+    workers : int
+        Number of threads in `executor`.
+    processes : int, optional
+        Number of processes used to parse the files of merged profiles,
+        defaults to the number of CPUs.
+    disk : DiskCache, optional
+        Where to save converted profiles so they load quickly
+        the next time they are needed, even by another process.
+    prune : dict, optional
+        Keyword arguments of `prune_stats`, to leave parts of every
+        profile out before it is converted.
+
+    """
+    def __init__(self, max_entries=8, max_bytes=512 * 2**20, workers=4,
+                 disk=None, processes=None, prune=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.processes = processes or os.cpu_count() or 1
+        self.disk = disk
+        self.prune = prune
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._diffs = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    @cached_property
+    def executor(self):
+        """
+        Thread pool used to load profiles and do other expensive work
+        on them without blocking the IOLoop.
+
+        """
+        return ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix='snakeviz')
+
+    def get(self, path):
+        """
+        Return the `CachedProfile` for `path`, loading it if it isn't
+        cached or has changed on disk since it was cached.
+
+        """
+        path, key = self.key(path)
+        with self._lock:
+            entry = self._lookup(path, key)
+            if entry is not None:
+                return entry
+            self.misses += 1
+        return self._load(path, key)
+
+    async def load(self, path):
+        """
+        Like `get`, but profiles are loaded on `executor`.
+        Concurrent requests for the same profile share a single load.
+
+        """
+        path, key = self.key(path)
+        with self._lock:
+            entry = self._lookup(path, key)
+            if entry is not None:
+                return entry
+
+            future = self._loading.get((path, key))
+            if future is None:
+                self.misses += 1
+                future = IOLoop.current().run_in_executor(
+                    self.executor, self._load, path, key)
+                self._loading[path, key] = future
+                future.add_done_callback(
+                    lambda f: self._loading.pop((path, key), None))
+            else:
+                self.coalesced += 1
+
+        return await future
+
+    async def load_diff(self, base, new):
+        """
+        Return the `CachedDiff` between the profiles named `base`
+        and `new`, loading them like `load`.
+        The most recent `max_entries` diffs are kept.
+
+        """
+        base, new = await asyncio.gather(self.load(base), self.load(new))
+        key = (base.path, new.path)
+        with self._lock:
+            diff = self._diffs.get(key)
+            # profiles that were reloaded have new entries
+            if diff is None or diff.base is not base or diff.new is not new:
+                diff = self._diffs[key] = CachedDiff(base, new)
+            self._diffs.move_to_end(key)
+            while len(self._diffs) > self.max_entries:
+                self._diffs.popitem(last=False)
+        return diff
+
+    def key(self, name):
+        """
+        Return the cache key for the profile(s) named by `name`:
+        the absolute path, or tuple of paths for a merged profile,
+        and a tuple of the latest modification time in nanoseconds
+        and the total size of the files.
+
+        Raises OSError if the files can't be found.
+
+        """
+        paths = profile_paths(name)
+        stats = [os.stat(p) for p in paths]
+        key = (max(st.st_mtime_ns for st in stats),
+               sum(st.st_size for st in stats))
+        if len(paths) == 1:
+            return paths[0], key
+        return tuple(paths), key
+
+    def _lookup(self, path, key):
+        # caller must hold self._lock
+        entry = self._entries.get(path)
+        if entry is not None and (entry.mtime, entry.size) == key:
+            self._entries.move_to_end(path)
+            self.hits += 1
+            return entry
+
+    def _load(self, path, key):
+        # do the expensive work outside the lock so other profiles
+        # can still be served from the cache in the meantime
+        disk = (self.disk.entry(path, *key, self.prune)
+                if self.disk is not None else None)
+        entry = CachedProfile(
+            path, *key, disk=disk, processes=self.processes, prune=self.prune,
+            on_grow=self._trim)
+
+        with self._lock:
+            if entry.from_disk:
+                self.disk_hits += 1
+            self._entries[path] = entry
+            self._entries.move_to_end(path)
+            self._evict()
+
+        return entry
+
+    def _trim(self):
+        # entries call this when they keep something new,
+        # which may take the cache over max_bytes
+        with self._lock:
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._diffs.clear()
+
+    @property
+    def nbytes(self):
+        return sum(e.nbytes for e in self._entries.values())
+
+    def info(self):
+        """
+        Return a dictionary of cache counters suitable for JSON encoding.
+
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'disk_hits': self.disk_hits,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self.nbytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'workers': self.workers,
+            }
+
+    def _evict(self):
+        # caller must hold self._lock
+        while len(self._entries) > 1 and (
+                len(self._entries) > self.max_entries or
+                self.nbytes > self.max_bytes):
+            self._entries.popitem(last=False)
+            self.evictions += 1
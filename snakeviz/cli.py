@@ -9,10 +9,10 @@ import random
 import sys
 import threading
 import webbrowser
-from pstats import Stats
 from urllib.parse import quote
 
 from snakeviz import VERSION
+from snakeviz.profiles import join_profile_names, profile_paths, read_profile
 
 
 # As seen in IPython:
@@ -41,7 +41,18 @@ def build_parser():
     parser = SVArgumentParser(
         description='Start SnakeViz to view a Python profile.')
 
-    parser.add_argument('filename', help='Python profile to view')
+    parser.add_argument('filename', nargs='+',
+                        help='Python profile to view; several profiles or '
+                             'a quoted glob pattern are merged into one view')
+
+    parser.add_argument('-d', '--diff', action='store_true', default=False,
+                        help='compare two profiles, showing how each function '
+                             'changed from the first to the second')
+
+    parser.add_argument('-e', '--export', metavar='FILE',
+                        help='write the visualization to FILE, an HTML page '
+                             'that can be opened without a SnakeViz server, '
+                             'instead of starting the server')
 
     parser.add_argument('-v', '--version', action='version',
                         version=('%(prog)s ' + VERSION))
@@ -63,37 +74,156 @@ def build_parser():
                         help='start SnakeViz in server-only mode--'
                              'no attempt will be made to open a browser')
 
+    parser.add_argument('--cache-entries', type=int, metavar='N', default=8,
+                        help='maximum number of parsed profiles to keep in '
+                             'memory (default: %(default)s)')
+
+    parser.add_argument('--cache-size', type=int, metavar='MB', default=512,
+                        help='approximate maximum memory in megabytes used '
+                             'by cached profiles (default: %(default)s)')
+
+    parser.add_argument('-w', '--workers', type=int, metavar='N', default=4,
+                        help='number of threads used to load and convert '
+                             'profiles in the background (default: %(default)s)')
+
+    parser.add_argument('--cache-dir', metavar='DIR',
+                        help='directory in which to save converted profiles '
+                             'so they load quickly the next time they are '
+                             'viewed, even after a restart')
+
+    parser.add_argument('--cache-dir-size', type=int, metavar='MB',
+                        default=1024,
+                        help='maximum disk space in megabytes used by '
+                             '--cache-dir (default: %(default)s)')
+
+    prune = parser.add_argument_group(
+        'pruning',
+        'Leave functions out of the view, adding their time to the '
+        'functions that call them. PATTERN is a glob matched against '
+        'the file names of functions, such as "*/mypackage/*", or one of '
+        'builtins, stdlib, or site-packages.')
+
+    prune.add_argument('--min-time', type=float, metavar='FRACTION',
+                       default=0,
+                       help='leave out functions whose cumulative time is '
+                            'less than this fraction of the total')
+
+    prune.add_argument('--max-functions', type=int, metavar='N',
+                       help='keep at most the N functions with the most '
+                            'cumulative time')
+
+    prune.add_argument('--include', action='append', metavar='PATTERN',
+                       default=[],
+                       help='only keep functions in files matching PATTERN, '
+                            'may be given more than once')
+
+    prune.add_argument('--exclude', action='append', metavar='PATTERN',
+                       default=[],
+                       help='leave out functions in files matching PATTERN, '
+                            'may be given more than once')
+
+    prune.add_argument('--collapse', action='append', metavar='PATTERN',
+                       default=[],
+                       help='show each file matching PATTERN as a single '
+                            'function, may be given more than once')
+
     return parser
 
 
-def main(argv=None):
-    parser = build_parser()
-    args = parser.parse_args(argv)
+def prune_options(args):
+    """
+    Return the keyword arguments of `prune_stats` given on the command
+    line, leaving out those that weren't.
 
-    if args.browser and args.server:
-        parser.error("options --browser and --server are mutually exclusive")
+    """
+    options = {
+        'min_fraction': args.min_time,
+        'max_functions': args.max_functions,
+        'include': args.include,
+        'exclude': args.exclude,
+        'collapse': args.collapse,
+    }
+    return {k: v for k, v in options.items() if v}
+
+
+def check_profiles(parser, name):
+    """
+    Exit with an error unless every file named by `name` (see
+    `profile_paths`) can be opened. The files are parsed by
+    `load_profiles` once the server has been imported.
+
+    """
+    try:
+        paths = profile_paths(name)
+    except OSError as e:
+        parser.error(str(e))
 
-    filename = os.path.abspath(args.filename)
-    if not os.path.exists(filename):
-        parser.error('the path %s does not exist' % filename)
+    for path in paths:
+        if os.path.isdir(path):
+            parser.error('the path %s is a directory, only one directory '
+                         'can be viewed at a time' % path)
 
-    if not os.path.isdir(filename):
         try:
-            open(filename)
+            open(path)
         except OSError as e:
             parser.error('the file %s could not be opened: %s'
-                         % (filename, str(e)))
+                         % (path, str(e)))
+
+
+def load_profiles(parser, profile_cache, name):
+    """
+    Load the profiles named by `name` into `profile_cache`, so they are
+    only parsed once, exiting with an error if they can't be read.
+
+    """
+    try:
+        return profile_cache.get(name)
+    except Exception:
+        pass
 
+    # find the file that couldn't be read
+    for path in profile_paths(name):
         try:
-            Stats(filename)
+            read_profile(path)
         except Exception:
-            parser.error(('The file %s is not a valid profile. ' % filename) +
+            parser.error(('The file %s is not a valid profile. ' % path) +
                          'Generate profiles using: \n\n'
                          '\tpython -m cProfile -o my_program.prof my_program.py\n\n'
                          'Note that snakeviz must be run under the same '
-                         'version of Python as was used to create the profile.\n')
+                         'version of Python as was used to create the profile.\n'
+                         'Collapsed stack files and Chrome trace event files '
+                         'can also be viewed.\n')
+    parser.error('the profiles %s could not be merged' % name)
 
-    filename = quote(filename, safe='')
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if args.browser and args.server:
+        parser.error("options --browser and --server are mutually exclusive")
+
+    if args.diff:
+        if len(args.filename) != 2:
+            parser.error('--diff takes two profiles, the base and the new one')
+        names = [os.path.abspath(f) for f in args.filename]
+        page = 'diff?base={}&new={}'.format(
+            *(quote(name, safe='') for name in names))
+    elif len(args.filename) == 1 and os.path.isdir(args.filename[0]):
+        names = []
+        page = quote(os.path.abspath(args.filename[0]), safe='')
+    else:
+        # glob patterns are passed on rather than the files they match
+        # so that the view picks up files that appear later
+        names = [join_profile_names(
+            os.path.abspath(p) for p in args.filename)]
+        page = quote(names[0], safe='')
+
+    for name in names:
+        check_profiles(parser, name)
+
+    if args.export and (args.diff or not names):
+        parser.error('--export takes one profile or profiles to merge')
 
     hostname = args.hostname
     port = args.port
@@ -102,13 +232,59 @@ def main(argv=None):
         parser.error('invalid port number %d: use a port between 0 and 65535'
                      % port)
 
+    if args.cache_entries < 1:
+        parser.error('--cache-entries must be at least 1')
+
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+
+    if not 0 <= args.min_time < 1:
+        parser.error('--min-time must be at least 0 and less than 1')
+
+    if args.max_functions is not None and args.max_functions < 1:
+        parser.error('--max-functions must be at least 1')
+
     # Go ahead and import the tornado app and start it; we do an inline import
     # here to avoid the extra overhead when just running the cli for --help and
     # the like
 
-    from .main import app
+    from .main import app, compressed_static, profile_cache, settings
+    from .diskcache import DiskCache
     import tornado.ioloop
 
+    profile_cache.max_entries = args.cache_entries
+    profile_cache.max_bytes = args.cache_size * 2**20
+    profile_cache.workers = args.workers
+    profile_cache.prune = prune_options(args) or None
+
+    if args.cache_dir:
+        try:
+            profile_cache.disk = DiskCache(
+                args.cache_dir, args.cache_dir_size * 2**20)
+        except OSError as e:
+            parser.error('could not create the cache directory %s: %s'
+                         % (args.cache_dir, e))
+
+    profiles = [load_profiles(parser, profile_cache, name) for name in names]
+
+    if args.export:
+        from .export import export_html
+
+        export_html(names[0], profiles[0], args.export)
+        print('snakeviz wrote %s' % args.export)
+        return 0
+
+    if not args.diff:
+        # build what the page asks for first while the browser opens
+        for profile in profiles:
+            profile_cache.executor.submit(profile.prepare)
+    profile_cache.executor.submit(
+        compressed_static.prepare, settings['static_path'])
+
+    # only show errors in full to the person running snakeviz locally
+    if not args.server:
+        app.settings['serve_traceback'] = True
+
     # As seen in IPython:
     # https://github.com/ipython/ipython/blob/8be7f9abd97eafb493817371d70101d28640919c/IPython/html/notebookapp.py
     # See the IPython license at:
@@ -125,7 +301,7 @@ def main(argv=None):
         print('No available port found.')
         return 1
 
-    url = f"http://{hostname}:{port}/snakeviz/{filename}"
+    url = f"http://{hostname}:{port}/snakeviz/{page}"
     print('snakeviz web server started on %s:%d; enter Ctrl-C to exit' %
            (hostname, port))
     print(url)
@@ -0,0 +1,224 @@
+"""
+This module compresses responses ahead of time, so that static files
+and profile payloads that are sent many times are compressed once
+instead of on every request.
+
+gzip is always available. brotli and zstd are also used when the
+optional brotli or zstandard packages are installed (zstd is part
+of the standard library from Python 3.14).
+
+"""
+
+import atexit
+import os
+import shutil
+import tempfile
+import threading
+import zlib
+
+# encoding -> function(best) returning an incremental compressor for
+# it, with compress(data) and flush() methods like zlib's, in the order
+# they are preferred, see choose_encoding
+COMPRESSORS = {}
+
+try:
+    import brotli
+except ImportError:
+    pass
+else:
+    class _BrotliCompressor:
+        def __init__(self, best):
+            self._compressor = brotli.Compressor(quality=11 if best else 5)
+
+        def compress(self, data):
+            return self._compressor.process(data)
+
+        def flush(self):
+            return self._compressor.finish()
+
+    COMPRESSORS['br'] = _BrotliCompressor
+
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        import zstandard
+    except ImportError:
+        pass
+    else:
+        COMPRESSORS['zstd'] = lambda best: zstandard.ZstdCompressor(
+            level=19 if best else 3).compressobj()
+else:
+    COMPRESSORS['zstd'] = lambda best: zstd.ZstdCompressor(
+        19 if best else 3)
+
+# wbits=31 writes a gzip header and trailer
+COMPRESSORS['gzip'] = lambda best: zlib.compressobj(
+    9 if best else 6, zlib.DEFLATED, 31)
+
+# extensions of the static files worth compressing
+COMPRESSIBLE = ('.css', '.html', '.js', '.json', '.svg')
+
+
+def compress(data, encoding, best=False):
+    """
+    Compress the bytes `data` with `encoding`, one of `COMPRESSORS`.
+    `best` trades speed for size, for data compressed only once.
+
+    """
+    return compress_chunks([data], encoding, best)
+
+
+def compress_chunks(chunks, encoding, best=False):
+    """
+    Like `compress`, but for the data made by joining `chunks`, strings
+    (encoded as UTF-8) or bytes, which are compressed one at a time
+    so that the uncompressed data is never all in memory.
+
+    """
+    compressor = COMPRESSORS[encoding](best)
+    parts = []
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        parts.append(compressor.compress(chunk))
+    parts.append(compressor.flush())
+    return b''.join(parts)
+
+
+def accepted_encodings(accept_encoding):
+    """
+    Return the set of encodings allowed by the value of an
+    Accept-Encoding header.
+
+    """
+    accepted = set()
+    for item in accept_encoding.lower().split(','):
+        name, *params = [p.strip() for p in item.split(';')]
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name and q > 0:
+            accepted.add(name)
+    return accepted
+
+
+def choose_encoding(accept_encoding):
+    """
+    Return the preferred encoding in `COMPRESSORS` allowed by the value
+    of an Accept-Encoding header, or None to send the response as is.
+
+    """
+    accepted = accepted_encodings(accept_encoding)
+    for encoding in COMPRESSORS:
+        if encoding in accepted or '*' in accepted:
+            return encoding
+    return None
+
+
+class CompressedCopies:
+    """
+    Compressed copies of files, kept in a temporary directory until the
+    file changes.
+    The copies have the same names as the files, in a directory for
+    each encoding, so they are recognized as the same type of file.
+
+    Compressing a file for good can take a while, so when serving files
+    use `ready` and have missing copies made in the background with
+    `build_later`.
+
+    """
+    def __init__(self):
+        self._dir = None
+        # (root, path, encoding) of the copies waiting to be made
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def compressible(path):
+        return path.endswith(COMPRESSIBLE)
+
+    def _copy(self, root, path, encoding):
+        # where the copy of path goes, and whether it is up to date
+        with self._lock:
+            if self._dir is None:
+                self._dir = tempfile.mkdtemp(prefix='snakeviz-')
+                atexit.register(self.close)
+            copy = os.path.join(
+                self._dir, encoding, os.path.relpath(path, root))
+        try:
+            fresh = os.stat(copy).st_mtime_ns >= os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            fresh = False
+        return copy, fresh
+
+    def ready(self, root, path, encoding):
+        """
+        Return the path of the copy of `path`, a file under the directory
+        `root`, compressed with `encoding`, or None if it hasn't been
+        made or is out of date.
+
+        """
+        copy, fresh = self._copy(root, path, encoding)
+        return copy if fresh else None
+
+    def path(self, root, path, encoding):
+        """
+        Like `ready`, but makes the copy if it is missing or out of date.
+
+        """
+        copy, fresh = self._copy(root, path, encoding)
+        if not fresh:
+            with open(path, 'rb') as f:
+                data = compress(f.read(), encoding, best=True)
+            os.makedirs(os.path.dirname(copy), exist_ok=True)
+            # a unique name, in case the copy is being made twice
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(copy))
+            with open(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, copy)
+        return copy
+
+    def build_later(self, executor, root, path, encoding):
+        """
+        Make the copy of `path` like `path` does, on `executor`,
+        unless it is already waiting to be made.
+
+        """
+        key = (root, path, encoding)
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+
+        def build():
+            try:
+                self.path(root, path, encoding)
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+        executor.submit(build)
+
+    def prepare(self, root):
+        """
+        Make compressed copies of every compressible file under `root`
+        with every encoding, so that none are made while serving them.
+
+        """
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if self.compressible(path):
+                    for encoding in COMPRESSORS:
+                        self.path(root, path, encoding)
+
+    def close(self):
+        with self._lock:
+            if self._dir is not None:
+                shutil.rmtree(self._dir, ignore_errors=True)
+                self._dir = None
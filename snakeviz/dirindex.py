@@ -0,0 +1,294 @@
+"""
+This module contains an index of the profiles in directories so that
+directory listings can show a summary of each profile, and be sorted,
+searched and paged, without opening the profiles on every request.
+
+"""
+
+import heapq
+import os.path
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import cached_property
+from urllib.parse import quote
+
+from .loaders import profile_format
+from .profiles import read_profile
+
+# directory listing columns in the order they appear in dir.html
+DIR_COLUMNS = (
+    'name', 'size', 'mtime', 'total_time', 'functions', 'hottest')
+
+# seconds a directory listing is reused for while the directory's
+# modification time stays the same, so that paging through a big
+# directory doesn't list it again for every page
+LISTING_TTL = 2.0
+
+
+def looks_like_profile(path):
+    """
+    Cheaply check whether the file at `path` could be a profile
+    without reading all of it.
+
+    """
+    try:
+        return profile_format(path) is not None
+    except OSError:
+        return False
+
+
+def summarize_profile(path, top=5):
+    """
+    Return a summary of the profile at `path` as a dictionary with keys:
+
+    total_time
+        total time recorded in the profile
+    functions
+        number of functions in the profile
+    hottest
+        filename:lineno(function) of the `top` functions with the most
+        time spent in them, not including sub-functions
+
+    """
+    stats = read_profile(path)
+    hottest = heapq.nlargest(top, stats.stats, key=lambda k: stats.stats[k][2])
+    return {
+        'total_time': stats.total_tt,
+        'functions': len(stats.stats),
+        'hottest': [
+            '{}:{}({})'.format(os.path.basename(k[0]), k[1], k[2])
+            for k in hottest],
+    }
+
+
+def _format_size(nbytes):
+    if nbytes < 1024:
+        return f'{nbytes} B'
+    for unit in ('KB', 'MB', 'GB'):
+        nbytes /= 1024
+        if nbytes < 1024 or unit == 'GB':
+            return f'{nbytes:.1f} {unit}'
+
+
+def dir_row(entry):
+    """
+    Format an entry from `DirectoryIndex.entries` as a row of the
+    directory listing table.
+
+    """
+    summary = entry['summary'] or {}
+    return [
+        [entry['name'], quote(entry['path'], safe='')],
+        '' if entry['size'] is None else _format_size(entry['size']),
+        datetime.fromtimestamp(entry['mtime']).strftime('%Y-%m-%d %H:%M'),
+        '{:.4g}'.format(summary['total_time']) if summary else '',
+        str(summary['functions']) if summary else '',
+        ', '.join(summary.get('hottest', ())),
+    ]
+
+
+class DirectoryIndex:
+    """
+    Summaries of the profiles found in directories.
+
+    Profiles are summarized by a background scan of their directory the
+    first time it is listed, and the summaries are kept until the file's
+    modification time or size changes. Until then listings show the
+    profile without its summary.
+
+    Summaries of files that are gone are dropped the next time their
+    directory is listed, and only the summaries of the most recently
+    listed directories are kept. Listings themselves are reused for
+    `LISTING_TTL` seconds unless the directory changes.
+
+    Parameters
+    ----------
+    top : int
+        Number of hottest functions listed for each profile.
+    max_dirs : int
+        Number of directories whose summaries are kept.
+
+    """
+    def __init__(self, top=5, max_dirs=64):
+        self.top = top
+        self.max_dirs = max_dirs
+        # directory -> {path -> ((mtime, size), summary)} where summary
+        # is None for files that aren't profiles, least recently
+        # listed directories first
+        self._summaries = OrderedDict()
+        # directory -> (mtime_ns, time listed, rows), same order
+        self._listings = OrderedDict()
+        self._scanning = set()
+        self._lock = threading.Lock()
+
+    @cached_property
+    def executor(self):
+        """
+        Thread used to scan directories, kept separate from the profile
+        cache's threads so that a big scan doesn't hold up profiles
+        being opened.
+
+        """
+        return ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='snakeviz-index')
+
+    def entries(self, path):
+        """
+        List the directory at `path`, starting a background scan of any
+        files that haven't been summarized.
+
+        Returns a list of dictionaries with keys name, path, is_dir,
+        size, mtime, and summary (see `summarize_profile`, None if the
+        file is not a profile or is yet to be scanned), and whether a
+        scan of the directory is still running.
+
+        """
+        entries = []
+        pending = []
+        rows = self._listing(path)
+        with self._lock:
+            summaries = dict(self._summaries.get(path, {}))
+        for row, key in rows:
+            entry = dict(row, summary=None)
+            if key is not None:
+                cached = summaries.get(entry['path'])
+                if cached is not None and cached[0] == key:
+                    entry['summary'] = cached[1]
+                else:
+                    pending.append((entry['path'], key))
+            entries.append(entry)
+
+        with self._lock:
+            # forget files that are gone
+            paths = {e['path'] for e in entries}
+            summaries = self._summaries.pop(path, {})
+            self._summaries[path] = {
+                p: v for p, v in summaries.items() if p in paths}
+            while len(self._summaries) > self.max_dirs:
+                self._summaries.popitem(last=False)
+
+        return entries, self._scan(path, pending)
+
+    def _listing(self, path):
+        # the rows of the directory at path, each an entry without its
+        # summary and the (mtime, size) key of files
+        mtime = os.stat(path).st_mtime_ns
+        now = time.monotonic()
+        with self._lock:
+            listing = self._listings.get(path)
+            if (listing is not None and listing[0] == mtime and
+                    now - listing[1] < LISTING_TTL):
+                self._listings.move_to_end(path)
+                return listing[2]
+
+        rows = []
+        with os.scandir(path) as it:
+            for d in it:
+                if d.name.startswith('.'):
+                    # skip invisible files/directories
+                    continue
+                try:
+                    st = d.stat()
+                    is_dir = d.is_dir()
+                except OSError:
+                    # e.g. a broken link
+                    continue
+
+                # Append / for directories or @ for symbolic links
+                name = d.name
+                if is_dir:
+                    name += '/'
+                if d.is_symlink():
+                    name += '@'
+
+                row = {
+                    'name': name,
+                    'path': d.path,
+                    'is_dir': is_dir,
+                    'size': None if is_dir else st.st_size,
+                    'mtime': st.st_mtime,
+                }
+                key = None if is_dir else (st.st_mtime_ns, st.st_size)
+                rows.append((row, key))
+
+        with self._lock:
+            self._listings.pop(path, None)
+            self._listings[path] = (mtime, now, rows)
+            while len(self._listings) > self.max_dirs:
+                self._listings.popitem(last=False)
+        return rows
+
+    def _scan(self, path, pending):
+        # start summarizing pending files unless path is already being
+        # scanned, returns whether a scan is running
+        if not pending:
+            return False
+        with self._lock:
+            if path not in self._scanning:
+                self._scanning.add(path)
+                self.executor.submit(self._summarize, path, pending)
+        return True
+
+    def _summarize(self, path, pending):
+        try:
+            for fname, key in pending:
+                summary = None
+                if looks_like_profile(fname):
+                    try:
+                        summary = summarize_profile(fname, self.top)
+                    except Exception:
+                        pass
+                with self._lock:
+                    summaries = self._summaries.get(path)
+                    if summaries is None:
+                        # the directory has been dropped since
+                        break
+                    summaries[fname] = (key, summary)
+        finally:
+            with self._lock:
+                self._scanning.discard(path)
+
+    def page(self, path, column, descending, search, start, length):
+        """
+        Return a page of the listing of the directory at `path`, sorted by
+        `column` (one of `DIR_COLUMNS`) and limited to entries whose name
+        or hottest functions contain every word of `search`, ignoring case.
+
+        Returns the total number of entries, the number of matching
+        entries, the entries in the page, and whether a scan of the
+        directory is still running. A `length` of -1 returns all
+        matching entries.
+
+        """
+        entries, scanning = self.entries(path)
+        total = len(entries)
+
+        words = search.lower().split()
+        if words:
+            def text(e):
+                hottest = (e['summary'] or {}).get('hottest', ())
+                return ' '.join([e['name'], *hottest]).lower()
+            entries = [e for e in entries if all(w in text(e) for w in words)]
+
+        if column == 'name':
+            def key(e):
+                # directories before files
+                return (not e['is_dir'], e['name'].lower())
+        elif column in ('size', 'mtime'):
+            def key(e):
+                return e[column] if e[column] is not None else -1
+        elif column == 'hottest':
+            def key(e):
+                summary = e['summary']
+                return ', '.join(summary['hottest']).lower() if summary else ''
+        else:
+            def key(e):
+                summary = e['summary']
+                return summary[column] if summary else -1
+        entries.sort(key=key, reverse=descending)
+
+        stop = None if length < 0 else start + length
+        return total, len(entries), entries[start:stop], scanning
@@ -0,0 +1,263 @@
+"""
+This module contains an optional on-disk cache of converted profiles so
+that a restarted server can serve a profile it has seen before without
+parsing and converting it again.
+
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from array import array
+from collections import Counter
+
+from tornado.log import app_log
+
+from .stats import np
+
+# bump this whenever the layout of the cached files changes so that
+# entries written by older versions are ignored and eventually evicted
+FORMAT_VERSION = 2
+
+# the numeric columns from stats_columns and the array typecodes
+# they are stored as
+NUMERIC_COLUMNS = (
+    ('pcalls', 'q'),
+    ('ncalls', 'q'),
+    ('tottime', 'd'),
+    ('cumtime', 'd'),
+    ('tottime_percall', 'd'),
+    ('cumtime_percall', 'd'),
+)
+
+# mkstemp makes files only their owner can read, but cached files should
+# get the usual permissions so that the cache can be shared. The umask
+# can only be read by setting it, so that's done once, before any
+# threads are writing files.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+FILE_MODE = 0o666 & ~_UMASK
+
+
+class FileChunks:
+    """
+    The text of a file, read a block at a time each time it is iterated.
+
+    Payloads in the disk cache are streamed to clients from the file
+    instead of being held in memory. Each block is read from disk as it
+    is needed, so they should be iterated over off the IOLoop.
+    While they are, the `DiskEntry` `entry` holding the file, if given,
+    is kept from being evicted.
+
+    """
+    def __init__(self, path, entry=None, block_size=2**16):
+        self.path = path
+        self.entry = entry
+        self.block_size = block_size
+
+    def __iter__(self):
+        with contextlib.ExitStack() as stack:
+            if self.entry is not None:
+                stack.enter_context(self.entry.cache.reading(self.entry.path))
+            f = stack.enter_context(open(self.path, encoding='utf-8'))
+            while True:
+                block = f.read(self.block_size)
+                if not block:
+                    return
+                yield block
+
+
+class DiskEntry:
+    """
+    The directory holding the converted data of one version of a profile.
+
+    Each file is written to a temporary name and then renamed so readers,
+    including other processes sharing the cache, never see partial files.
+    Errors writing to the cache are logged and otherwise ignored,
+    the data will simply be rebuilt next time.
+
+    """
+    def __init__(self, cache, path):
+        self.cache = cache
+        self.path = path
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def read_meta(self):
+        try:
+            with open(self._file('meta.json'), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write_meta(self, meta):
+        self._write('meta.json', [json.dumps(meta).encode()])
+
+    def read_payload(self, name):
+        """
+        Return a `FileChunks` for a payload written by `write_payload`,
+        or None if there isn't one.
+
+        """
+        fname = self._file(name + '.json')
+        return FileChunks(fname, self) if os.path.exists(fname) else None
+
+    def write_payload(self, name, chunks):
+        self._write(name + '.json', (c.encode() for c in chunks))
+
+    def read_columns(self):
+        """
+        Return columns written by `write_columns` in the same form as
+        `stats_columns` returns them, or None if there aren't any.
+
+        """
+        try:
+            with open(self._file('keys.json'), encoding='utf-8') as f:
+                keys = [tuple(k) for k in json.load(f)]
+            columns = {'keys': keys}
+            with open(self._file('columns.bin'), 'rb') as f:
+                for name, typecode in NUMERIC_COLUMNS:
+                    values = array(typecode)
+                    values.fromfile(f, len(keys))
+                    if np is not None:
+                        columns[name] = np.frombuffer(values, dtype=typecode)
+                    else:
+                        columns[name] = values.tolist()
+        except (OSError, ValueError, EOFError):
+            return None
+        return columns
+
+    def write_columns(self, columns):
+        def numeric():
+            for name, typecode in NUMERIC_COLUMNS:
+                if np is not None:
+                    yield np.asarray(columns[name], dtype=typecode).tobytes()
+                else:
+                    yield array(typecode, columns[name]).tobytes()
+
+        # keys.json is written last because read_columns needs both
+        self._write('columns.bin', numeric())
+        self._write('keys.json', [json.dumps(columns['keys']).encode()])
+
+    def _write(self, name, blocks):
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+            try:
+                with open(fd, 'wb') as f:
+                    f.writelines(blocks)
+                os.chmod(tmp, FILE_MODE)
+                os.replace(tmp, self._file(name))
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        except OSError as e:
+            app_log.warning('Could not write %s to the cache: %s', name, e)
+            return
+        self.cache.evict(keep=self.path)
+
+
+class DiskCache:
+    """
+    A directory of converted profiles, evicting the least recently used
+    when they take up more than `max_bytes`.
+
+    Entries are keyed by the absolute path(s), modification time and size
+    of the profile so a changed profile gets a new entry and the old one
+    ages out.
+
+    Parameters
+    ----------
+    path : str
+        Directory for the cache, created if it doesn't exist.
+    max_bytes : int
+        Maximum disk space used by the cache. The most recently
+        written entry is always kept, even if it alone is larger
+        than this, as are entries this process is reading from.
+
+    """
+    def __init__(self, path, max_bytes=1024 * 2**20):
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # entry directory -> number of files being read from it
+        self._readers = Counter()
+        os.makedirs(self.path, exist_ok=True)
+
+    def entry(self, path, mtime, size, prune=None):
+        """
+        Return the `DiskEntry` for a profile, which may not have anything
+        in it yet, and mark it as recently used.
+        Profiles pruned with different `prune_stats` options have
+        separate entries.
+
+        """
+        key = [FORMAT_VERSION, path, mtime, size]
+        if prune:
+            key.append(prune)
+        key = json.dumps(key, sort_keys=True)
+        digest = hashlib.sha256(key.encode()).hexdigest()[:32]
+        entry = DiskEntry(self, os.path.join(self.path, digest))
+        try:
+            os.utime(entry.path)
+        except OSError:
+            pass
+        return entry
+
+    @contextlib.contextmanager
+    def reading(self, path):
+        """
+        Keep the entry in directory `path` from being evicted
+        while in the context.
+
+        """
+        with self._lock:
+            self._readers[path] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._readers[path] -= 1
+                if not self._readers[path]:
+                    del self._readers[path]
+
+    def _scan(self):
+        # (last used time, bytes, path) for each entry
+        entries = []
+        for d in os.scandir(self.path):
+            if not d.is_dir():
+                continue
+            try:
+                nbytes = sum(f.stat().st_size for f in os.scandir(d.path))
+                entries.append((d.stat().st_mtime_ns, nbytes, d.path))
+            except OSError:
+                # removed by another process in the meantime
+                continue
+        return entries
+
+    @property
+    def nbytes(self):
+        return sum(e[1] for e in self._scan())
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries, other than the entry in
+        directory `keep` and those being read from, until the cache fits
+        in `max_bytes`.
+
+        """
+        with self._lock:
+            entries = sorted(self._scan())
+            total = sum(e[1] for e in entries)
+            for _, nbytes, path in entries:
+                if total <= self.max_bytes:
+                    break
+                if path == keep or path in self._readers:
+                    continue
+                shutil.rmtree(path, ignore_errors=True)
+                total -= nbytes
@@ -0,0 +1,80 @@
+"""
+This module writes the visualization of a profile to a single HTML file
+that can be opened in a browser without a SnakeViz server, for example
+when publishing profiles made by a CI job.
+
+"""
+
+import base64
+import mimetypes
+import os.path
+import re
+
+from tornado.template import Loader
+
+from .cache import DEFAULT_CUTOFF, DEFAULT_DEPTH
+from .main import settings
+
+_SCRIPT_END = re.compile(r'</(?=script)', re.IGNORECASE)
+_CSS_URL = re.compile(r'''url\((["']?)([^"')]+)\1\)''')
+
+
+def _static(name):
+    return os.path.join(settings['static_path'], name)
+
+
+def inline_script(name):
+    """
+    Return a <script> element containing the static file `name`.
+
+    """
+    with open(_static(name), encoding='utf-8') as f:
+        source = f.read()
+    return '<script>{}</script>'.format(_SCRIPT_END.sub(r'<\\/', source))
+
+
+def inline_stylesheet(name):
+    """
+    Return a <style> element containing the static file `name`,
+    with the images it refers to included as data URIs.
+
+    """
+    path = _static(name)
+
+    def data_uri(match):
+        image = os.path.normpath(
+            os.path.join(os.path.dirname(path), match.group(2)))
+        if not os.path.isfile(image):
+            return match.group(0)
+        with open(image, 'rb') as f:
+            data = base64.b64encode(f.read()).decode('ascii')
+        mime = mimetypes.guess_type(image)[0] or 'application/octet-stream'
+        return f'url("data:{mime};base64,{data}")'
+
+    with open(path, encoding='utf-8') as f:
+        css = _CSS_URL.sub(data_uri, f.read())
+    return f'<style>{css}</style>'
+
+
+def export_html(profile_name, profile, fname):
+    """
+    Write the visualization of `profile`, the `CachedProfile` for
+    `profile_name`, to the HTML file `fname`.
+
+    The page includes SnakeViz's scripts and styles, the stats table,
+    the data the browser needs to build call trees, and the call tree
+    that is shown first, so that it can be opened straight from disk.
+
+    """
+    template = Loader(settings['template_path']).load('viz.html')
+    html = template.generate(
+        profile_name=profile_name, diff=False, export=True,
+        table_url=None, hierarchy_url=None, live_url=None,
+        script=inline_script, stylesheet=inline_stylesheet,
+        table_data=''.join(profile.table_rows),
+        stats_data=''.join(profile.compact_callees),
+        hierarchy_data=''.join(
+            profile.hierarchy(None, DEFAULT_DEPTH, DEFAULT_CUTOFF)))
+
+    with open(fname, 'wb') as f:
+        f.write(html)
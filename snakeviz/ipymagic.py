@@ -1,10 +1,16 @@
-import errno
+import atexit
+import collections
+import os
+import re
+import shutil
 import subprocess
 import sys
 import tempfile
-import time
+import threading
 import uuid
+import webbrowser
 from urllib.parse import quote
+from urllib.request import urlopen
 
 __all__ = ["load_ipython_extension"]
 
@@ -15,6 +21,131 @@ JUPYTER_HTML_TEMPLATE = """
 """
 DEFAULT_HOST = "\" + document.location.hostname + \""
 
+
+class SnakevizServer:
+    """
+    A SnakeViz server run in the background for the magics.
+
+    It is started the first time a profile is shown and kept running
+    until Python exits, so later profiles are shown without waiting for
+    a new server to start. Profiles are saved to a temporary directory
+    that is removed by `close`.
+
+    """
+    def __init__(self):
+        self.process = None
+        self.host = None
+        self.port = None
+        self._profile_dir = None
+        atexit.register(self.close)
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def profile_name(self):
+        """
+        Return a new file name for a profile to be shown by the server.
+
+        """
+        if self._profile_dir is None:
+            self._profile_dir = tempfile.mkdtemp(prefix="snakeviz-")
+        return os.path.join(self._profile_dir, uuid.uuid4().hex + ".prof")
+
+    def start(self, host="127.0.0.1", port=None):
+        """
+        Start the server, listening on `host` and `port`, unless it is
+        already running in a way that serves them. If `port` is not given
+        the first free port from 8080 is used.
+
+        Returns the port the server is listening on.
+
+        """
+        if (self.running and self.host in (host, "0.0.0.0") and
+                port in (None, self.port)):
+            return self.port
+        self.stop()
+
+        environ = os.environ.copy()
+        environ["PYTHONUNBUFFERED"] = "TRUE"
+        self.process = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "snakeviz",
+                "-s",
+                "-H",
+                host,
+                "-p",
+                str(port or 8080),
+                self._profile_dir or tempfile.gettempdir(),
+            ],
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            env=environ,
+        )
+        # the server says which port it found once it is listening
+        for line in self.process.stdout:
+            match = re.match(r"snakeviz web server started on .*:(\d+);", line)
+            if match:
+                break
+        else:
+            self.stop()
+            raise RuntimeError("The SnakeViz server failed to start.")
+
+        # keep reading what the server prints so it never blocks on a
+        # full pipe
+        threading.Thread(
+            target=collections.deque, args=(self.process.stdout, 0), daemon=True
+        ).start()
+
+        self.host = host
+        self.port = int(match.group(1))
+        return self.port
+
+    def preload(self, filename):
+        """
+        Ask the server to load the profile `filename` in the background,
+        so it is ready by the time the page asks for it.
+
+        """
+        url = "http://127.0.0.1:{}/snakeviz/api/hierarchy/{}".format(
+            self.port, quote(filename, safe=""))
+
+        def load():
+            try:
+                urlopen(url).close()
+            except OSError:
+                pass
+
+        threading.Thread(target=load, daemon=True).start()
+
+    def stop(self):
+        """
+        Stop the server.
+
+        """
+        if self.process is not None:
+            self.process.terminate()
+            try:
+                self.process.wait(5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+            self.process = None
+
+    def close(self):
+        """
+        Stop the server and remove the profiles it was showing.
+
+        """
+        self.stop()
+        if self._profile_dir is not None:
+            shutil.rmtree(self._profile_dir, ignore_errors=True)
+            self._profile_dir = None
+
+
+_server = SnakevizServer()
+
 # Users may be using snakeviz in an environment where IPython is not
 # installed, this try/except makes sure that snakeviz is operational
 # in that case.
@@ -32,6 +163,7 @@ else:
             super().__init__(shell=shell, **kwargs)
             self._host = None
             self._port = None
+            self._bind = None
 
         @line_cell_magic
         def snakeviz(self, line, cell=None):
@@ -54,14 +186,18 @@ else:
             use this flag to open snakeviz visualization in a new tab
             instead of embedded within the notebook.
 
-            Note that this will briefly open a server with host 0.0.0.0,
-            which in some situations may present a slight security risk as
-            0.0.0.0 means that the server will be available on all network
-            interfaces (if they are not blocked by something like a firewall).
+            Either way the profile is shown by a server that runs until
+            IPython exits. For embedded views it listens on 0.0.0.0, so that
+            notebooks running on another machine can reach it, which in some
+            situations may present a slight security risk as 0.0.0.0 means
+            that the server will be available on all network interfaces (if
+            they are not blocked by something like a firewall) and it can
+            show any profile on this machine. Use %snakeviz_config --bind
+            127.0.0.1 to only listen for connections from this machine.
 
             """
             # get location for saved profile
-            filename = tempfile.NamedTemporaryFile().name
+            filename = _server.profile_name()
 
             # parse options
             opts, line = self.parse_options(line, "t", "new-tab", posix=False)
@@ -77,18 +213,15 @@ else:
             else:
                 ip.run_line_magic("prun", line)
 
-            # start up a Snakeviz server
+            # show the profile with the Snakeviz server, which is
+            # started the first time and then kept running
             if _check_ipynb() and not ("t" in opts or "new-tab" in opts):
                 print("Embedding SnakeViz in this document...")
-                sv = open_snakeviz_and_display_in_notebook(filename, self._host, self._port)
+                open_snakeviz_and_display_in_notebook(
+                    filename, self._host, self._port, self._bind)
             else:
                 print("Opening SnakeViz in a new tab...")
-                sv = subprocess.Popen(
-                    [sys.executable, "-m", "snakeviz", filename]
-                )
-            # give time for the Snakeviz page to load then shut down the server
-            time.sleep(3)
-            sv.terminate()
+                open_snakeviz_in_new_tab(filename)
 
         @line_magic
         def snakeviz_config(self, line):
@@ -104,13 +237,22 @@ else:
             to the server, and the port is the port used by the server and
             which will be supplied by the browser when it connects to the
             server.
+
+            A third option, -b or --bind, sets the address the server listens
+            on for visualizations embedded in notebooks, 0.0.0.0 (all network
+            interfaces) by default. Set it to 127.0.0.1 when the notebook is
+            opened on the same machine to keep other machines from reaching
+            the server.
             """
-            opts, line = self.parse_options(line, "h:p:", "host=", "port=")
+            opts, line = self.parse_options(
+                line, "h:p:b:", "host=", "port=", "bind=")
             for opt in opts:
                 if opt in ("h", "host"):
                     self._host = opts[opt]
                 elif opt in ("p", "port"):
                     self._port = opts[opt]
+                elif opt in ("b", "bind"):
+                    self._bind = opts[opt]
                 else:
                     raise ValueError("Unsupported option {opt}.".format(opt))
             host = self._host or DEFAULT_HOST
@@ -133,64 +275,15 @@ def _check_ipynb():
     return "connection_file" in cfg["IPKernelApp"]
 
 
-def open_snakeviz_and_display_in_notebook(filename, override_host=None, override_port=None):
-    def _find_free_port():
-        import socket
-        from contextlib import closing
-
-        with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
-            # snakeviz frequently gets called many times in a short period.
-            # This line tells the kernel it's okay to reuse TIME-WAIT sockets,
-            # which means snakeviz will use the same socket on successive runs,
-            # which makes life with snakeviz-over-SSH much easier.
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-            # Try a default range of five ports, then use whatever's free.
-            ports = list(range(8080, 8085)) + [0]
-            for port in ports:
-                try:
-                    s.bind(("", port))
-                except OSError as e:
-                    if e.errno == errno.EADDRINUSE:
-                        pass
-                    else:
-                        raise
-                else:
-                    return s.getsockname()[1]
-
-    port = override_port or str(_find_free_port())
-
-    def _start_and_wait_when_ready():
-        import os
-
-        environ = os.environ.copy()
-        environ["PYTHONUNBUFFERED"] = "TRUE"
-        sv = subprocess.Popen(
-            [
-                sys.executable,
-                "-m",
-                "snakeviz",
-                "-s",
-                "-H",
-                "0.0.0.0",
-                "-p",
-                port,
-                filename,
-            ],
-            stdout=subprocess.PIPE,
-            universal_newlines=True,
-            env=environ,
-        )
-        while True:
-            line = sv.stdout.readline()
-            if line.strip().startswith("snakeviz web server started"):
-                break
-        return sv
+def open_snakeviz_and_display_in_notebook(filename, override_host=None, override_port=None,
+                                          bind=None):
+    # the notebook may be open on another machine, so by default the
+    # server listens on all interfaces
+    port = _server.start(bind or "0.0.0.0", override_port and int(override_port))
+    _server.preload(filename)
 
-    sv = _start_and_wait_when_ready()
     path = "/snakeviz/%s" % quote(filename, safe="")
     host = override_host or DEFAULT_HOST
-    print(display)
     display(
         HTML(
             JUPYTER_HTML_TEMPLATE.format(
@@ -198,4 +291,12 @@ def open_snakeviz_and_display_in_notebook(filename, override_host=None, override
             )
         )
     )
-    return sv
+
+
+def open_snakeviz_in_new_tab(filename):
+    port = _server.start()
+    _server.preload(filename)
+    webbrowser.open(
+        "http://127.0.0.1:%d/snakeviz/%s" % (port, quote(filename, safe="")),
+        new=2,
+    )
@@ -0,0 +1,104 @@
+"""
+This module watches profiles that are still being written, such as those
+saved every so often by a long running program, so that open pages can be
+updated when they change.
+
+"""
+
+from collections import defaultdict
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+
+class ProfileWatcher:
+    """
+    Watch profiles for changes by polling their modification times and
+    sizes, the same key `ProfileCache` uses.
+
+    A changed profile is loaded into the cache once, however many pages
+    are watching it, and then each of its listeners is called with the
+    new key. Profiles that fail to load, for instance because they are
+    partly written, are tried again when they next change.
+
+    Parameters
+    ----------
+    cache : ProfileCache
+    interval : float
+        Seconds between polls.
+
+    """
+    def __init__(self, cache, interval=1.0):
+        self.cache = cache
+        self.interval = interval
+        self._listeners = defaultdict(set)
+        self._keys = {}
+        self._periodic = None
+        self._polling = False
+
+    def _key(self, name):
+        try:
+            return self.cache.key(name)
+        except OSError:
+            return None
+
+    def watch(self, name, listener):
+        """
+        Call `listener` when the profile `name` changes.
+
+        """
+        if name not in self._listeners:
+            self._keys[name] = self._key(name)
+        self._listeners[name].add(listener)
+
+        if self._periodic is None:
+            self._periodic = PeriodicCallback(
+                self._schedule, self.interval * 1000)
+            self._periodic.start()
+
+    def unwatch(self, name, listener):
+        """
+        Stop calling `listener` for changes to the profile `name`.
+
+        """
+        listeners = self._listeners.get(name)
+        if listeners is None:
+            return
+        listeners.discard(listener)
+        if not listeners:
+            del self._listeners[name]
+            del self._keys[name]
+
+        if not self._listeners and self._periodic is not None:
+            self._periodic.stop()
+            self._periodic = None
+
+    def _schedule(self):
+        # skip a poll if the last one is still loading profiles
+        if not self._polling:
+            IOLoop.current().spawn_callback(self.poll)
+
+    async def poll(self):
+        """
+        Check each watched profile for changes, loading those that changed
+        and calling their listeners.
+
+        """
+        self._polling = True
+        try:
+            for name in list(self._listeners):
+                key = self._key(name)
+                if name not in self._keys or key == self._keys[name]:
+                    continue
+                self._keys[name] = key
+                if key is None:
+                    continue
+
+                try:
+                    await self.cache.load(name)
+                except Exception:
+                    continue
+
+                for listener in list(self._listeners.get(name, ())):
+                    listener(key)
+        finally:
+            self._polling = False
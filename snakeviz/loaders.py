@@ -0,0 +1,364 @@
+"""
+This module converts profiles written by profilers other than cProfile
+into the statistics dictionary of a `pstats.Stats`, so that they can be
+viewed and merged like any other profile.
+
+Each loader has a function that recognizes its files from their first
+few bytes and a function that reads a file, see `register_loader`.
+Files are read as a stream, keeping only the totals for each function
+and call, so that large sample files never have to be in memory
+all at once.
+
+It is imported by the command line interface before the server is started,
+so it should only use the standard library.
+
+"""
+
+import json
+import re
+from array import array
+from collections import defaultdict
+
+# number of bytes at the start of a file given to the sniff functions
+HEAD_SIZE = 256
+
+# Seconds each sample in a collapsed stack file stands for. Those files
+# only have sample counts, this is the 100 samples a second used by
+# py-spy and many other sampling profilers.
+FOLDED_INTERVAL = 0.01
+
+# name -> (sniff, load) for each registered loader
+LOADERS = {}
+
+# a frame like "function (path/to/file.py:12)", as written by py-spy
+# and VizTracer
+_FRAME = re.compile(r'^(?P<func>.*) \((?P<file>.*):(?P<line>\d+)\)$')
+
+
+def register_loader(name, sniff, load):
+    """
+    Teach snakeviz to read a new kind of profile.
+
+    `sniff` is given the first `HEAD_SIZE` bytes of a file and returns
+    whether `load` can read it. `load` is given the path of the file and
+    returns a dictionary laid out like the ``stats`` attribute of
+    `pstats.Stats`. Loaders are tried in the order they were registered,
+    after checking for profiles written by cProfile.
+
+    """
+    LOADERS[name] = (sniff, load)
+
+
+def sniff_pstats(head):
+    """
+    Recognize profiles written by cProfile, which are dictionaries
+    saved by marshal.
+
+    """
+    # with and without marshal's reference flag set, a JSON object
+    # also starts with { but is followed by a quote or whitespace
+    return head[:1] == b'\xfb' or (
+        head[:1] == b'{' and head[1:2] not in b'"} \t\r\n')
+
+
+def profile_format(path):
+    """
+    Return the format of the file at `path`, either ``'pstats'`` for
+    profiles written by cProfile or the name of a registered loader,
+    or None if it doesn't look like a profile.
+
+    """
+    with open(path, 'rb') as f:
+        head = f.read(HEAD_SIZE)
+    if sniff_pstats(head):
+        return 'pstats'
+    for name, (sniff, _) in LOADERS.items():
+        if sniff(head):
+            return name
+    return None
+
+
+def frame_key(frame):
+    """
+    Turn the name of a frame in a stack sample or trace into a
+    (filename, lineno, function) key like those made by cProfile.
+    Frames that don't say where they are defined are treated like
+    built-in functions.
+
+    """
+    match = _FRAME.match(frame)
+    if match is None:
+        return ('~', 0, frame)
+    return (
+        match.group('file'), int(match.group('line')), match.group('func'))
+
+
+class _Totals:
+    # accumulates function and call totals, and turns them into a
+    # pstats dictionary with to_stats
+    def __init__(self):
+        self.keys = {}
+        # key -> [primitive calls, calls, tottime, cumtime]
+        self.funcs = defaultdict(lambda: [0, 0, 0.0, 0.0])
+        # (caller, callee) -> [calls, primitive calls, tottime, cumtime]
+        self.calls = defaultdict(lambda: [0, 0, 0.0, 0.0])
+
+    def key(self, frame):
+        try:
+            return self.keys[frame]
+        except KeyError:
+            key = self.keys[frame] = frame_key(frame)
+            return key
+
+    def to_stats(self):
+        callers = defaultdict(dict)
+        for (caller, callee), v in self.calls.items():
+            callers[callee][caller] = tuple(v)
+        return {
+            k: (*v, callers.get(k, {})) for k, v in self.funcs.items()}
+
+
+def sniff_folded(head):
+    """
+    Recognize collapsed stack ("folded") files, which have one line per
+    distinct stack: the frames from the outermost in, separated by
+    semicolons, then a space and the number of samples.
+
+    The first stack can be longer than `head`, in which case the file is
+    recognized by starting with a frame followed by a semicolon, where
+    the frame is either like those written by py-spy or has no spaces.
+
+    """
+    text = head.decode('utf-8', errors='replace')
+    line, newline, _ = text.partition('\n')
+    line = line.rstrip('\r')
+    if re.match(r'^[^\s;][^\n]* \d+$', line) is not None:
+        return True
+    if not newline:
+        first, semicolon, _ = line.partition(';')
+        return bool(semicolon) and '\ufffd' not in first and (
+            _FRAME.match(first) is not None or
+            re.match(r'^[^\s;]+$', first) is not None)
+    return False
+
+
+def load_folded(path, interval=FOLDED_INTERVAL):
+    """
+    Read a collapsed stack file, with each sample counting as `interval`
+    seconds.
+
+    There are no call counts in sampled profiles, so the number of calls
+    of a function is the number of samples it was on the stack for.
+    Time is cumulative for every function on a stack and internal for
+    the innermost.
+
+    """
+    totals = _Totals()
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            stack, _, count = line.rstrip().rpartition(' ')
+            try:
+                count = int(count)
+            except ValueError:
+                continue
+            if not stack or count <= 0:
+                continue
+            time = count * interval
+
+            frames = [totals.key(frame) for frame in stack.split(';')]
+            # functions and calls already on the stack, which are
+            # recursive and don't add to the cumulative time
+            seen = set()
+            caller = None
+            for key in frames:
+                func = totals.funcs[key]
+                func[1] += count
+                if key not in seen:
+                    seen.add(key)
+                    func[0] += count
+                    func[3] += time
+                if caller is not None:
+                    call = totals.calls[caller, key]
+                    call[0] += count
+                    if (caller, key) not in seen:
+                        seen.add((caller, key))
+                        call[1] += count
+                        call[3] += time
+                caller = key
+
+            totals.funcs[frames[-1]][2] += time
+            if len(frames) > 1:
+                totals.calls[frames[-2], frames[-1]][2] += time
+
+    return totals.to_stats()
+
+
+def sniff_trace_events(head):
+    """
+    Recognize Chrome trace event files, which are JSON with either
+    a list of events or an object with a ``traceEvents`` list.
+    Lists are recognized by their first event having a ``ph`` or ``ts``
+    key and objects by ``traceEvents`` being among their first keys.
+
+    """
+    text = head.decode('utf-8', errors='replace').lstrip('\ufeff \t\r\n')
+    if text.startswith('['):
+        return re.match(r'^\[\s*\{[^}]*"(ph|ts)"\s*:', text) is not None
+    return (re.match(r'^\{\s*"', text) is not None and
+            re.search(r'"traceEvents"\s*:', text) is not None)
+
+
+def iter_json_list(f, key=None, chunk_size=2**20):
+    """
+    Generate the items of a JSON list from the text file `f` without
+    reading all of it, or of the list under `key` if the file holds
+    an object.
+
+    `key` is found by searching for it, so it shouldn't appear in the
+    object before the list. The list may be unterminated, as traces
+    written by a program that was stopped often are.
+
+    """
+    decoder = json.JSONDecoder()
+    buf = f.read(chunk_size)
+    if key is not None and buf.lstrip('\ufeff \t\r\n').startswith('{'):
+        token = json.dumps(key)
+        while True:
+            pos = buf.find(token)
+            if pos >= 0:
+                buf = buf[pos + len(token):]
+                break
+            more = f.read(chunk_size)
+            if not more:
+                return
+            buf = buf[-len(token):] + more
+
+    pos = buf.find('[')
+    while pos < 0:
+        more = f.read(chunk_size)
+        if not more:
+            return
+        buf += more
+        pos = buf.find('[')
+    pos += 1
+
+    eof = False
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos < len(buf) and buf[pos] == ']':
+            return
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                return
+            more = f.read(chunk_size)
+            eof = not more
+            buf = buf[pos:] + more
+            pos = 0
+            continue
+        yield item
+        pos = end
+
+
+def _thread_calls(totals, keys, starts, durations, names):
+    # add the calls of one thread, given as parallel arrays of
+    # start times, durations, and indexes into keys
+    order = sorted(
+        range(len(starts)), key=lambda i: (starts[i], -durations[i]))
+    # open calls as [end, key, duration, time in callees]
+    stack = []
+    depth = defaultdict(int)
+
+    def finish():
+        end, key, duration, inner = stack.pop()
+        depth[key] -= 1
+        primitive = depth[key] == 0
+        tottime = max(duration - inner, 0.0)
+
+        func = totals.funcs[key]
+        func[1] += 1
+        func[2] += tottime
+        if primitive:
+            func[0] += 1
+            func[3] += duration
+
+        if stack:
+            stack[-1][3] += duration
+            call = totals.calls[stack[-1][1], key]
+            call[0] += 1
+            call[2] += tottime
+            if primitive:
+                call[1] += 1
+                call[3] += duration
+
+    for i in order:
+        start = starts[i]
+        while stack and stack[-1][0] <= start:
+            finish()
+        key = keys[names[i]]
+        depth[key] += 1
+        stack.append([start + durations[i], key, durations[i], 0.0])
+    while stack:
+        finish()
+
+
+def load_trace_events(path):
+    """
+    Read a Chrome trace event file, such as those written by VizTracer,
+    from its complete (``X``) and begin/end (``B``/``E``) events.
+
+    Each event is a call of the function named by the event, and
+    the calls of each thread are nested by their start and end times.
+    Only the times and names of events are kept until all of them have
+    been read, since complete events needn't be in order.
+
+    """
+    totals = _Totals()
+    # the functions named by events, and the index of each name in keys
+    keys = []
+    ids = {}
+    # (pid, tid) -> (starts, durations, names)
+    threads = defaultdict(lambda: (array('d'), array('d'), array('l')))
+    # (pid, tid) -> [(start, name)] for B events waiting for their E
+    open_events = defaultdict(list)
+
+    def add(thread, start, duration, name):
+        try:
+            name_id = ids[name]
+        except KeyError:
+            name_id = ids[name] = len(keys)
+            keys.append(totals.key(name))
+        starts, durations, names = threads[thread]
+        starts.append(start)
+        durations.append(duration)
+        names.append(name_id)
+
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for event in iter_json_list(f, 'traceEvents'):
+            if not isinstance(event, dict):
+                continue
+            ph = event.get('ph')
+            thread = (event.get('pid'), event.get('tid'))
+            try:
+                # times are in microseconds
+                ts = float(event['ts']) / 1e6
+                if ph == 'X':
+                    add(thread, ts, float(event.get('dur', 0)) / 1e6,
+                        str(event['name']))
+                elif ph == 'B':
+                    open_events[thread].append((ts, str(event['name'])))
+                elif ph == 'E' and open_events[thread]:
+                    start, name = open_events[thread].pop()
+                    add(thread, start, ts - start, name)
+            except (KeyError, TypeError, ValueError):
+                continue
+
+    for starts, durations, names in threads.values():
+        _thread_calls(totals, keys, starts, durations, names)
+    return totals.to_stats()
+
+
+register_loader('trace-events', sniff_trace_events, load_trace_events)
+register_loader('folded', sniff_folded, load_folded)
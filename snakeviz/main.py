@@ -1,68 +1,556 @@
 #!/usr/bin/env python
 
 import os.path
-from pstats import Stats
-import json
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from urllib.parse import quote
 
 import tornado.ioloop
 import tornado.web
+import tornado.websocket
+from tornado.escape import json_encode
+
+from .cache import ProfileCache
+from .compress import CompressedCopies, choose_encoding
+from .dirindex import DirectoryIndex, DIR_COLUMNS, dir_row
+from .live import ProfileWatcher
+from .metrics import Metrics, MeteredGZipContentEncoding
+
+def script(handler, name):
+    return '<script src="{}"></script>'.format(handler.static_url(name))
+
+
+def stylesheet(handler, name):
+    return '<link href="{}" rel="stylesheet">'.format(handler.static_url(name))
 
-from .stats import table_rows, json_stats
 
 settings = {
     'static_path': os.path.join(os.path.dirname(__file__), 'static'),
     'template_path': os.path.join(os.path.dirname(__file__), 'templates'),
-    'debug': True,
-    'gzip': True
+    # snakeviz.export includes these files in the page instead
+    'ui_methods': {'script': script, 'stylesheet': stylesheet},
+    # the command line interface shows tracebacks when not in server mode
+    'debug': False,
 }
 
+profile_cache = ProfileCache()
+dir_index = DirectoryIndex()
+compressed_static = CompressedCopies()
+profile_watcher = ProfileWatcher(profile_cache)
+metrics = Metrics()
+
+# number of directory entries on each page of a listing
+DIR_PAGE_LENGTH = 100
+
+# approximate size of the batches of a payload written before each flush
+SEND_BATCH_SIZE = 2**16
+
+
+def _next_chunks(chunks, size=SEND_BATCH_SIZE):
+    # take chunks from the iterator `chunks` until they add up to
+    # `size`, or there are none left
+    batch = []
+    total = 0
+    for chunk in chunks:
+        batch.append(chunk)
+        total += len(chunk)
+        if total >= size:
+            break
+    return batch
+
+
+class MeteredHandler(tornado.web.RequestHandler):
+    """
+    Base class for handlers whose requests are counted in `metrics`.
+
+    Subclasses time the phases of a request with `timed`. Phases that
+    are over by the time the response headers are sent are also listed
+    in a Server-Timing header so they show up in the browser's
+    developer tools.
+
+    """
+    def initialize(self):
+        self.timings = []
+        self._server_timing_set = False
 
-class VizHandler(tornado.web.RequestHandler):
-    def get(self, profile_name):
+    @contextmanager
+    def timed(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings.append((phase, time.perf_counter() - start))
+
+    def render_string(self, template_name, **kwargs):
+        with self.timed('render'):
+            return super().render_string(template_name, **kwargs)
+
+    def flush(self, include_footers=False):
+        # the first flush sends the headers
+        if not self._server_timing_set:
+            self._server_timing_set = True
+            if self.timings:
+                self.set_header('Server-Timing', ', '.join(
+                    '{};dur={:.1f}'.format(phase, seconds * 1000)
+                    for phase, seconds in self.timings))
+        return super().flush(include_footers)
+
+    def on_finish(self):
+        phases = {}
+        for phase, seconds in self.timings:
+            phases[phase] = phases.get(phase, 0) + seconds
+        compress_time = getattr(self.request, 'compress_time', 0)
+        if compress_time:
+            phases['compress'] = compress_time
+        metrics.record(
+            type(self).__name__, self.get_status(),
+            self.request.request_time(), phases,
+            getattr(self.request, 'bytes_sent', 0))
+
+
+class PrecompressedStaticFileHandler(tornado.web.StaticFileHandler):
+    """
+    Serve static files from the copies compressed ahead of time by
+    `compressed_static` to clients that accept them.
+
+    Until a file's copy has been made, the file is sent as is, to be
+    compressed as it is sent, and the copy is made on the profile
+    cache's thread pool.
+
+    Files asked for with the version argument added by ``static_url``
+    may be cached for good since their URL changes with their contents.
+
+    """
+    def validate_absolute_path(self, root, absolute_path):
+        path = super().validate_absolute_path(root, absolute_path)
+        self.encoding = None
+        if path is not None and compressed_static.compressible(path):
+            encoding = choose_encoding(
+                self.request.headers.get('Accept-Encoding', ''))
+            if encoding is not None:
+                root = os.path.abspath(root)
+                copy = compressed_static.ready(root, path, encoding)
+                if copy is None:
+                    compressed_static.build_later(
+                        profile_cache.executor, root, path, encoding)
+                else:
+                    path = copy
+                    self.encoding = encoding
+                    # the size and time sent are those of the copy,
+                    # and StaticFileHandler keeps the stat of the file
+                    self._stat_result = os.stat(copy)
+        return path
+
+    def set_headers(self):
+        super().set_headers()
+        if self.encoding is not None:
+            self.set_header('Content-Encoding', self.encoding)
+        if 'v' in self.request.arguments:
+            self.set_header(
+                'Cache-Control', f'max-age={self.CACHE_MAX_AGE}, immutable')
+
+
+class VizHandler(MeteredHandler):
+    async def get(self, profile_name):
         abspath = os.path.abspath(profile_name)
         if os.path.isdir(abspath):
-            self._list_dir(abspath)
+            await self._list_dir(abspath)
         else:
-            try:
-                s = Stats(profile_name)
-            except:
-                raise RuntimeError('Could not read %s.' % profile_name)
+            # the stats themselves are loaded by the page from the
+            # JSON API below so that this shell renders immediately
+            quoted_name = quote(profile_name, safe='')
             self.render(
                 'viz.html', profile_name=profile_name,
-                table_rows=table_rows(s), callees=json_stats(s))
+                diff=False, export=False,
+                table_url='/snakeviz/api/table/' + quoted_name,
+                hierarchy_url='/snakeviz/api/hierarchy/' + quoted_name,
+                live_url='/snakeviz/api/live/' + quoted_name)
 
-    def _list_dir(self, path):
+    async def _list_dir(self, path):
         """
         Show a directory listing.
 
+        The first page of entries is part of the page, later pages,
+        sorting and searching are served by `DirHandler`.
+
         """
-        entries = os.listdir(path)
-        dir_entries = [[[
-            '..',
-            quote(os.path.normpath(os.path.join(path, '..')), safe='')
-        ]]]
-        for name in entries:
-            if name.startswith('.'):
-                # skip invisible files/directories
-                continue
-            fullname = os.path.join(path, name)
-            displayname = linkname = name
-            # Append / for directories or @ for symbolic links
-            if os.path.isdir(fullname):
-                displayname += '/'
-            if os.path.islink(fullname):
-                displayname += '@'
-            dir_entries.append(
-                [[displayname, quote(os.path.join(path, linkname), safe='')]])
+        with self.timed('index'):
+            total, _, entries, scanning = \
+                await tornado.ioloop.IOLoop.current().run_in_executor(
+                    profile_cache.executor, dir_index.page,
+                    path, 'name', False, '', 0, DIR_PAGE_LENGTH)
 
         self.render(
-            'dir.html', dir_name=path, dir_entries=json.dumps(dir_entries))
+            'dir.html', dir_name=path, quoted_name=quote(path, safe=''),
+            parent=quote(os.path.normpath(os.path.join(path, '..')), safe=''),
+            rows=[dir_row(e) for e in entries], total=total,
+            page_length=DIR_PAGE_LENGTH, scanning=scanning)
+
+
+class ProfileDataHandler(MeteredHandler):
+    """
+    Base class for handlers serving JSON derived from a profile.
+
+    Responses carry ETag and Last-Modified headers derived from the
+    profile file(s) so browsers can revalidate them and get a 304
+    without the profile being loaded at all.
+    Subclasses implement `payload` to return the JSON for a
+    `CachedProfile` as an iterable of strings, which are sent to the client
+    a batch at a time. Loading the profile, building the payload, and
+    taking each batch of chunks from it happen on the profile cache's
+    thread pool so that the IOLoop stays free to serve other requests,
+    and so that payloads generated a piece at a time, or read from the
+    disk cache, are sent as they are produced. They are timed as the
+    ``load`` and ``convert`` phases, and sending the payload as ``send``.
+
+    Subclasses may also implement `payload_name` to name payloads that
+    are the same for every request with that name. Those are compressed
+    once for each encoding and kept with the profile, instead of being
+    compressed as they are sent.
+
+    """
+    async def get(self, profile_name):
+        try:
+            _, (mtime_ns, size) = profile_cache.key(profile_name)
+        except OSError:
+            raise tornado.web.HTTPError(404)
+
+        if self._check_cache(mtime_ns, '{:x}-{:x}'.format(mtime_ns, size)):
+            return
+
+        try:
+            with self.timed('load'):
+                profile = await profile_cache.load(profile_name)
+        except:
+            raise RuntimeError('Could not read %s.' % profile_name)
+
+        await self._send(profile)
+
+    def _check_cache(self, mtime_ns, etag):
+        # set the caching headers, returning True and sending a 304
+        # if the client's copy is up to date
+        mtime = datetime.fromtimestamp(mtime_ns // 10**9, timezone.utc)
+        self.set_header('Etag', f'"{etag}"')
+        self.set_header('Last-Modified', mtime)
+        self.set_header('Cache-Control', 'no-cache')
+
+        if self._not_modified(mtime):
+            self.set_status(304)
+            return True
+        return False
+
+    async def _send(self, profile):
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        name = self.payload_name()
+        encoding = choose_encoding(
+            self.request.headers.get('Accept-Encoding', ''))
+
+        loop = tornado.ioloop.IOLoop.current()
+        if name is not None and encoding is not None:
+            with self.timed('convert'):
+                body = await loop.run_in_executor(
+                    profile_cache.executor, profile.compressed, name,
+                    encoding, lambda: self.payload(profile))
+            self.set_header('Content-Encoding', encoding)
+            chunks = iter([body])
+        else:
+            with self.timed('convert'):
+                chunks = await loop.run_in_executor(
+                    profile_cache.executor,
+                    lambda: iter(self.payload(profile)))
+
+        with self.timed('send'):
+            while True:
+                batch = await loop.run_in_executor(
+                    profile_cache.executor, _next_chunks, chunks)
+                if not batch:
+                    break
+                for chunk in batch:
+                    self.write(chunk)
+                await self.flush()
+
+    def payload(self, profile):
+        raise NotImplementedError
+
+    def payload_name(self):
+        return None
+
+    def _not_modified(self, mtime):
+        if self.request.headers.get('If-None-Match'):
+            return self.check_etag_header()
+
+        since = self.request.headers.get('If-Modified-Since')
+        if since:
+            try:
+                return parsedate_to_datetime(since) >= mtime
+            except (TypeError, ValueError):
+                pass
+        return False
+
+
+class TableHandler(ProfileDataHandler):
+    """
+    Serve the stats table rows.
+
+    If there is a ``draw`` query argument this follows the DataTables
+    server-side processing protocol and returns one sorted and filtered
+    page of rows, otherwise it returns all of the rows.
+
+    """
+    def payload_name(self):
+        return 'table' if self.get_argument('draw', None) is None else None
+
+    def payload(self, profile):
+        if self.get_argument('draw', None) is None:
+            return profile.table_rows
+
+        try:
+            draw = int(self.get_argument('draw'))
+            start = int(self.get_argument('start', '0'))
+            length = int(self.get_argument('length', '-1'))
+            column = profile.table_columns[
+                int(self.get_argument('order[0][column]', '1'))]
+        except (ValueError, IndexError):
+            raise tornado.web.HTTPError(400, 'invalid table request')
+        descending = self.get_argument('order[0][dir]', 'desc') == 'desc'
+        search = self.get_argument('search[value]', '')
+
+        filtered, rows = profile.table_page(
+            column, descending, search, max(start, 0), length)
+        return [json_encode({
+            'draw': draw,
+            'recordsTotal': len(profile.columns['keys']),
+            'recordsFiltered': filtered,
+            'data': rows,
+        })]
+
+
+class CalleesHandler(ProfileDataHandler):
+    """
+    Serve the call graph, in the `compact_stats` layout
+    if the ``format=compact`` query argument is given.
+
+    """
+    def payload_name(self):
+        if self.get_argument('format', None) == 'compact':
+            return 'compact'
+        return 'callees'
+
+    def payload(self, profile):
+        if self.get_argument('format', None) == 'compact':
+            return profile.compact_callees
+        return profile.callees
+
+
+class HierarchyHandler(ProfileDataHandler):
+    """
+    Build the call tree for the visualization on the server.
+
+    Query arguments are the root function ``name`` (defaults to the
+    profile's root), ``parent_name``, ``depth``, and ``cutoff``.
+    With ``callers=1`` the tree is of the functions calling the root
+    instead of those it calls.
+
+    """
+    def _arguments(self):
+        name = self.get_argument('name', None)
+        parent_name = self.get_argument('parent_name', None) or None
+        try:
+            depth = int(self.get_argument('depth', '10'))
+            cutoff = float(self.get_argument('cutoff', '0.001'))
+        except ValueError:
+            raise tornado.web.HTTPError(400, 'invalid depth or cutoff')
+        callers = self.get_argument('callers', '0') not in ('', '0', 'false')
+        return name, parent_name, depth, cutoff, callers
+
+    def payload_name(self):
+        # only trees from the root of the profile, which every page
+        # shows first, are kept compressed
+        name, parent_name, depth, cutoff, callers = self._arguments()
+        if name or parent_name or callers:
+            return None
+        return f'hierarchy-{depth}-{cutoff}'
+
+    def payload(self, profile):
+        name, parent_name, depth, cutoff, callers = self._arguments()
+
+        root = None
+        if name:
+            try:
+                root = profile.func_keys[name]
+            except KeyError:
+                raise tornado.web.HTTPError(404, 'unknown function %s', name)
+
+        return profile.hierarchy(root, depth, cutoff, parent_name, callers)
+
+
+class DiffVizHandler(MeteredHandler):
+    """
+    Show how the profile named by the ``new`` query argument
+    differs from the one named by ``base``.
+
+    """
+    def get(self):
+        base = self.get_argument('base')
+        new = self.get_argument('new')
+        query = '?base={}&new={}'.format(
+            quote(base, safe=''), quote(new, safe=''))
+        self.render(
+            'viz.html', profile_name=new, diff=True, export=False,
+            table_url='/snakeviz/api/diff/table' + query,
+            hierarchy_url='/snakeviz/api/diff/hierarchy' + query,
+            live_url=None)
+
+
+class DiffDataHandler(ProfileDataHandler):
+    """
+    Base class for handlers serving JSON derived from the `CachedDiff`
+    between the profiles named by the ``base`` and ``new`` query
+    arguments, otherwise like `ProfileDataHandler`.
+
+    """
+    async def get(self):
+        names = (self.get_argument('base'), self.get_argument('new'))
+        try:
+            keys = [profile_cache.key(name)[1] for name in names]
+        except OSError:
+            raise tornado.web.HTTPError(404)
+
+        etag = '-'.join('{:x}-{:x}'.format(*key) for key in keys)
+        if self._check_cache(max(key[0] for key in keys), etag):
+            return
+
+        try:
+            with self.timed('load'):
+                diff = await profile_cache.load_diff(*names)
+        except:
+            raise RuntimeError('Could not read %s or %s.' % names)
+
+        await self._send(diff)
+
+
+class DiffTableHandler(DiffDataHandler, TableHandler):
+    pass
+
+
+class DiffHierarchyHandler(DiffDataHandler, HierarchyHandler):
+    pass
+
+
+class LiveHandler(tornado.websocket.WebSocketHandler):
+    """
+    Tell the page when the profile changes, so that it can fetch
+    what it's showing again. The profile is already loaded by
+    `profile_watcher` by the time the message is sent.
+
+    """
+    def open(self, profile_name):
+        self.profile_name = profile_name
+        profile_watcher.watch(profile_name, self.changed)
+
+    def changed(self, key):
+        _, (mtime_ns, size) = key
+        try:
+            self.write_message(
+                {'type': 'changed', 'etag': '{:x}-{:x}'.format(mtime_ns, size)})
+        except tornado.websocket.WebSocketClosedError:
+            pass
+
+    def on_close(self):
+        profile_watcher.unwatch(self.profile_name, self.changed)
+
+
+class DirHandler(MeteredHandler):
+    """
+    Serve a page of a directory listing following the DataTables
+    server-side processing protocol. Responses also say whether profiles
+    in the directory are still being summarized, so the page knows
+    to ask again.
+
+    """
+    async def get(self, dir_name):
+        path = os.path.abspath(dir_name)
+        if not os.path.isdir(path):
+            raise tornado.web.HTTPError(404)
+
+        try:
+            draw = int(self.get_argument('draw', '0'))
+            start = int(self.get_argument('start', '0'))
+            length = int(self.get_argument('length', str(DIR_PAGE_LENGTH)))
+            column = DIR_COLUMNS[int(self.get_argument('order[0][column]', '0'))]
+        except (ValueError, IndexError):
+            raise tornado.web.HTTPError(400, 'invalid directory request')
+        descending = self.get_argument('order[0][dir]', 'asc') == 'desc'
+        search = self.get_argument('search[value]', '')
+
+        with self.timed('index'):
+            total, filtered, entries, scanning = \
+                await tornado.ioloop.IOLoop.current().run_in_executor(
+                    profile_cache.executor, dir_index.page,
+                    path, column, descending, search, max(start, 0), length)
+        self.write({
+            'draw': draw,
+            'recordsTotal': total,
+            'recordsFiltered': filtered,
+            'data': [dir_row(e) for e in entries],
+            'scanning': scanning,
+        })
+
+
+class CacheInfoHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write(profile_cache.info())
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """
+    Serve `metrics` and the profile cache counters, in the Prometheus
+    text format if the ``format=prometheus`` query argument is given
+    or the client accepts ``text/plain`` (as Prometheus does),
+    otherwise as JSON.
+
+    """
+    def get(self):
+        fmt = self.get_argument('format', None)
+        if fmt is None:
+            accept = self.request.headers.get('Accept', '')
+            fmt = 'prometheus' if (
+                'text/plain' in accept or 'openmetrics' in accept) else 'json'
+
+        if fmt == 'prometheus':
+            self.set_header(
+                'Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.write(metrics.to_prometheus(profile_cache.info()))
+        elif fmt == 'json':
+            self.write({
+                'handlers': metrics.to_json(),
+                'cache': profile_cache.info(),
+            })
+        else:
+            raise tornado.web.HTTPError(400, 'unknown format %s', fmt)
 
 
-handlers = [(r'/snakeviz/(.*)', VizHandler)]
+handlers = [
+    (r'/snakeviz/api/cache', CacheInfoHandler),
+    (r'/snakeviz/metrics', MetricsHandler),
+    (r'/snakeviz/api/table/(.*)', TableHandler),
+    (r'/snakeviz/api/callees/(.*)', CalleesHandler),
+    (r'/snakeviz/api/hierarchy/(.*)', HierarchyHandler),
+    (r'/snakeviz/api/live/(.*)', LiveHandler),
+    (r'/snakeviz/api/dir/(.*)', DirHandler),
+    (r'/snakeviz/api/diff/table', DiffTableHandler),
+    (r'/snakeviz/api/diff/hierarchy', DiffHierarchyHandler),
+    (r'/snakeviz/diff', DiffVizHandler),
+    (r'/snakeviz/(.*)', VizHandler),
+]
 
-app = tornado.web.Application(handlers, **settings)
+# responses that weren't compressed ahead of time are gzipped,
+# measuring how long that takes for metrics
+app = tornado.web.Application(
+    handlers, transforms=[MeteredGZipContentEncoding],
+    static_handler_class=PrecompressedStaticFileHandler, **settings)
 
 if __name__ == '__main__':
     app.listen(8080)
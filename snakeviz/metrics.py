@@ -0,0 +1,202 @@
+"""
+This module keeps count of the requests the server handles, how long
+each phase of them takes, such as loading a profile, converting it
+to JSON, or rendering a page, and how many bytes are sent, so that
+they can be read from ``/snakeviz/metrics`` as JSON or in the
+Prometheus text format.
+
+"""
+
+import threading
+import time
+from collections import defaultdict
+
+from tornado.web import GZipContentEncoding
+
+# upper bounds in seconds of the request duration histogram's buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# ProfileCache.info() keys that are counters, the rest are gauges
+_CACHE_COUNTERS = ('hits', 'misses', 'disk_hits', 'coalesced', 'evictions')
+
+
+class _HandlerMetrics:
+    # totals for the requests to one handler
+    def __init__(self):
+        self.statuses = defaultdict(int)
+        # requests per DURATION_BUCKETS bucket, not cumulative,
+        # the last is for those slower than every bucket
+        self.buckets = [0] * (len(DURATION_BUCKETS) + 1)
+        self.seconds = 0.0
+        self.bytes_sent = 0
+        # phase -> [count, seconds]
+        self.phases = defaultdict(lambda: [0, 0.0])
+
+
+class Metrics:
+    """
+    Totals for the requests made to each handler: how many there were
+    with each status, how long they took, the time spent in each phase,
+    and the bytes sent.
+
+    """
+    def __init__(self):
+        self._handlers = defaultdict(_HandlerMetrics)
+        self._lock = threading.Lock()
+
+    def record(self, handler, status, seconds, phases, bytes_sent):
+        """
+        Add a finished request to the totals.
+
+        Parameters
+        ----------
+        handler : str
+            Name of the handler of the request.
+        status : int
+            HTTP status of the response.
+        seconds : float
+            How long the request took.
+        phases : dict
+            Seconds spent in each phase of the request, by name.
+        bytes_sent : int
+            Size of the response body as it was sent, after compression.
+
+        """
+        bucket = next(
+            (i for i, b in enumerate(DURATION_BUCKETS) if seconds <= b),
+            len(DURATION_BUCKETS))
+        with self._lock:
+            m = self._handlers[handler]
+            m.statuses[status] += 1
+            m.buckets[bucket] += 1
+            m.seconds += seconds
+            m.bytes_sent += bytes_sent
+            for phase, phase_seconds in phases.items():
+                totals = m.phases[phase]
+                totals[0] += 1
+                totals[1] += phase_seconds
+
+    def to_json(self):
+        """
+        Return the totals as a dictionary suitable for JSON encoding.
+
+        """
+        with self._lock:
+            return {
+                handler: {
+                    'requests': sum(m.statuses.values()),
+                    'statuses': {str(s): n for s, n in m.statuses.items()},
+                    'seconds': m.seconds,
+                    'bytes_sent': m.bytes_sent,
+                    'phases': {
+                        phase: {'count': count, 'seconds': seconds}
+                        for phase, (count, seconds) in m.phases.items()},
+                }
+                for handler, m in self._handlers.items()
+            }
+
+    def to_prometheus(self, cache_info=None):
+        """
+        Return the totals in the Prometheus text exposition format,
+        along with the `ProfileCache.info` counters in `cache_info`.
+
+        """
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f'# HELP snakeviz_{name} {help_text}')
+            lines.append(f'# TYPE snakeviz_{name} {kind}')
+            for suffix, labels, value in samples:
+                label_text = ','.join(
+                    '{}="{}"'.format(k, _escape_label(v)) for k, v in labels)
+                if label_text:
+                    label_text = '{' + label_text + '}'
+                lines.append(f'snakeviz_{name}{suffix}{label_text} {value}')
+
+        with self._lock:
+            handlers = sorted(self._handlers.items())
+
+            metric('requests_total', 'counter', 'Requests handled.', [
+                ('', [('handler', h), ('code', s)], n)
+                for h, m in handlers for s, n in sorted(m.statuses.items())])
+
+            durations = []
+            for h, m in handlers:
+                total = 0
+                for bound, n in zip(DURATION_BUCKETS + ('+Inf',), m.buckets):
+                    total += n
+                    durations.append(
+                        ('_bucket', [('handler', h), ('le', bound)], total))
+                durations.append(('_sum', [('handler', h)], m.seconds))
+                durations.append(('_count', [('handler', h)], total))
+            metric('request_duration_seconds', 'histogram',
+                   'Time taken to handle requests.', durations)
+
+            phases = []
+            for h, m in handlers:
+                for phase, (count, seconds) in sorted(m.phases.items()):
+                    labels = [('handler', h), ('phase', phase)]
+                    phases.append(('_sum', labels, seconds))
+                    phases.append(('_count', labels, count))
+            metric('request_phase_seconds', 'summary',
+                   'Time spent in each phase of handling requests.', phases)
+
+            metric('response_bytes_total', 'counter',
+                   'Bytes of response bodies sent, after compression.', [
+                       ('', [('handler', h)], m.bytes_sent)
+                       for h, m in handlers])
+
+        for key, value in (cache_info or {}).items():
+            if key in _CACHE_COUNTERS:
+                metric(f'cache_{key}_total', 'counter',
+                       f'Profile cache {key}.', [('', [], value)])
+            else:
+                metric(f'cache_{key}', 'gauge',
+                       f'Profile cache {key}.', [('', [], value)])
+
+        return '\n'.join(lines) + '\n'
+
+
+def _escape_label(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n')
+
+
+class MeteredGZipContentEncoding(GZipContentEncoding):
+    """
+    Tornado's gzip compression of responses that also records, on the
+    request, how long compressing took (``compress_time``) and how many
+    bytes of the body were sent (``bytes_sent``).
+
+    """
+    def __init__(self, request):
+        super().__init__(request)
+        self.request = request
+        self._first = False
+        request.compress_time = 0.0
+        request.bytes_sent = 0
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        start = time.perf_counter()
+        # the first chunk is compressed by transform_chunk
+        self._first = True
+        try:
+            status_code, headers, chunk = super().transform_first_chunk(
+                status_code, headers, chunk, finishing)
+        finally:
+            self._first = False
+        self._measure(start, chunk)
+        return status_code, headers, chunk
+
+    def transform_chunk(self, chunk, finishing):
+        if self._first:
+            return super().transform_chunk(chunk, finishing)
+        start = time.perf_counter()
+        chunk = super().transform_chunk(chunk, finishing)
+        self._measure(start, chunk)
+        return chunk
+
+    def _measure(self, start, chunk):
+        if self._gzipping:
+            self.request.compress_time += time.perf_counter() - start
+        self.request.bytes_sent += len(chunk)
@@ -0,0 +1,205 @@
+"""
+This module contains a context manager and decorator for profiling
+programs that are left running, such as servers, with little overhead.
+Only a sample of runs of the code are profiled, the results are added up
+in memory, and every so often the totals are written to a profile file
+that can be viewed with snakeviz.
+
+It only uses the standard library.
+
+"""
+
+import atexit
+import cProfile
+import functools
+import inspect
+import marshal
+import os
+import random
+import threading
+import time
+from pstats import Stats
+
+__all__ = ['Profiler', 'profile', 'profiled']
+
+# Python only allows one profiler to run at a time, in any thread
+_running = threading.Lock()
+
+# fname -> Profiler, see profile
+_profilers = {}
+_profilers_lock = threading.Lock()
+
+
+class Profiler:
+    """
+    Profile a sample of the runs of some code, adding them up and
+    writing the totals to a profile file.
+
+    Profilers are context managers, use `profile` or `profiled` to get
+    the one for a file.
+
+    Runs are only profiled if no other profiler is running, in any
+    thread, so the outermost of nested profiled code is the one that
+    is profiled.
+
+    Parameters
+    ----------
+    fname : str
+        Profile file to write.
+    sample_rate : float
+        Fraction of runs that are profiled.
+    flush_interval : float
+        Least number of seconds between writes of the totals to `fname`,
+        which happen at the end of a profiled run. They are also written
+        by `flush` and when the program exits.
+
+    """
+    def __init__(self, fname, sample_rate=1.0, flush_interval=60.0):
+        if not 0 <= sample_rate <= 1:
+            raise ValueError('sample_rate must be between 0 and 1')
+        self.fname = os.path.abspath(fname)
+        self.sample_rate = sample_rate
+        self.flush_interval = flush_interval
+        self.sampled = 0
+        self._stats = None
+        self._unsaved = False
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        # held while writing, so that writes happen in the order the
+        # totals were taken
+        self._flush_lock = threading.Lock()
+        self._local = threading.local()
+        atexit.register(self.flush)
+
+    def __enter__(self):
+        # the same code may be run again inside itself
+        stack = self._local.__dict__.setdefault('profiles', [])
+        stack.append(self._start())
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop(self._local.profiles.pop())
+        return False
+
+    def _start(self):
+        # a running cProfile.Profile if this run is sampled, else None
+        if (random.random() < self.sample_rate and
+                _running.acquire(blocking=False)):
+            prof = cProfile.Profile()
+            try:
+                prof.enable()
+            except ValueError:
+                # some other profiling tool is running
+                _running.release()
+                return None
+            return prof
+        return None
+
+    def _stop(self, prof):
+        if prof is not None:
+            prof.disable()
+            _running.release()
+            self._add(prof)
+
+    def _add(self, prof):
+        with self._lock:
+            if self._stats is None:
+                self._stats = Stats(prof)
+            else:
+                self._stats.add(prof)
+            self.sampled += 1
+            self._unsaved = True
+            due = time.monotonic() - self._last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the totals of the profiled runs so far to `fname`.
+
+        """
+        with self._flush_lock:
+            # runs can still be added while the file is written
+            with self._lock:
+                self._last_flush = time.monotonic()
+                if not self._unsaved:
+                    return
+                data = marshal.dumps(self._stats.stats)
+                self._unsaved = False
+
+            # replace the file in one go so that it's never seen half written
+            tmp = '{}.{}.tmp'.format(self.fname, os.getpid())
+            try:
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp, self.fname)
+            except BaseException:
+                with self._lock:
+                    self._unsaved = True
+                raise
+
+
+def profile(fname, sample_rate=1.0, flush_interval=60.0):
+    """
+    Return the `Profiler` writing to `fname`, for use as a
+    context manager::
+
+        with snakeviz.profile('handler.prof', sample_rate=0.01):
+            handle(request)
+
+    Every use with the same file adds to the same totals, so this can be
+    called each time the code runs. The options are those of `Profiler`
+    and only take effect the first time a file is used.
+
+    """
+    fname = os.path.abspath(fname)
+    with _profilers_lock:
+        profiler = _profilers.get(fname)
+        if profiler is None:
+            profiler = _profilers[fname] = Profiler(
+                fname, sample_rate, flush_interval)
+        return profiler
+
+
+def profiled(fname=None, sample_rate=1.0, flush_interval=60.0):
+    """
+    Decorator that profiles a sample of the calls to a function,
+    see `profile`::
+
+        @snakeviz.profiled(sample_rate=0.01)
+        def handle(request):
+            ...
+
+    `fname` defaults to the module and qualified name of the function
+    followed by ``.prof``, in the current directory.
+
+    Coroutine functions are profiled from when they start until they
+    return, so a profiled run also includes whatever else runs on its
+    thread while it is waiting, such as other tasks of an event loop.
+
+    """
+    def decorator(func):
+        name = '{}.{}'.format(func.__module__, func.__qualname__)
+        # leave out the angle brackets of <locals>
+        name = name.replace('<', '').replace('>', '')
+        profiler = profile(
+            fname or name + '.prof', sample_rate, flush_interval)
+
+        if inspect.iscoroutinefunction(func):
+            # other tasks can run in between, so the thread's stack of
+            # runs used by the context manager would get mixed up
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                prof = profiler._start()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    profiler._stop(prof)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with profiler:
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,129 @@
+"""
+This module contains functions for finding and loading profiles, including
+views that merge several profile files into one.
+Profiles may be in any format known to `snakeviz.loaders`.
+
+It is imported by the command line interface before the server is started,
+so it should only use the standard library.
+
+"""
+
+import glob
+import os
+from pstats import Stats
+
+from .loaders import LOADERS, profile_format
+
+
+def join_profile_names(names):
+    """
+    Combine several profile file names or glob patterns into the single
+    name used in snakeviz URLs. `profile_paths` splits them apart again.
+
+    """
+    return os.pathsep.join(names)
+
+
+def profile_paths(name):
+    """
+    Return the sorted absolute paths of the profile files named by `name`.
+
+    `name` is usually the path of a single profile, but it may also be
+    a glob pattern or several paths and patterns joined by `os.pathsep`,
+    in which case the matching files are merged into one view.
+    A path that exists is always taken literally.
+
+    Raises FileNotFoundError if nothing matches.
+
+    """
+    if os.path.exists(name):
+        return [os.path.abspath(name)]
+
+    paths = []
+    for part in name.split(os.pathsep):
+        if glob.has_magic(part):
+            paths.extend(p for p in glob.glob(part) if os.path.isfile(p))
+        elif part:
+            paths.append(part)
+
+    # the order files are merged in doesn't matter, so sort them to
+    # give the same view one name, and the same file named twice
+    # would count its calls twice
+    paths = sorted(set(os.path.abspath(p) for p in paths))
+    if not paths:
+        raise FileNotFoundError(f'no profiles match {name}')
+    for p in paths:
+        if not os.path.exists(p):
+            raise FileNotFoundError(f'the profile {p} does not exist')
+    return paths
+
+
+class _StatsDict:
+    # pstats.Stats accepts anything with a create_stats method and a stats
+    # attribute in place of a file name, this wraps the merged stats
+    # dictionaries sent back from worker processes so they can be added
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def read_profile(path):
+    """
+    Load the profile at `path` into a `pstats.Stats`, converting it first
+    if it wasn't written by cProfile.
+
+    """
+    fmt = profile_format(path)
+    if fmt is None or fmt == 'pstats':
+        # pstats explains what's wrong with files it can't read
+        return Stats(path)
+    _, load = LOADERS[fmt]
+    return Stats(_StatsDict(load(path)))
+
+
+def read_profiles(paths):
+    """
+    Load the profiles at `paths` and merge them into one `pstats.Stats`.
+
+    """
+    stats = read_profile(paths[0])
+    for path in paths[1:]:
+        stats.add(read_profile(path))
+    return stats
+
+
+def _merged_stats_dict(paths):
+    # runs in a worker process, a Stats instance can't be pickled but
+    # the dictionary of its stats can
+    return read_profiles(paths).stats
+
+
+def load_stats(paths, processes=1):
+    """
+    Load and merge the profiles at `paths` into one `pstats.Stats`.
+
+    With more than one process the files are split between that many
+    worker processes which each parse and merge their share, so that only
+    one partial result per worker needs merging here.
+
+    """
+    nparts = min(len(paths), processes)
+    if nparts < 2:
+        return read_profiles(paths)
+
+    # only imported when needed since the command line interface uses
+    # this module
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    # The pool only lives as long as the merge, and its workers are spawned
+    # rather than forked so they never inherit the server's sockets.
+    parts = [paths[i::nparts] for i in range(nparts)]
+    stats = Stats()
+    with ProcessPoolExecutor(
+            nparts, mp_context=multiprocessing.get_context('spawn')) as pool:
+        for merged in pool.map(_merged_stats_dict, parts):
+            stats.add(_StatsDict(merged))
+    return stats
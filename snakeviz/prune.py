@@ -0,0 +1,270 @@
+"""
+This module leaves parts of a profile out before it is converted for
+the browser, such as functions that take up very little time or code
+from the standard library, so that large profiles are quicker to send
+and draw.
+
+Functions that are left out are removed from the call graph with their
+time added to their callers, so the cumulative times of the functions
+that are kept, and the total time of the profile, don't change.
+
+"""
+
+import fnmatch
+import re
+from collections import defaultdict
+from pstats import Stats
+
+from .profiles import _StatsDict
+
+# function name of the node a collapsed file becomes
+COLLAPSED_NAME = '<collapsed>'
+
+_SITE_PACKAGES = re.compile(r'[\\/](site|dist)-packages[\\/]')
+_STDLIB = re.compile(
+    r'[\\/]lib(64)?[\\/]python\d+(\.\d+)?t?[\\/]|\\Lib\\|^<frozen ')
+
+# names that can be given instead of glob patterns
+PATTERN_NAMES = {
+    'builtins': lambda f: f == '~',
+    'site-packages': lambda f: _SITE_PACKAGES.search(f) is not None,
+    'stdlib': lambda f: (_STDLIB.search(f) is not None and
+                         _SITE_PACKAGES.search(f) is None),
+}
+
+
+def file_matcher(patterns):
+    """
+    Return a function telling whether a file name from a profile
+    matches any of `patterns`.
+
+    Patterns are globs matched against the whole file name, such as
+    ``*/mypackage/*``, or one of ``builtins`` (functions written in C),
+    ``stdlib``, or ``site-packages``.
+
+    """
+    tests = []
+    for pattern in patterns:
+        if pattern in PATTERN_NAMES:
+            tests.append(PATTERN_NAMES[pattern])
+        else:
+            tests.append(re.compile(fnmatch.translate(pattern)).match)
+
+    cache = {}
+
+    def matches(filename):
+        try:
+            return cache[filename]
+        except KeyError:
+            match = cache[filename] = any(t(filename) for t in tests)
+            return match
+    return matches
+
+
+def prune_stats(stats, min_fraction=0, max_functions=None, include=(),
+                exclude=(), collapse=()):
+    """
+    Return a copy of the `pstats.Stats` `stats` with some functions
+    left out and their time added to their callers.
+
+    Parameters
+    ----------
+    stats : pstats.Stats
+    min_fraction : float
+        Leave out functions whose cumulative time is less than this
+        fraction of the root's.
+    max_functions : int, optional
+        Keep at most this many functions, those with the most
+        cumulative time.
+    include : sequence of str
+        If given, only keep functions in files matching these patterns,
+        see `file_matcher`.
+    exclude : sequence of str
+        Leave out functions in files matching these patterns.
+    collapse : sequence of str
+        Turn the functions of each file matching these patterns into
+        a single function, named ``<collapsed>``. Calls between them
+        are left out.
+
+    The root of the profile (see `find_root`) is always kept, as are
+    other functions nothing calls, such as those threads start in,
+    since there is no caller to add their time to.
+
+    """
+    # [pcalls, ncalls, tottime, cumtime, {caller: [ncalls, pcalls,
+    # tottime, cumtime]}] for each function, mutable copies of the
+    # stats tuples
+    funcs = {
+        key: [cc, nc, tt, ct, {c: list(e) for c, e in callers.items()}]
+        for key, (cc, nc, tt, ct, callers) in stats.stats.items()}
+
+    if collapse:
+        funcs = _collapse(funcs, file_matcher(collapse))
+
+    # the edges in funcs by caller, sharing the lists of call totals
+    callees = defaultdict(dict)
+    for key, func in funcs.items():
+        for caller, call in func[4].items():
+            callees[caller][key] = call
+
+    root = _find_root(funcs, callees)
+    keep = set(funcs)
+    if include:
+        matches = file_matcher(include)
+        keep = {k for k in keep if matches(k[0])}
+    if exclude:
+        matches = file_matcher(exclude)
+        keep = {k for k in keep if not matches(k[0])}
+    if min_fraction and root is not None:
+        least = min_fraction * funcs[root][3]
+        keep = {k for k in keep if funcs[k][3] >= least}
+    if max_functions is not None:
+        keep = set(sorted(
+            keep, key=lambda k: funcs[k][3], reverse=True)[:max_functions])
+    if root is not None:
+        keep.add(root)
+    keep.update(
+        k for k, func in funcs.items() if not any(c != k for c in func[4]))
+
+    # removing the functions with the least time first moves time up
+    # the call graph one level at a time
+    removed = sorted(
+        (k for k in funcs if k not in keep), key=lambda k: funcs[k][3])
+    for key in removed:
+        _remove(funcs, callees, key)
+
+    pruned = {
+        key: (cc, nc, tt, ct, {
+            c: (_count(e[0]), _count(e[1]), e[2], e[3])
+            for c, e in callers.items()})
+        for key, (cc, nc, tt, ct, callers) in funcs.items()}
+    return Stats(_StatsDict(pruned))
+
+
+def _count(n):
+    # calls moved from a removed function are shared out between its
+    # callers, so may no longer be whole numbers
+    return max(round(n), 1) if n > 0 else 0
+
+
+def _find_root(funcs, callees):
+    # like stats.find_root
+    possible_roots = [
+        k for k in funcs
+        if callees.get(k) and not any(c != k for c in funcs[k][4])]
+    return max(possible_roots or funcs, key=lambda k: funcs[k][3],
+               default=None)
+
+
+def _collapse(funcs, matches):
+    groups = {
+        key: (key[0], 0, COLLAPSED_NAME)
+        for key in funcs if matches(key[0])}
+    reentrant = _reentrant(funcs, groups)
+
+    collapsed = {}
+    for key, (cc, nc, tt, ct, callers) in funcs.items():
+        group = groups.get(key, key)
+        func = collapsed.setdefault(group, [0, 0, 0.0, 0.0, {}])
+        func[2] += tt
+        if group == key:
+            func[0] += cc
+            func[1] += nc
+            func[3] += ct
+        elif not callers:
+            # a function nothing calls is only counted for itself
+            func[0] += cc
+            func[1] += nc
+            func[3] += ct
+
+        for caller, call in callers.items():
+            caller_group = groups.get(caller, caller)
+            if group != key:
+                if caller_group == group:
+                    # a call within the collapsed file
+                    continue
+                if caller in reentrant[group]:
+                    # a call back into the file from something it called,
+                    # like a recursive call its time is already counted
+                    func[1] += call[0]
+                else:
+                    # the collapsed file's calls and time are those of
+                    # the calls from outside of it
+                    func[0] += call[1]
+                    func[1] += call[0]
+                    func[3] += call[3]
+            totals = func[4].setdefault(caller_group, [0, 0, 0.0, 0.0])
+            for i, value in enumerate(call):
+                totals[i] += value
+
+    # share the own time of each collapsed file, which includes the
+    # functions only called from within it, between its callers
+    for group in set(groups.values()):
+        func = collapsed[group]
+        for _, call, share in _shares(func, group):
+            call[2] = func[2] * share
+    return collapsed
+
+
+def _reentrant(funcs, groups):
+    # the functions called, directly or not, by the functions of each
+    # collapsed file
+    callees = defaultdict(list)
+    for key, func in funcs.items():
+        for caller in func[4]:
+            callees[caller].append(key)
+
+    members = defaultdict(list)
+    for key, group in groups.items():
+        members[group].append(key)
+
+    reachable = {}
+    for group, keys in members.items():
+        seen = set()
+        stack = [c for k in keys for c in callees[k]]
+        while stack:
+            key = stack.pop()
+            if key not in seen:
+                seen.add(key)
+                stack.extend(callees[key])
+        reachable[group] = seen
+    return reachable
+
+
+def _shares(func, key):
+    # each caller of a function with the fraction of the function's
+    # time spent called by it
+    callers = {c: e for c, e in func[4].items() if c != key}
+    total = sum(e[3] for e in callers.values())
+    for caller, call in callers.items():
+        yield caller, call, call[3] / total if total else 1 / len(callers)
+
+
+def _remove(funcs, callees, key):
+    # remove a function from the call graph, adding its time to its
+    # callers and connecting them to its callees
+    func = funcs.pop(key)
+    shares = list(_shares(func, key))
+    called = {c: e for c, e in callees.pop(key, {}).items() if c != key}
+    for caller, _, _ in shares:
+        del callees[caller][key]
+    for callee in called:
+        del funcs[callee][4][key]
+
+    for caller, _, share in shares:
+        # the function's own time becomes its callers' own time,
+        # including the time each of them spent called by their callers
+        time = func[2] * share
+        funcs[caller][2] += time
+        for _, call, caller_share in _shares(funcs[caller], caller):
+            call[2] += time * caller_share
+
+        for callee, callee_call in called.items():
+            if callee == caller:
+                continue
+            totals = funcs[callee][4].get(caller)
+            if totals is None:
+                totals = funcs[callee][4][caller] = [0, 0, 0.0, 0.0]
+                callees[caller][callee] = totals
+            for i, value in enumerate(callee_call):
+                totals[i] += value * share
@@ -0,0 +1,188 @@
+// This contains a Canvas renderer for the visualization, an alternative to
+// the SVG renderer in drawsvg.js that stays fast for large call trees.
+//
+// All of the nodes are painted onto one <canvas> in a single pass instead
+// of each getting its own SVG element. Nodes less than half a pixel across,
+// and everything beneath them, are skipped. The node under the mouse is
+// found by picking the ring or row under the pointer and binary searching
+// it, and every node for a function is looked up in an index by name
+// for highlighting.
+
+var make_canvas_obj = function make_canvas_obj(style) {
+  var params = get_render_params(style);
+  // draw at the screen's resolution so the canvas isn't blurry
+  var ratio = window.devicePixelRatio || 1;
+  var canvas = d3.select("#chart")
+    .style('margin-left', 'auto')
+    .style('margin-right', 'auto')
+    .append("canvas")
+    .attr("id", "container")
+    .attr("width", params["width"] * ratio)
+    .attr("height", params["height"] * ratio)
+    .style("width", params["width"] + "px")
+    .style("height", params["height"] + "px");
+  canvas.node().getContext("2d").scale(ratio, ratio);
+  return canvas;
+};
+
+
+// The color of the lines between nodes, matching the stroke
+// on the SVG nodes in snakeviz.css
+var sv_canvas_stroke = function sv_canvas_stroke() {
+  if (window.matchMedia &&
+      window.matchMedia('(prefers-color-scheme: dark)').matches) {
+    return getComputedStyle(document.documentElement)
+      .getPropertyValue('--dark-theme-black').trim();
+  }
+  return '#fff';
+};
+
+
+// Where sunburst nodes are drawn and how the mouse position maps back
+// to the partition layout's coordinates.
+var get_sunburst_canvas_geometry = function get_sunburst_canvas_geometry(params) {
+  var y = params["y"];
+  var angle = function (a) {
+    // d3 measures angles clockwise from 12 o'clock,
+    // canvas clockwise from 3 o'clock
+    return Math.max(0, Math.min(2 * Math.PI, a)) - Math.PI / 2;
+  };
+  return {
+    "origin": [params["radius"], params["radius"]],
+    "size": function (d) {
+      // length of the outer edge of the arc
+      return d.dx * y(d.y + d.dy);
+    },
+    "path": function (ctx, d) {
+      ctx.arc(0, 0, y(d.y + d.dy), angle(d.x), angle(d.x + d.dx));
+      ctx.arc(0, 0, y(d.y), angle(d.x + d.dx), angle(d.x), true);
+      ctx.closePath();
+    },
+    "locate": function (px, py) {
+      var a = Math.atan2(px, -py);
+      if (a < 0) {
+        a += 2 * Math.PI;
+      }
+      return [a, y.invert(Math.sqrt(px * px + py * py))];
+    }
+  };
+};
+
+
+var get_icicle_canvas_geometry = function get_icicle_canvas_geometry(params, root) {
+  var x = d3.scale.linear()
+      .domain([0, root.dx])
+      .range([0, params["width"] - params["leftMargin"]]);
+  var y = d3.scale.linear()
+      .domain([0, root.dy * $('#sv-depth-select').val()])
+      .range([0, params["height"] - params["topMargin"]]);
+  return {
+    "origin": [params["leftMargin"], params["topMargin"]],
+    "size": function (d) {
+      return x(d.dx);
+    },
+    "path": function (ctx, d) {
+      ctx.rect(x(d.x), y(d.y), x(d.dx), y(d.dy));
+    },
+    "label": function (ctx, d) {
+      // like the SVG labels, only drawn if they fit the node's width
+      var lines = [d.display_name, d.cumulative.toPrecision(3) + " s"];
+      ctx.font = "15px sans-serif";
+      ctx.textAlign = "center";
+      ctx.fillStyle = "black";
+      if (_.every(lines, function (l) {
+          return ctx.measureText(l).width <= x(d.dx); })) {
+        var cx = x(d.x + d.dx / 2.0);
+        var cy = y(d.y + d.dy / 2.0);
+        ctx.fillText(lines[0], cx, cy);
+        ctx.fillText(lines[1], cx, cy + 18);
+      }
+    },
+    "locate": function (px, py) {
+      return [x.invert(px), y.invert(py)];
+    }
+  };
+};
+
+
+var drawCanvas = function drawCanvas(style, json) {
+  var params = get_render_params(style);
+  var all_nodes = params["partition"].nodes(json);
+  var root = all_nodes[0];
+  var geometry = (style === "sunburst") ?
+    get_sunburst_canvas_geometry(params) :
+    get_icicle_canvas_geometry(params, root);
+
+  // The partition layout lists parents before their children,
+  // so a node can be culled along with its parent in one pass.
+  var nodes = _.filter(all_nodes, function (d) {
+    d.sv_culled = (d.parent != null && d.parent.sv_culled) ||
+      geometry.size(d) < 0.5;
+    return !d.sv_culled;
+  });
+
+  // Nodes at each depth are in order of their x coordinate.
+  var levels = _.groupBy(nodes, 'depth');
+  var by_name = _.groupBy(nodes, 'name');
+
+  var ctx = vis.node().getContext("2d");
+  ctx.translate(geometry["origin"][0], geometry["origin"][1]);
+  ctx.strokeStyle = sv_canvas_stroke();
+
+  var paint = function (d, fill) {
+    ctx.beginPath();
+    geometry.path(ctx, d);
+    ctx.fillStyle = fill;
+    ctx.fill();
+    ctx.stroke();
+    if (geometry.label) {
+      geometry.label(ctx, d);
+    }
+  };
+
+  _.each(nodes, function (d) { paint(d, color(d)); });
+
+  var find = function (canvas) {
+    var mouse = d3.mouse(canvas);
+    var pos = geometry.locate(
+      mouse[0] - geometry["origin"][0], mouse[1] - geometry["origin"][1]);
+    var level = levels[Math.floor(pos[1] / root.dy)];
+    if (level === undefined) {
+      return null;
+    }
+    var i = _.sortedLastIndexBy(level, {'x': pos[0]}, 'x') - 1;
+    if (i < 0 || pos[0] >= level[i].x + level[i].dx) {
+      return null;
+    }
+    return level[i];
+  };
+
+  // Nodes never overlap, so highlighting only repaints the nodes
+  // for the functions entering and leaving the highlight.
+  var highlighted = null;
+  var highlight = function (d) {
+    if (d === highlighted) {
+      return;
+    }
+    if (highlighted !== null) {
+      _.each(by_name[highlighted.name], function (n) { paint(n, color(n)); });
+    }
+    highlighted = d;
+    if (d !== null) {
+      var thiscolor = d3.rgb('#ff00ff').toString();
+      _.each(by_name[d.name], function (n) { paint(n, thiscolor); });
+      sv_update_info_div(d);
+      sv_show_info_div();
+    }
+  };
+
+  vis
+    .on('mousemove', function () { highlight(find(this)); })
+    .on('mouseout.highlight', function () { highlight(null); })
+    .on('click', function () {
+      var d = find(this);
+      if (d !== null) {
+        click(d);
+      }
+    });
+};
@@ -27,7 +27,8 @@ var get_sunburst_render_params = function get_sunburst_render_params() {
     "radius": radius,
     "transform": "translate(" + radius + "," + radius + ")",
     "partition": partition,
-    "arc": arc
+    "arc": arc,
+    "y": y
   };
 };
 
@@ -62,8 +63,21 @@ var get_render_params = function get_render_params(style) {
 // Colors.
 var scale = d3.scale.category20c();
 
+// In the diff view nodes have a delta, the change in the function's
+// cumulative time, and are colored from green for functions that got
+// faster to red for ones that got slower.
+var diff_scale = d3.scale.linear()
+    .domain([-1, 0, 1])
+    .range(['#1a9850', '#f7f7f7', '#d73027'])
+    .clamp(true);
+
 // should make it so that a given function is always the same color
 var color = function color(d) {
+  if (d.delta !== undefined) {
+    // the change as a fraction of the larger of the old and new times
+    var base = d.cumulative - d.delta;
+    return diff_scale(d.delta / (Math.max(d.cumulative, base) || 1));
+  }
   return scale(d.name);
 };
 
@@ -83,12 +97,16 @@ var make_vis_obj = function make_vis_obj (style) {
 var vis = make_vis_obj("sunburst");
 
 
-var reset_vis = function reset_vis (style) {
+var reset_vis = function reset_vis (style, renderer) {
   // Remove the current figure
-  d3.select('svg').remove();
+  d3.select('#chart').selectAll('*').remove();
 
-  // Make and draw the new svg container
-  vis = make_vis_obj(style);
+  // Make the new svg or canvas container, see drawcanvas.js for the latter
+  if (renderer === "canvas") {
+    vis = make_canvas_obj(style);
+  } else {
+    vis = make_vis_obj(style);
+  }
 };
 
 // This is the function that runs whenever the user clicks on an SVG
@@ -155,7 +173,11 @@ var sv_info_tpl = _.template(
    '<div class="sv-info-label">Line:</div>',
    '<div class="sv-info-item"><%= line %></div>',
    '<div class="sv-info-label">Directory:</div>',
-   '<div class="sv-info-item"><%- directory %></div>'
+   '<div class="sv-info-item"><%- directory %></div>',
+   '<% if (delta !== undefined) { %>',
+   '<div class="sv-info-label">Change in Cumulative Time:</div>',
+   '<div class="sv-info-item"><%= delta %> s</div>',
+   '<% } %>'
   ].join('\n'));
 
 var sv_update_info_div = function sv_update_info_div (d) {
@@ -174,7 +196,9 @@ var sv_update_info_div = function sv_update_info_div (d) {
     'line': result[2],
     'name': result[3],
     'cumulative': d.cumulative.toPrecision(3),
-    'cumulative_percent': (d.cumulative / sv_total_time * 100).toFixed(2)
+    'cumulative_percent': (d.cumulative / sv_total_time * 100).toFixed(2),
+    'delta': (d.delta === undefined) ? undefined :
+      ((d.delta > 0) ? '+' : '') + d.delta.toPrecision(3)
   };
 
   var style = $('#sv-style-select').val();
@@ -306,8 +330,11 @@ var drawIcicle = function drawIcicle(json) {
 // Clear and redraw the visualization
 var redraw_vis = function redraw_vis(json) {
   var style = $('#sv-style-select').val();
-  reset_vis(style);
-  if (style === "sunburst") {
+  var renderer = $('#sv-renderer-select').val();
+  reset_vis(style, renderer);
+  if (renderer === "canvas") {
+    drawCanvas(style, json);
+  } else if (style === "sunburst") {
     drawSunburst(json);
   } else if (style === "icicle") {
     drawIcicle(json);
@@ -352,5 +379,7 @@ var sv_selects_changed = function sv_selects_changed() {
   sv_draw_vis(_.last(sv_call_stack), parent_name);
 };
 d3.select('#sv-style-select').on('change', sv_selects_changed);
+d3.select('#sv-renderer-select').on('change', sv_selects_changed);
 d3.select('#sv-depth-select').on('change', sv_selects_changed);
 d3.select('#sv-cutoff-select').on('change', sv_selects_changed);
+d3.select('#sv-direction-select').on('change', sv_selects_changed);
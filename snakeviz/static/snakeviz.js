@@ -1,29 +1,3 @@
-// Look for something that calls other functions,
-// but is never called itself.
-var sv_find_root = function sv_find_root (stats) {
-    var callers = Immutable.Set.fromKeys(stats);
-    var callees = Immutable.Set();
-
-    for (var key in stats) {
-        callees = callees.union(Immutable.Set.fromKeys(stats[key]['children']));
-    }
-
-    var diff = callers.subtract(callees);
-    if (diff.size !== 0) {
-        // hopefully there's only one thing left...
-        var possible_roots = diff.toJS();
-    } else {
-        var possible_roots = _.keys(stats);
-    }
-
-    // if more than one potential root found, fall back on finding the thing
-    // with the most cummulative time
-    return _.maxBy(possible_roots, function (s) {
-        return stats[s]['stats'][3];
-    });
-};
-
-
 // Returns the hierarchy depth value from the depth <select> element
 var sv_hierarchy_depth = function sv_hierarchy_depth() {
     return parseInt($('#sv-depth-select').val(), 10);
@@ -39,6 +13,13 @@ var sv_hierarchy_cutoff = function sv_hierarchy_cutoff() {
 };
 
 
+// Whether the direction <select> element asks for the tree of the
+// functions calling the root rather than the functions it calls
+var sv_hierarchy_callers = function sv_hierarchy_callers() {
+    return $('#sv-direction-select').val() === 'callers';
+};
+
+
 // Configures the call stack button's settings and appearance
 // for when the call stack is hidden.
 var sv_call_stack_btn_for_show = function sv_call_stack_btn_for_show() {
@@ -158,14 +139,10 @@ var sv_make_worker = function sv_make_worker() {
         [$('#hierarchy-worker').text()], {'type': 'text/javascript'});
     var blobURL = URL.createObjectURL(blob);
     var sv_worker = new Worker(blobURL);
+    sv_worker.postMessage({'stats': sv_stats_text});
 
     sv_worker.onmessage = function (event) {
-        var json = JSON.parse(event.data);
-        if (cache_key != null) {
-            sv_json_cache[cache_key] = json;
-        }
-        redraw_vis(json);
-        _.defer(sv_hide_working);
+        sv_show_hierarchy(JSON.parse(event.data), cache_key);
     };
 
     sv_worker.onerror = function (event) {
@@ -186,31 +163,165 @@ var sv_make_worker = function sv_make_worker() {
 
 
 var sv_cycle_worker = function sv_cycle_worker() {
+    if (sv_hierarchy_url) {
+        if (sv_hierarchy_xhr !== null) {
+            sv_hierarchy_xhr.abort();
+        }
+        return;
+    }
     sv_end_worker();
     sv_worker = sv_make_worker();
 };
 
 
-var sv_draw_vis = function sv_draw_vis(root_name, parent_name) {
-    sv_show_working();
-    var message = {
+// URL of the server's hierarchy API for this profile, see sv_draw_vis
+var sv_hierarchy_url = null;
+
+// Set from the first hierarchy drawn, see sv_show_hierarchy
+var sv_root_func_name__cached = null;
+
+
+// Request a hierarchy from the SnakeViz server, which builds it from the
+// full profile so that only the nodes that will be drawn are downloaded.
+// Only the most recent request is kept so that a slow response can't
+// overwrite the result of a later click.
+var sv_hierarchy_xhr = null;
+var sv_request_hierarchy = function sv_request_hierarchy(message, key) {
+    if (sv_hierarchy_xhr !== null) {
+        sv_hierarchy_xhr.abort();
+    }
+    sv_hierarchy_xhr = $.getJSON(sv_hierarchy_url, _.omitBy(message, _.isNil))
+        .done(function (json) {
+            sv_show_hierarchy(json, key);
+        })
+        .fail(function (xhr, status) {
+            if (status !== 'abort') {
+                sv_show_error_msg();
+                sv_hide_working();
+            }
+        })
+        .always(function () {
+            sv_hierarchy_xhr = null;
+        });
+    return sv_hierarchy_xhr;
+};
+
+
+// Cache and draw a newly built hierarchy. The first hierarchy drawn
+// starts from the profile's root function, which is recorded here.
+var sv_show_hierarchy = function sv_show_hierarchy(json, key) {
+    if (json['name'] === sv_root_func_name__cached) {
+        // the profile may have changed, see sv_watch_profile
+        sv_total_time = json['cumulative'];
+    }
+    if (sv_root_func_name__cached === null) {
+        sv_root_func_name = json['name'];
+        sv_root_func_name__cached = sv_root_func_name;
+        sv_call_stack = [sv_root_func_name];
+        sv_total_time = json['cumulative'];
+        key = JSON.stringify(sv_vis_message(sv_root_func_name));
+
+        // Initialize the call stack button
+        sv_update_call_stack_list();
+        sv_call_stack_btn_for_show();
+    }
+    if (key != null) {
+        sv_json_cache[key] = json;
+    }
+    redraw_vis(json);
+    _.defer(sv_hide_working);
+};
+
+
+var sv_vis_message = function sv_vis_message(root_name, parent_name) {
+    return {
         'depth': sv_hierarchy_depth(),
         'cutoff': sv_hierarchy_cutoff(),
         'name': root_name,
         'parent_name': parent_name,
-        'url': window.location.origin
+        // null rather than false so that it's left out of server requests
+        'callers': sv_hierarchy_callers() ? 1 : null
     };
+};
+
+
+// Look for a cached hierarchy with the same root and cutoff as message
+// but a greater depth, which can be cut down instead of building a new one.
+var sv_find_deeper_hierarchy = function sv_find_deeper_hierarchy(message) {
+    var found = null;
+    _.forOwn(sv_json_cache, function (json, key) {
+        var other = JSON.parse(key);
+        // == so that missing names match null ones
+        if (other['depth'] > message['depth'] &&
+                other['cutoff'] === message['cutoff'] &&
+                other['callers'] === message['callers'] &&
+                other['name'] == message['name'] &&
+                other['parent_name'] == message['parent_name']) {
+            found = json;
+            return false;
+        }
+    });
+    return found;
+};
+
+
+// Copy the nodes of a hierarchy down to max_depth, leaving out the
+// layout D3 has added to them.
+var sv_truncate_hierarchy = function sv_truncate_hierarchy(node, max_depth) {
+    var copy = _.pick(
+        node, ['name', 'display_name', 'time', 'cumulative', 'parent_name', 'delta']);
+    if (max_depth > 0 && node.children) {
+        copy['children'] = _.map(node.children, function (child) {
+            return sv_truncate_hierarchy(child, max_depth - 1);
+        });
+    }
+    return copy;
+};
+
+
+// The hierarchy is built by the SnakeViz server if sv_hierarchy_url is set,
+// otherwise by the web worker from the full stats data.
+// Lowering the depth reuses the deeper hierarchy already drawn.
+var sv_draw_vis = function sv_draw_vis(root_name, parent_name) {
+    sv_show_working();
+    var message = sv_vis_message(root_name, parent_name);
 
     cache_key = JSON.stringify(message);
+    var deeper = null;
     if (_.has(sv_json_cache, cache_key)) {
         redraw_vis(sv_json_cache[cache_key]);
         sv_hide_working();
+    } else if ((deeper = sv_find_deeper_hierarchy(message)) !== null) {
+        sv_show_hierarchy(
+            sv_truncate_hierarchy(deeper, message['depth']), cache_key);
+    } else if (sv_hierarchy_url) {
+        sv_request_hierarchy(message, cache_key);
     } else {
         sv_worker.postMessage(message);
     }
 };
 
 
+// Keep the page up to date with a profile that is still being written.
+// The SnakeViz server says when the profile has changed, then the table
+// page and the call tree on display are fetched again.
+var sv_watch_profile = function sv_watch_profile(url) {
+    var protocol = (window.location.protocol === 'https:') ? 'wss://' : 'ws://';
+    var socket = new WebSocket(protocol + window.location.host + url);
+    socket.onmessage = function (event) {
+        var message = JSON.parse(event.data);
+        if (message['type'] !== 'changed' || sv_root_func_name__cached === null) {
+            return;
+        }
+        sv_json_cache = {};
+        $('#pstats-table').DataTable().ajax.reload(null, false);
+        var n = sv_call_stack.length;
+        sv_draw_vis(sv_call_stack[n - 1], (n > 1) ? sv_call_stack[n - 2] : null);
+    };
+    return socket;
+};
+
+
 // An error message for when the worker fails building the call tree
 var sv_show_error_msg = function sv_show_error_msg() {
     var radius = get_sunburst_render_params()["radius"];
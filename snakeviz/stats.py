@@ -1,10 +1,139 @@
+import gc
 import os.path
-from itertools import chain
+import threading
+from contextlib import contextmanager
+from itertools import chain, islice
 
-from tornado.escape import xhtml_escape
+from tornado.escape import json_encode, xhtml_escape
 
+# NumPy is optional, it speeds up the bulk arithmetic in stats_columns
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
-def table_rows(stats):
+
+@contextmanager
+def _gc_paused():
+    """
+    Turn off the cyclic garbage collector while building large
+    structures. None of the objects made here form cycles, but making
+    millions of them triggers repeated, expensive collections.
+
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def calc_callees(stats):
+    """
+    Work out `stats.all_callees`, the calls made by each function,
+    if it hasn't been already, and return it.
+
+    `pstats.Stats.calc_callees` swaps in an empty dictionary and then
+    fills it, so other threads reading the graph while it is built see
+    it empty or incomplete. `CachedProfile` calls this when it loads a
+    profile, before the stats are shared, after which it does nothing.
+
+    """
+    if stats.all_callees is None:
+        stats.calc_callees()
+    return stats.all_callees
+
+
+def stats_columns(stats):
+    """
+    Load the per-function stats into columns for bulk processing.
+
+    Returns a dictionary of equal length sequences with keys:
+
+    keys
+        keys of `stats.stats`
+    pcalls, ncalls, tottime, cumtime
+        the first four entries of each stats tuple: primitive
+        (non-recursive) calls, total calls, and times
+    tottime_percall, cumtime_percall
+        times per primitive call, zero for functions that were never
+        called
+
+    The numeric columns are NumPy arrays if NumPy is installed,
+    otherwise lists.
+
+    """
+    keys = list(stats.stats)
+    n = len(keys)
+
+    if np is not None:
+        values = np.fromiter(
+            chain.from_iterable(v[:4] for v in stats.stats.values()),
+            dtype=float, count=4 * n).reshape(n, 4)
+        pcalls = values[:, 0].astype(np.int64)
+        ncalls = values[:, 1].astype(np.int64)
+        tottime = values[:, 2]
+        cumtime = values[:, 3]
+        called = pcalls > 0
+        tottime_percall = np.divide(
+            tottime, pcalls, out=np.zeros(n), where=called)
+        cumtime_percall = np.divide(
+            cumtime, pcalls, out=np.zeros(n), where=called)
+    else:
+        pcalls, ncalls, tottime, cumtime = (
+            [list(c) for c in zip(*(v[:4] for v in stats.stats.values()))]
+            or ([], [], [], []))
+        tottime_percall = [
+            t / c if c > 0 else 0 for t, c in zip(tottime, pcalls)]
+        cumtime_percall = [
+            t / c if c > 0 else 0 for t, c in zip(cumtime, pcalls)]
+
+    return {
+        'keys': keys,
+        'pcalls': pcalls,
+        'ncalls': ncalls,
+        'tottime': tottime,
+        'cumtime': cumtime,
+        'tottime_percall': tottime_percall,
+        'cumtime_percall': cumtime_percall,
+    }
+
+
+def _tolist(column):
+    return column.tolist() if np is not None else column
+
+
+def _take(column, indices):
+    if np is not None:
+        return column[np.asarray(indices, dtype=np.intp)]
+    return [column[i] for i in indices]
+
+
+def column_order(column):
+    """
+    Return the indices that sort `column` in ascending order.
+
+    """
+    if np is not None and isinstance(column, np.ndarray):
+        return np.argsort(column, kind='stable')
+    order = sorted(range(len(column)), key=column.__getitem__)
+    return np.array(order, dtype=np.intp) if np is not None else order
+
+
+def filter_order(order, mask):
+    """
+    Keep the entries of a sort order from `column_order`
+    whose rows are true in `mask`.
+
+    """
+    if np is not None:
+        return order[np.asarray(mask, dtype=bool)[order]]
+    return [i for i in order if mask[i]]
+
+
+def table_rows(stats, columns=None):
     """
     Generate a list of stats info lists for the snakeviz stats table.
 
@@ -12,31 +141,164 @@ def table_rows(stats):
 
     calls tot_time tot_time_per_call cum_time cum_time_per_call file_line_func
 
+    `columns` may be passed in if `stats_columns` has already been called.
+
     """
     rows = []
 
-    for k, v in stats.stats.items():
-        flf = xhtml_escape('{}:{}({})'.format(
-            os.path.basename(k[0]), k[1], k[2]))
+    with _gc_paused():
+        rows.extend(iter_table_rows(stats, columns))
+
+    return rows
+
+
+def iter_table_rows(stats, columns=None, indices=None):
+    """
+    Generate the rows of `table_rows` one at a time.
+
+    If `indices` is given only those rows are generated, in that order.
+
+    """
+    if columns is None:
+        columns = stats_columns(stats)
+
+    keys = columns['keys']
+    numeric = [columns[c] for c in (
+        'pcalls', 'ncalls', 'tottime', 'cumtime',
+        'tottime_percall', 'cumtime_percall')]
+
+    if indices is not None:
+        keys = [keys[i] for i in indices]
+        numeric = [_take(c, indices) for c in numeric]
+
+    fmt = '{:.4g}'.format
+
+    # many functions share a file, so only escape each file name once
+    basenames = {}
+
+    for k, pc, nc, tt, ct, ttp, ctp in zip(keys, *map(_tolist, numeric)):
+        try:
+            basename = basenames[k[0]]
+        except KeyError:
+            basename = basenames[k[0]] = xhtml_escape(
+                os.path.basename(k[0]))
+        flf = '{}:{}({})'.format(basename, k[1], xhtml_escape(k[2]))
         name = '{}:{}({})'.format(*k)
 
-        if v[0] == v[1]:
-            calls = str(v[0])
+        if pc == nc:
+            calls = str(pc)
         else:
-            calls = f'{v[1]}/{v[0]}'
+            calls = f'{nc}/{pc}'
 
-        fmt = '{:.4g}'.format
+        tot_time = fmt(tt)
+        cum_time = fmt(ct)
+        tot_time_per = fmt(ttp) if pc > 0 else 0
+        cum_time_per = fmt(ctp) if pc > 0 else 0
 
-        tot_time = fmt(v[2])
-        cum_time = fmt(v[3])
-        tot_time_per = fmt(v[2] / v[0]) if v[0] > 0 else 0
-        cum_time_per = fmt(v[3] / v[0]) if v[0] > 0 else 0
+        yield [[calls, nc], tot_time, tot_time_per,
+               cum_time, cum_time_per, flf, name]
 
-        rows.append(
-            [[calls, v[1]], tot_time, tot_time_per,
-             cum_time, cum_time_per, flf, name])
 
-    return rows
+# stats compared by diff_columns
+DIFF_METRICS = ('ncalls', 'tottime', 'cumtime')
+
+
+def diff_columns(base, new):
+    """
+    Line up the functions of two profiles and compute how much each
+    changed from `base` to `new`, both `stats_columns` results.
+
+    Functions are matched on their keys with a hash join, so this takes
+    time in proportion to the number of functions.
+
+    Returns a dictionary of equal length sequences with keys:
+
+    keys
+        keys of `new` followed by the keys only in `base`
+    base_ncalls, base_tottime, base_cumtime
+        stats in `base`, zero for functions not in it
+    new_ncalls, new_tottime, new_cumtime
+        stats in `new`, zero for functions not in it
+    delta_ncalls, delta_tottime, delta_cumtime
+        the new stats minus the base stats
+
+    The numeric columns are NumPy arrays if NumPy is installed,
+    otherwise lists.
+
+    """
+    index = {k: i for i, k in enumerate(base['keys'])}
+    # popping the matches leaves the functions only in base
+    positions = [index.pop(k, -1) for k in new['keys']]
+    removed = list(index.values())
+    positions.extend(removed)
+
+    keys = list(new['keys']) + [base['keys'][i] for i in removed]
+    n_new = len(new['keys'])
+    columns = {'keys': keys}
+
+    if np is not None:
+        positions = np.asarray(positions, dtype=np.intp)
+        matched = positions >= 0
+
+    for m in DIFF_METRICS:
+        if np is not None:
+            base_values = np.asarray(base[m])
+            new_values = np.asarray(new[m])
+            b = np.zeros(len(keys), dtype=base_values.dtype)
+            b[matched] = base_values[positions[matched]]
+            n = np.zeros(len(keys), dtype=new_values.dtype)
+            n[:n_new] = new_values
+        else:
+            b = [base[m][i] if i >= 0 else 0 for i in positions]
+            n = list(new[m]) + [0] * len(removed)
+
+        columns['base_' + m] = b
+        columns['new_' + m] = n
+        columns['delta_' + m] = (
+            n - b if np is not None else [y - x for x, y in zip(b, n)])
+
+    return columns
+
+
+def iter_diff_rows(columns, indices=None):
+    """
+    Generate rows of the stats table comparing two profiles from
+    the result of `diff_columns`.
+
+    Each row has the filename:lineno(function) followed by the base, new,
+    and change in cumtime, tottime and ncalls, and finally the full name
+    of the function.
+    If `indices` is given only those rows are generated, in that order.
+
+    """
+    keys = columns['keys']
+    numeric = [
+        columns[prefix + m]
+        for m in ('cumtime', 'tottime', 'ncalls')
+        for prefix in ('base_', 'new_', 'delta_')]
+
+    if indices is not None:
+        keys = [keys[i] for i in indices]
+        numeric = [_take(c, indices) for c in numeric]
+
+    fmt = '{:.4g}'.format
+    delta_fmt = '{:+.4g}'.format
+
+    basenames = {}
+
+    for k, *values in zip(keys, *map(_tolist, numeric)):
+        try:
+            basename = basenames[k[0]]
+        except KeyError:
+            basename = basenames[k[0]] = xhtml_escape(
+                os.path.basename(k[0]))
+        flf = '{}:{}({})'.format(basename, k[1], xhtml_escape(k[2]))
+
+        bc, nc, dc, bt, nt, dt, bn, nn, dn = values
+        yield [flf, fmt(bc), fmt(nc), delta_fmt(dc),
+               fmt(bt), fmt(nt), delta_fmt(dt),
+               str(int(bn)), str(int(nn)), '{:+d}'.format(int(dn)),
+               '{}:{}({})'.format(*k)]
 
 
 def json_stats(stats):
@@ -44,35 +306,337 @@ def json_stats(stats):
     Convert the all_callees data structure to something compatible with
     JSON. Mostly this means all keys need to be strings.
 
+    """
+    with _gc_paused():
+        return dict(iter_json_stats(stats))
+
+
+def iter_json_stats(stats):
+    """
+    Generate the items of `json_stats` one at a time.
+
     """
     keyfmt = '{}:{}({})'.format
 
-    def _replace_keys(d):
-        return {keyfmt(*k): v for k, v in d.items()}
+    calc_callees(stats)
 
-    stats.calc_callees()
+    # functions appear many times as callers and callees,
+    # so only format each name once
+    names = {k: keyfmt(*k) for k in stats.all_callees}
 
-    nstats = {}
+    # leave out anything that both never called anything and was never
+    # called by anything.
+    # this is profiler cruft.
+    called = set(chain.from_iterable(stats.all_callees.values()))
 
     for k, v in stats.all_callees.items():
-        nk = keyfmt(*k)
-        nstats[nk] = {}
-        nstats[nk]['children'] = {
-            keyfmt(*ck): list(cv) for ck, cv in v.items()}
-        nstats[nk]['stats'] = list(stats.stats[k][:4])
-        nstats[nk]['callers'] = {
-            keyfmt(*ck): list(cv) for ck, cv in stats.stats[k][-1].items()}
-        nstats[nk]['display_name'] = keyfmt(os.path.basename(k[0]), k[1], k[2])
-
-    # remove anything that both never called anything and was never called
-    # by anything.
-    # this is profiler cruft.
-    no_calls = {k for k, v in nstats.items() if not v['children']}
-    called = set(chain.from_iterable(
-        d['children'].keys() for d in nstats.values()))
-    cruft = no_calls - called
+        if not v and k not in called:
+            continue
+        yield names[k], {
+            'children': {names[ck]: list(cv) for ck, cv in v.items()},
+            'stats': list(stats.stats[k][:4]),
+            'callers': {
+                names[ck]: list(cv)
+                for ck, cv in stats.stats[k][-1].items()},
+            'display_name': keyfmt(os.path.basename(k[0]), k[1], k[2]),
+        }
+
+
+def _batched(iterable, n):
+    it = iter(iterable)
+    while True:
+        with _gc_paused():
+            batch = list(islice(it, n))
+        if not batch:
+            return
+        yield batch
+
+
+def json_array_chunks(values, batch_size=1000):
+    """
+    Encode the values from an iterable as a JSON array, a batch of values
+    at a time, so that the whole array never has to be in memory.
+
+    Yields strings that join together to make the complete array.
+
+    """
+    yield '['
+    sep = ''
+    for batch in _batched(values, batch_size):
+        yield sep + json_encode(batch)[1:-1]
+        sep = ','
+    yield ']'
+
+
+def json_object_chunks(items, batch_size=1000):
+    """
+    Like `json_array_chunks`, but encodes (key, value) pairs
+    as a JSON object.
+
+    """
+    yield '{'
+    sep = ''
+    for batch in _batched(items, batch_size):
+        yield sep + json_encode(dict(batch))[1:-1]
+        sep = ','
+    yield '}'
+
+
+def find_root(stats):
+    """
+    Look for something that calls other functions but is never called
+    itself. If there are several candidates (or none) fall back on the
+    one with the most cumulative time.
+
+    Returns a key from `stats.stats`.
+
+    """
+    calc_callees(stats)
+
+    called = set(chain.from_iterable(stats.all_callees.values()))
+    possible_roots = [
+        k for k, v in stats.all_callees.items() if v and k not in called]
+    if not possible_roots:
+        possible_roots = list(stats.stats)
+
+    return max(possible_roots, key=lambda k: stats.stats[k][3])
+
+
+def build_hierarchy(stats, root, max_depth, cutoff, parent_name=None,
+                    callers=False):
+    """
+    Build the call tree drawn by the sunburst and icicle visualizations.
+
+    This is the same algorithm as the browser's ``sv_build_hierarchy``
+    so that the server can send only the nodes that will be drawn
+    instead of the whole call graph.
+
+    Parameters
+    ----------
+    stats : pstats.Stats
+    root : tuple
+        Key from `stats.stats` of the function at the root of the tree.
+    max_depth : int
+        Number of levels below the root to descend.
+    cutoff : float
+        Children taking up less than this fraction of their parent's
+        time are left out of the tree.
+    parent_name : str, optional
+        Recorded as the ``parent_name`` of the root node.
+    callers : bool, optional
+        Build the tree of the functions calling `root` instead,
+        see `CallerHierarchy`.
+
+    Returns
+    -------
+    dict
+        Nested nodes with keys name, display_name, time, cumulative,
+        parent_name, and children.
+
+    """
+    cls = CallerHierarchy if callers else Hierarchy
+    return cls(stats, root, cutoff, parent_name).tree(max_depth)
+
+
+class Hierarchy:
+    """
+    The call tree made by `build_hierarchy`, built a level at a time
+    as deeper trees are asked for.
+
+    The levels built so far are kept, so asking for the tree to a greater
+    depth only builds the new levels and a shallower tree is just a copy
+    of the top of the one already built.
+    Building is thread safe once the call graph of `stats` has been
+    worked out by `calc_callees`, as `CachedProfile` does when it loads
+    a profile.
+
+    """
+    def __init__(self, stats, root, cutoff, parent_name=None):
+        self.stats = stats
+        self.cutoff = cutoff
+        self.depth = 0
+        self.nodes = 1
+        self.root = self._node(root, stats.stats[root][3], parent_name)
+        # nodes at self.depth that may have children, with the functions
+        # above them so we can avoid infinitely displaying instances
+        # of recursion
+        self._frontier = [(self.root, root, frozenset([root]))]
+        self._lock = threading.Lock()
+
+    def _node(self, key, node_time, parent_name):
+        keyfmt = '{}:{}({})'.format
+        return {
+            'name': keyfmt(*key),
+            'display_name': keyfmt(os.path.basename(key[0]), key[1], key[2]),
+            'time': node_time,
+            'cumulative': self.stats.stats[key][3],
+            'parent_name': parent_name,
+        }
+
+    def _links(self, key):
+        # the functions below key in the tree, with the stats of
+        # their calls
+        return calc_callees(self.stats).get(key)
+
+    def _expand(self, data, key, call_stack):
+        # add the children of one node, returning the ones that may
+        # themselves have children
+        children = self._links(key)
+        if not children:
+            return []
+
+        node_time = data['time']
+
+        # the time recorded for a child under this node is its time
+        # under this function everywhere in the call tree, so the
+        # child times can add up to more than the node's and need
+        # to be normalized.
+        child_times = {
+            ck: cv[3] for ck, cv in children.items()
+            if ck not in call_stack}
+        total_children_time = sum(child_times.values())
+        if total_children_time > node_time:
+            scale = node_time / total_children_time
+            child_times = {ck: t * scale for ck, t in child_times.items()}
+
+        frontier = []
+        data['children'] = []
+        for ck, t in child_times.items():
+            if node_time and t / node_time > self.cutoff:
+                child = self._node(ck, t, data['name'])
+                data['children'].append(child)
+                frontier.append((child, ck, call_stack | {ck}))
+
+        # the plots only account for time in leaf nodes, so add a
+        # child for the time spent in this function itself
+        if total_children_time < node_time:
+            data['children'].append({
+                'name': data['name'],
+                'display_name': data['display_name'],
+                'parent_name': data['parent_name'],
+                'cumulative': data['cumulative'],
+                'time': node_time - total_children_time,
+            })
+
+        self.nodes += len(data['children'])
+        return frontier
+
+    def expand(self, max_depth):
+        """
+        Build any levels of the tree down to `max_depth` that haven't
+        been built yet.
+
+        """
+        with self._lock:
+            while self.depth < max_depth and self._frontier:
+                self._frontier = [
+                    child
+                    for node in self._frontier
+                    for child in self._expand(*node)]
+                self.depth += 1
+
+    def tree(self, max_depth):
+        """
+        Return the tree down to `max_depth` as nested dictionaries,
+        building any levels that are missing.
+
+        """
+        self.expand(max_depth)
+
+        def copy(data, depth):
+            if depth >= max_depth or 'children' not in data:
+                return {k: v for k, v in data.items() if k != 'children'}
+            return dict(data, children=[
+                copy(c, depth + 1) for c in data['children']])
+
+        return copy(self.root, 0)
+
+
+class CallerHierarchy(Hierarchy):
+    """
+    The inverted, or bottom-up, call tree of the functions that called
+    `root`: the children of each node are the functions that called it,
+    and the time of each is the part of the root's cumulative time spent
+    in calls made through them.
+
+    The profile only records the time of each call from one function to
+    another, so the time of a node is shared between its callers in
+    proportion to the time spent in the calls each of them made. Like
+    `Hierarchy`, functions already on the path to the root are left out
+    and the tree is built a level at a time, so finding the callers of
+    a function is quick however large the profile. The callers are
+    recorded in the stats themselves, so the call graph worked out by
+    `calc_callees` isn't needed.
+
+    """
+    def _links(self, key):
+        return self.stats.stats[key][4]
+
+
+def compact_stats(stats):
+    """
+    A compact alternative to `json_stats`.
+
+    Functions are identified by their position in a function table and
+    the call graph is stored as flat integer adjacency arrays, so each
+    function name appears only once. As in `json_stats`, functions that
+    neither call nor are called by anything are left out.
+
+    Returns a dictionary with keys:
+
+    files
+        list of [file name, base name] pairs
+    functions
+        list of [file index, line number, function name]
+    stats
+        flat list of ncalls, primitive calls, tottime, cumtime
+        for each function
+    callees
+        dictionary of ``offsets``, ``ids`` and ``stats``.
+        The calls made by function ``i`` are the entries
+        ``offsets[i]`` through ``offsets[i + 1]`` of ``ids``,
+        the callees, and of ``stats``, four numbers per call.
+    callers
+        dictionary of ``offsets``, ``ids`` and ``edges``, laid out the
+        same way as ``callees`` but with ``edges`` giving the index of
+        each call's stats in the ``callees`` arrays.
+
+    """
+    calc_callees(stats)
+
+    called = set(chain.from_iterable(stats.all_callees.values()))
+    keys = [k for k, v in stats.all_callees.items() if v or k in called]
+    ids = {k: i for i, k in enumerate(keys)}
+
+    files = {}
+    functions = []
+    func_stats = []
+    for k in keys:
+        if k[0] not in files:
+            files[k[0]] = len(files)
+        functions.append([files[k[0]], k[1], k[2]])
+        func_stats.extend(stats.stats[k][:4])
+
+    callees = {'offsets': [0], 'ids': [], 'stats': []}
+    edges = {}
+    for k in keys:
+        for ck, cv in stats.all_callees[k].items():
+            edges[k, ck] = len(callees['ids'])
+            callees['ids'].append(ids[ck])
+            callees['stats'].extend(cv[:4])
+        callees['offsets'].append(len(callees['ids']))
 
-    for c in cruft:
-        del nstats[c]
+    callers = {'offsets': [0], 'ids': [], 'edges': []}
+    for k in keys:
+        for pk in stats.stats[k][-1]:
+            callers['ids'].append(ids[pk])
+            callers['edges'].append(edges[pk, k])
+        callers['offsets'].append(len(callers['ids']))
 
-    return nstats
+    return {
+        'files': [[f, os.path.basename(f)] for f in files],
+        'functions': functions,
+        'stats': func_stats,
+        'callees': callees,
+        'callers': callers,
+    }
@@ -0,0 +1,46 @@
+import importlib.util
+import json
+import os
+from pstats import Stats
+
+import pytest
+
+from snakeviz.stats import find_root
+
+BENCH = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), 'benchmarks', 'bench.py')
+
+
+@pytest.fixture(scope='module')
+def bench():
+    spec = importlib.util.spec_from_file_location('bench', BENCH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_synthetic_stats(bench, tmp_path):
+    path = str(tmp_path / 'synthetic.prof')
+    bench.write_profile(path, bench.synthetic_stats(100, 3, 2))
+
+    stats = Stats(path)
+    assert len(stats.stats) == 100
+    assert find_root(stats)[2] == 'function_0'
+    # recursive functions call themselves
+    recursive = stats.stats[next(k for k in stats.stats if k[2] == 'function_5')]
+    assert recursive[1] == 3 * recursive[0]
+
+
+def test_main(bench, tmp_path, capsys):
+    out = str(tmp_path / 'bench.json')
+    args = ['--functions', '50', '--fanout', '3', '--recursion', '1',
+            '--repeat', '1']
+    assert bench.main(args + ['--json', out]) == 0
+    assert bench.main(args + ['--compare', out]) == 0
+
+    with open(out) as f:
+        report = json.load(f)
+    results = report['results']['50x3r1']
+    assert results['table_rows']['size'] > 0
+    assert results['http_table_warm']['time'] > 0
+    assert 'ratio' in capsys.readouterr().out
@@ -0,0 +1,310 @@
+import asyncio
+import cProfile
+import glob
+import gzip
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from snakeviz.cache import ProfileCache
+from snakeviz.diskcache import DiskCache
+
+
+def make_prof(fname):
+    cProfile.runctx('glob.glob("*")', {}, {'glob': glob}, fname)
+    return fname
+
+
+@pytest.fixture
+def profs(tmpdir):
+    return [make_prof(str(tmpdir.join(f'{i}.prof'))) for i in range(3)]
+
+
+def test_cache_hit_and_miss(profs):
+    cache = ProfileCache()
+    first = cache.get(profs[0])
+    assert cache.get(profs[0]) is first
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert '"stats"' in ''.join(first.callees)
+
+
+def test_cache_invalidated_on_change(profs):
+    cache = ProfileCache()
+    first = cache.get(profs[0])
+    st = os.stat(profs[0])
+    os.utime(profs[0], ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert cache.get(profs[0]) is not first
+    assert cache.misses == 2
+
+
+def test_cache_evicts_lru(profs):
+    cache = ProfileCache(max_entries=2)
+    for p in profs:
+        cache.get(p)
+    info = cache.info()
+    assert info['entries'] == 2
+    assert info['evictions'] == 1
+    cache.get(profs[0])
+    assert cache.misses == 4
+
+
+def test_cache_max_bytes_keeps_newest(profs):
+    cache = ProfileCache(max_bytes=1)
+    for p in profs:
+        cache.get(p)
+    assert cache.info()['entries'] == 1
+    cache.get(profs[-1])
+    assert cache.hits == 1
+
+
+def test_cache_evicts_when_entries_grow(profs):
+    cache = ProfileCache()
+    cache.get(profs[0])
+    second = cache.get(profs[1])
+    cache.max_bytes = cache.nbytes + 10
+    assert cache.evictions == 0
+
+    second.callees
+    assert cache.evictions == 1
+    assert cache.info()['entries'] == 1
+
+
+def test_cache_load_coalesces(profs):
+    cache = ProfileCache()
+
+    # hold up the load until every request has been made, otherwise it
+    # can finish first and the later requests are cache hits
+    release = threading.Event()
+    load = cache._load
+
+    def held_load(*args):
+        release.wait(5)
+        return load(*args)
+    cache._load = held_load
+
+    async def load_all():
+        loads = [asyncio.ensure_future(cache.load(profs[0])) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+        return await asyncio.gather(*loads)
+
+    entries = asyncio.run(load_all())
+    assert all(e is entries[0] for e in entries)
+    assert (cache.misses, cache.coalesced) == (1, 2)
+    assert asyncio.run(cache.load(profs[0])) is entries[0]
+    assert cache.hits == 1
+
+
+def test_call_graph_built_on_load(profs, tmpdir):
+    profile = ProfileCache().get(profs[0])
+    callees = profile.stats.all_callees
+    assert callees
+
+    # payloads built on other threads use the graph as it is
+    with ThreadPoolExecutor(4) as pool:
+        trees = list(pool.map(
+            lambda _: ''.join(profile.hierarchy(None, 10, 0)), range(4)))
+        list(pool.map(lambda _: profile.compact_callees, range(4)))
+    assert len(set(trees)) == 1
+    assert profile.stats.all_callees is callees
+
+    # and when the profile is only parsed after loading from disk
+    cache = ProfileCache(disk=DiskCache(str(tmpdir.join('cache'))))
+    cache.get(profs[0])
+    cache.clear()
+    profile = cache.get(profs[0])
+    assert profile.from_disk
+    assert profile.stats.all_callees
+
+
+def test_table_page(profs):
+    profile = ProfileCache().get(profs[0])
+    total = len(profile.columns['keys'])
+
+    filtered, rows = profile.table_page('tottime', True, '', 0, 5)
+    assert filtered == total
+    assert len(rows) == 5
+    times = [float(r[1]) for r in rows]
+    assert times == sorted(times, reverse=True)
+
+    filtered, rows = profile.table_page('display_name', False, 'GLOB py', 0, -1)
+    assert 0 < filtered < total
+    assert len(rows) == filtered
+    assert all('glob' in r[5] and 'py' in r[5] for r in rows)
+    assert [r[5].lower() for r in rows] == sorted(r[5].lower() for r in rows)
+
+
+def test_disk_cache(profs, tmpdir):
+    disk = DiskCache(str(tmpdir.join('cache')))
+    first = ProfileCache(disk=disk).get(profs[0])
+    assert not first.from_disk
+    payloads = [
+        ''.join(first.table_rows), ''.join(first.callees),
+        ''.join(first.compact_callees), ''.join(first.hierarchy(None, 10, 0))]
+    page = first.table_page('cumtime', True, 'glob', 0, 10)
+
+    # a new process with the same cache directory
+    cache = ProfileCache(disk=disk)
+    second = cache.get(profs[0])
+    assert second.from_disk
+    assert cache.info()['disk_hits'] == 1
+    assert second.root == first.root
+    assert [
+        ''.join(second.table_rows), ''.join(second.callees),
+        ''.join(second.compact_callees),
+        ''.join(second.hierarchy(None, 10, 0))] == payloads
+    assert second.table_page('cumtime', True, 'glob', 0, 10) == page
+    assert second._stats is None
+
+    # anything not in the cache falls back on the profile
+    name = next(iter(second.func_keys))
+    key = second.func_keys[name]
+    assert second.hierarchy(key, 3, 0, 'x') == first.hierarchy(key, 3, 0, 'x')
+    assert second._stats is not None
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='POSIX permissions')
+def test_disk_cache_file_mode(profs, tmpdir):
+    disk = DiskCache(str(tmpdir.join('cache')))
+    profile = ProfileCache(disk=disk).get(profs[0])
+    profile.callees
+    umask = os.umask(0)
+    os.umask(umask)
+    for name in os.listdir(profile.disk.path):
+        mode = os.stat(os.path.join(profile.disk.path, name)).st_mode
+        assert mode & 0o777 == 0o666 & ~umask
+
+
+def test_disk_cache_evicts(profs, tmpdir):
+    disk = DiskCache(str(tmpdir.join('cache')), max_bytes=1)
+    cache = ProfileCache(disk=disk)
+    for p in profs:
+        cache.get(p).callees
+    assert len(os.listdir(disk.path)) == 1
+    assert ProfileCache(disk=disk).get(profs[-1]).from_disk
+
+
+def test_disk_cache_keeps_entries_being_read(profs, tmpdir):
+    disk = DiskCache(str(tmpdir.join('cache')), max_bytes=1)
+    ProfileCache(disk=disk).get(profs[0]).callees
+    reading = ProfileCache(disk=disk).get(profs[0])
+    chunks = iter(reading.callees)
+    first = next(chunks)
+
+    ProfileCache(disk=disk).get(profs[1]).callees
+    assert os.path.isdir(reading.disk.path)
+    assert json.loads(first + ''.join(chunks))
+
+    ProfileCache(disk=disk).get(profs[2]).callees
+    assert not os.path.isdir(reading.disk.path)
+
+
+def test_merged_profiles(profs, tmpdir):
+    cache = ProfileCache(processes=2)
+    pattern = str(tmpdir.join('*.prof'))
+    merged = cache.get(pattern)
+    assert merged.path == tuple(sorted(profs))
+    assert cache.get(os.pathsep.join(reversed(profs))) is merged
+
+    single = cache.get(profs[0]).stats
+    key = max(single.stats, key=lambda k: single.stats[k][3])
+    assert merged.stats.stats[key][1] == 3 * single.stats[key][1]
+
+    make_prof(str(tmpdir.join('3.prof')))
+    assert len(cache.get(pattern).paths) == 4
+
+    with pytest.raises(FileNotFoundError):
+        cache.get(str(tmpdir.join('*.nope')))
+
+
+def test_hierarchy_reused(profs):
+    profile = ProfileCache().get(profs[0])
+    shallow = profile.hierarchy(None, 2, 0)
+    tree, = profile._hierarchies.values()
+    assert tree.depth == 2
+
+    deep = profile.hierarchy(None, 10, 0)
+    assert list(profile._hierarchies.values()) == [tree]
+    assert tree.depth > 2
+    assert profile.hierarchy(None, 2, 0) == shallow
+    assert profile.hierarchy(profile.root, 10, 0) == deep
+
+    profile.hierarchy(None, 10, 0.01)
+    assert len(profile._hierarchies) == 2
+
+
+def test_root_hierarchy_payload_kept_in_memory(profs):
+    profile = ProfileCache().get(profs[0])
+    first = profile.hierarchy(None, 5, 0)
+    assert profile.hierarchy(None, 5, 0) is first
+    assert profile.hierarchy(profile.root, 5, 0) is first
+    assert profile.hierarchy(None, 6, 0) is not first
+
+
+def test_caller_hierarchy_cached(profs):
+    profile = ProfileCache().get(profs[0])
+    leaf, = [k for k in profile.stats.stats if k[2] == 'glob']
+    tree = json.loads(''.join(profile.hierarchy(leaf, 10, 0, callers=True)))
+    assert tree['name'] == '{}:{}({})'.format(*leaf)
+    assert tree['children']
+
+    cached, = profile._hierarchies.values()
+    assert profile.hierarchy(leaf, 3, 0, callers=True)
+    assert list(profile._hierarchies.values()) == [cached]
+
+    # trees of the callees from the same root are kept apart
+    callees = json.loads(''.join(profile.hierarchy(leaf, 10, 0)))
+    assert len(profile._hierarchies) == 2
+    assert callees != tree
+
+
+def test_diff(profs, tmpdir):
+    cache = ProfileCache()
+    base = str(tmpdir.join('base.prof'))
+    cProfile.runctx('sorted(range(10))', {}, {}, base)
+    diff = asyncio.run(cache.load_diff(base, profs[0]))
+    assert asyncio.run(cache.load_diff(base, profs[0])) is diff
+
+    tree = json.loads(''.join(diff.hierarchy(None, 10, 0)))
+    assert tree['delta'] == pytest.approx(diff.cumtime_deltas[tree['name']])
+    assert all('delta' in child for child in tree['children'])
+
+    _, rows = diff.table_page('delta_cumtime', True, '', 0, -1)
+    deltas = [float(r[3]) for r in rows]
+    assert deltas == sorted(deltas, reverse=True)
+    assert any('builtins.sorted' in r[-1] for r in rows)
+
+
+def test_compressed(profs):
+    profile = ProfileCache().get(profs[0])
+    builds = []
+
+    def build():
+        builds.append(1)
+        return profile.table_rows
+
+    body = profile.compressed('table', 'gzip', build)
+    assert profile.compressed('table', 'gzip', build) is body
+    assert len(builds) == 1
+    assert gzip.decompress(body).decode('utf-8') == ''.join(profile.table_rows)
+
+
+def test_pruned(profs, tmpdir):
+    disk = DiskCache(str(tmpdir.join('cache')))
+    full = ProfileCache(disk=disk).get(profs[0])
+    pruned = ProfileCache(
+        disk=disk, prune={'exclude': ['builtins']}).get(profs[0])
+
+    assert any(k[0] == '~' for k in full.columns['keys'])
+    # the root, exec, is always kept, as is the profiler's disable call
+    # which nothing calls
+    uncalled = {k for k, v in full.stats.stats.items() if not v[4]}
+    assert full.root in uncalled
+    assert {k for k in pruned.columns['keys'] if k[0] == '~'} == uncalled
+    assert pruned.stats.stats[pruned.root][3] == full.stats.stats[full.root][3]
+    # pruned profiles have their own disk cache entries
+    assert pruned.disk.path != full.disk.path
+    assert len(''.join(pruned.table_rows)) < len(''.join(full.table_rows))
@@ -0,0 +1,95 @@
+import gzip
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from snakeviz.compress import (
+    COMPRESSORS, CompressedCopies, accepted_encodings, choose_encoding,
+    compress, compress_chunks)
+
+
+def test_accepted_encodings():
+    assert accepted_encodings('gzip, deflate, br') == {'gzip', 'deflate', 'br'}
+    assert accepted_encodings('gzip;q=0, br;q=0.5') == {'br'}
+    assert accepted_encodings('') == set()
+
+
+def test_choose_encoding():
+    assert choose_encoding('gzip, deflate') == 'gzip'
+    assert choose_encoding('deflate') is None
+    assert choose_encoding('gzip;q=0') is None
+    assert choose_encoding('') is None
+    assert choose_encoding('*') is not None
+
+
+def _decompress(data, encoding):
+    if encoding == 'gzip':
+        return gzip.decompress(data)
+    if encoding == 'br':
+        return pytest.importorskip('brotli').decompress(data)
+    try:
+        from compression import zstd
+    except ImportError:
+        zstandard = pytest.importorskip('zstandard')
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return zstd.decompress(data)
+
+
+@pytest.mark.parametrize('encoding', ['gzip', 'br', 'zstd'])
+def test_compress_chunks(encoding):
+    if encoding not in COMPRESSORS:
+        pytest.skip(f'{encoding} is not installed')
+    chunks = ['["\u00e9t\u00e9",', b'1,' * 1000, '2]']
+    body = compress_chunks(iter(chunks), encoding)
+    expected = '["\u00e9t\u00e9",'.encode() + b'1,' * 1000 + b'2]'
+    assert _decompress(body, encoding) == expected
+    assert _decompress(compress(expected, encoding, True), encoding) == expected
+    assert _decompress(compress_chunks([], encoding), encoding) == b''
+
+
+def test_compressed_copies(tmpdir):
+    root = str(tmpdir.mkdir('static'))
+    path = os.path.join(root, 'app.js')
+    with open(path, 'w') as f:
+        f.write('var a = 1;' * 100)
+
+    copies = CompressedCopies()
+    try:
+        copy = copies.path(root, path, 'gzip')
+        assert os.path.basename(copy) == 'app.js'
+        with open(copy, 'rb') as f:
+            assert gzip.decompress(f.read()) == b'var a = 1;' * 100
+
+        # copies are made again when the file changes
+        with open(path, 'w') as f:
+            f.write('var b = 2;')
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        assert copies.path(root, path, 'gzip') == copy
+        with open(copy, 'rb') as f:
+            assert gzip.decompress(f.read()) == b'var b = 2;'
+    finally:
+        copies.close()
+    assert not os.path.exists(copy)
+
+
+def test_compressed_copies_built_later(tmpdir):
+    root = str(tmpdir.mkdir('static'))
+    path = os.path.join(root, 'app.css')
+    with open(path, 'w') as f:
+        f.write('a { color: red; }' * 100)
+
+    copies = CompressedCopies()
+    try:
+        assert copies.ready(root, path, 'gzip') is None
+        with ThreadPoolExecutor(1) as pool:
+            copies.build_later(pool, root, path, 'gzip')
+            copies.build_later(pool, root, path, 'gzip')
+        copy = copies.ready(root, path, 'gzip')
+        assert copy is not None
+        with open(copy, 'rb') as f:
+            assert gzip.decompress(f.read()) == b'a { color: red; }' * 100
+        assert not copies._pending
+    finally:
+        copies.close()
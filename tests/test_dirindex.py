@@ -0,0 +1,113 @@
+import cProfile
+import glob
+import time
+
+import pytest
+
+from snakeviz.dirindex import DirectoryIndex, dir_row, looks_like_profile
+
+
+@pytest.fixture
+def profdir(tmpdir):
+    for i in range(3):
+        cProfile.runctx(
+            'glob.glob("*")', {}, {'glob': glob}, str(tmpdir.join(f'{i}.prof')))
+    tmpdir.join('notes.txt').write('not a profile')
+    tmpdir.mkdir('subdir')
+    return tmpdir
+
+
+def scanned(index, path):
+    # list the directory, waiting for the background scan to finish
+    for _ in range(100):
+        entries, scanning = index.entries(path)
+        if not scanning:
+            return {e['name']: e for e in entries}
+        time.sleep(0.05)
+    raise AssertionError('scan did not finish')
+
+
+def test_looks_like_profile(profdir):
+    assert looks_like_profile(str(profdir.join('0.prof')))
+    assert not looks_like_profile(str(profdir.join('notes.txt')))
+
+
+def test_entries_summarized(profdir):
+    index = DirectoryIndex(top=2)
+    entries = scanned(index, str(profdir))
+    assert sorted(entries) == ['0.prof', '1.prof', '2.prof', 'notes.txt', 'subdir/']
+
+    summary = entries['0.prof']['summary']
+    assert summary['functions'] > 0
+    assert summary['total_time'] > 0
+    assert len(summary['hottest']) == 2
+    assert entries['notes.txt']['summary'] is None
+    assert entries['subdir/']['is_dir']
+
+    row = dir_row(entries['0.prof'])
+    assert row[0][0] == '0.prof'
+    assert row[4] == str(summary['functions'])
+
+    # summaries are reused until the file changes
+    assert scanned(index, str(profdir))['0.prof']['summary'] is summary
+    profdir.join('0.prof').write('changed')
+    # editing a file doesn't change its directory, so the listing is
+    # only seen to change once it expires
+    index._listings.clear()
+    assert scanned(index, str(profdir))['0.prof']['summary'] is None
+
+
+def test_summaries_forgotten(profdir, tmpdir_factory):
+    index = DirectoryIndex(max_dirs=2)
+    scanned(index, str(profdir))
+    removed = str(profdir.join('1.prof'))
+    assert removed in index._summaries[str(profdir)]
+
+    profdir.join('1.prof').remove()
+    assert '1.prof' not in scanned(index, str(profdir))
+    assert removed not in index._summaries[str(profdir)]
+
+    # only the most recently listed directories are kept
+    others = [str(tmpdir_factory.mktemp('other')) for _ in range(2)]
+    for other in others:
+        scanned(index, other)
+    assert list(index._summaries) == others
+
+
+def test_listing_reused(profdir, monkeypatch):
+    index = DirectoryIndex()
+    listing = index._listing(str(profdir))
+    assert index._listing(str(profdir)) is listing
+
+    # until the directory changes
+    profdir.join('3.txt').write('new')
+    assert '3.txt' in {row['name'] for row, _ in index._listing(str(profdir))}
+
+    # or the listing gets old
+    listing = index._listing(str(profdir))
+    monkeypatch.setattr('snakeviz.dirindex.LISTING_TTL', 0)
+    assert index._listing(str(profdir)) is not listing
+
+
+def test_scan_of_dropped_directory(profdir):
+    index = DirectoryIndex()
+    index._summarize(str(profdir), [(str(profdir.join('0.prof')), (0, 0))])
+    assert not index._summaries
+
+
+def test_page(profdir):
+    index = DirectoryIndex()
+    scanned(index, str(profdir))
+
+    total, filtered, entries, scanning = index.page(
+        str(profdir), 'name', False, '', 0, 2)
+    assert (total, filtered, scanning) == (5, 5, False)
+    assert [e['name'] for e in entries] == ['subdir/', '0.prof']
+
+    total, filtered, entries, _ = index.page(
+        str(profdir), 'functions', True, 'PROF', 0, -1)
+    assert filtered == 3
+    assert all(e['summary'] for e in entries)
+
+    _, filtered, _, _ = index.page(str(profdir), 'size', False, 'glob', 0, -1)
+    assert filtered == 3
@@ -0,0 +1,51 @@
+import cProfile
+import glob
+import json
+import re
+import subprocess as sp
+
+import pytest
+
+from snakeviz.cache import ProfileCache
+from snakeviz.export import export_html
+
+
+@pytest.fixture
+def prof(tmpdir):
+    fname = str(tmpdir.join('program.prof'))
+    cProfile.runctx('glob.glob("*")', {}, {'glob': glob}, fname)
+    return fname
+
+
+def embedded(html, name):
+    match = re.search(
+        r'<script type="application/json" id="sv-{}-data">(.*?)</script>'
+        .format(name), html, re.DOTALL)
+    return json.loads(match.group(1))
+
+
+def test_export_html(prof, tmpdir):
+    fname = str(tmpdir.join('program.html'))
+    export_html(prof, ProfileCache().get(prof), fname)
+    with open(fname, encoding='utf-8') as f:
+        html = f.read()
+
+    # everything the page needs is in it
+    assert '/static/' not in html
+    assert 'data:image/png;base64,' in html
+
+    assert any('glob' in row[-1] for row in embedded(html, 'table'))
+    assert 'functions' in embedded(html, 'stats')
+    assert embedded(html, 'hierarchy')['children']
+
+
+def test_export_cli(prof, tmpdir):
+    fname = str(tmpdir.join('program.html'))
+    sp.run(['snakeviz', '--export', fname, prof], check=True)
+    with open(fname, encoding='utf-8') as f:
+        assert 'sv-hierarchy-data' in f.read()
+
+    result = sp.run(
+        ['snakeviz', '--diff', '--export', fname, prof, prof],
+        stderr=sp.PIPE)
+    assert result.returncode == 2
@@ -50,3 +50,31 @@ def test_snakeviz_config(config_str, test_str, shell):
 def test_snakeviz_config_unsupported_option(shell):
     with pytest.raises(error.UsageError, match="option -r not recognized"):
         shell.run_line_magic("snakeviz_config", "-r")
+
+
+def test_snakeviz_magic_reuses_server(shell):
+    with mock.patch.object(snakeviz.ipymagic, "_check_ipynb", return_value=True):
+        with mock.patch.object(snakeviz.ipymagic, "display"):
+            shell.run_line_magic("snakeviz", "print()")
+            process = snakeviz.ipymagic._server.process
+            shell.run_line_magic("snakeviz", "print()")
+    assert snakeviz.ipymagic._server.process is process
+    assert process.poll() is None
+
+
+def test_snakeviz_magic_new_tab(shell):
+    with mock.patch.object(snakeviz.ipymagic, "_check_ipynb", return_value=False):
+        with mock.patch.object(snakeviz.ipymagic.webbrowser, "open") as mock_open:
+            shell.run_line_magic("snakeviz", "print()")
+            url = mock_open.call_args[0][0]
+    port = snakeviz.ipymagic._server.port
+    assert url.startswith("http://127.0.0.1:{}/snakeviz/".format(port))
+
+
+@pytest.mark.parametrize("bind,listen", ((None, "0.0.0.0"), ("127.0.0.1", "127.0.0.1")))
+def test_snakeviz_embedded_bind(bind, listen):
+    with mock.patch.object(snakeviz.ipymagic._server, "start", return_value=8080) as start, \
+            mock.patch.object(snakeviz.ipymagic._server, "preload"), \
+            mock.patch.object(snakeviz.ipymagic, "display"):
+        snakeviz.ipymagic.open_snakeviz_and_display_in_notebook("x.prof", None, None, bind)
+    assert start.call_args[0][0] == listen
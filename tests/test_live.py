@@ -0,0 +1,43 @@
+import asyncio
+import cProfile
+import glob
+import os
+
+from snakeviz.cache import ProfileCache
+from snakeviz.live import ProfileWatcher
+
+
+def make_prof(fname, code='glob.glob("*")'):
+    cProfile.runctx(code, {'glob': glob}, {}, fname)
+
+
+def test_profile_watcher(tmpdir):
+    fname = str(tmpdir.join('live.prof'))
+    make_prof(fname)
+    cache = ProfileCache()
+    watcher = ProfileWatcher(cache)
+    changes = []
+
+    async def run():
+        watcher.watch(fname, changes.append)
+        await watcher.poll()
+        assert changes == []
+
+        make_prof(fname, '[glob.glob("*") for _ in range(2)]')
+        os.utime(fname, ns=(0, 10**9))
+        await watcher.poll()
+        await watcher.poll()
+        assert [key for _, key in changes] == [(10**9, os.path.getsize(fname))]
+        # the changed profile has been loaded
+        assert cache.misses == 1
+
+        # partly written profiles are skipped
+        with open(fname, 'wb') as f:
+            f.write(b'{')
+        await watcher.poll()
+        assert len(changes) == 1
+
+        watcher.unwatch(fname, changes.append)
+        assert watcher._periodic is None
+
+    asyncio.run(run())
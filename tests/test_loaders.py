@@ -0,0 +1,128 @@
+import io
+import json
+
+import pytest
+
+from snakeviz.loaders import (
+    FOLDED_INTERVAL, HEAD_SIZE, frame_key, iter_json_list, profile_format)
+from snakeviz.profiles import read_profile, read_profiles
+
+FOLDED = '''\
+main (app.py:1);work (app.py:5);parse (lib.py:10) 30
+main (app.py:1);work (app.py:5) 10
+main (app.py:1);rec (app.py:20);rec (app.py:20) 5
+main (app.py:1) 5
+'''
+
+MAIN = ('app.py', 1, 'main')
+WORK = ('app.py', 5, 'work')
+PARSE = ('lib.py', 10, 'parse')
+REC = ('app.py', 20, 'rec')
+
+EVENTS = [
+    {'ph': 'X', 'name': 'main (app.py:1)', 'ts': 0, 'dur': 100,
+     'pid': 1, 'tid': 1},
+    # complete events needn't be in order
+    {'ph': 'X', 'name': 'parse (lib.py:10)', 'ts': 10, 'dur': 30,
+     'pid': 1, 'tid': 1},
+    {'ph': 'X', 'name': 'work (app.py:5)', 'ts': 5, 'dur': 60,
+     'pid': 1, 'tid': 1},
+    {'ph': 'B', 'name': 'io', 'ts': 70, 'pid': 1, 'tid': 1},
+    {'ph': 'E', 'ts': 90, 'pid': 1, 'tid': 1},
+    {'ph': 'M', 'name': 'thread_name', 'pid': 1, 'tid': 1, 'args': {}},
+    {'ph': 'X', 'name': 'work (app.py:5)', 'ts': 0, 'dur': 50,
+     'pid': 1, 'tid': 2},
+]
+
+
+@pytest.fixture
+def folded(tmpdir):
+    fname = tmpdir.join('program.folded')
+    fname.write(FOLDED)
+    return str(fname)
+
+
+@pytest.fixture
+def trace(tmpdir):
+    fname = tmpdir.join('program.json')
+    fname.write(json.dumps({'traceEvents': EVENTS, 'displayTimeUnit': 'ms'}))
+    return str(fname)
+
+
+def test_frame_key():
+    assert frame_key('parse (lib.py:10)') == PARSE
+    assert frame_key('parse (a b.py:10)') == ('a b.py', 10, 'parse')
+    assert frame_key('[native]') == ('~', 0, '[native]')
+
+
+def test_profile_format(folded, trace, tmpdir):
+    assert profile_format(folded) == 'folded'
+    assert profile_format(trace) == 'trace-events'
+
+    notes = tmpdir.join('notes.txt')
+    notes.write('not a profile\n')
+    assert profile_format(str(notes)) is None
+
+    # other JSON isn't mistaken for a trace
+    for i, other in enumerate([{'name': 'config'}, [{'name': 'x'}], []]):
+        config = tmpdir.join(f'{i}.json')
+        config.write(json.dumps(other))
+        assert profile_format(str(config)) is None
+    listed = tmpdir.join('list.json')
+    listed.write(json.dumps(EVENTS))
+    assert profile_format(str(listed)) == 'trace-events'
+
+
+def test_folded_long_first_stack(tmpdir):
+    frames = ';'.join(
+        f'function_{i} (/site-packages/package/module_{i}.py:{i})'
+        for i in range(8))
+    long = tmpdir.join('long.folded')
+    long.write(f'{frames} 7\n{frames.split(";")[0]} 3\n')
+    assert len(frames) > HEAD_SIZE
+    assert profile_format(str(long)) == 'folded'
+
+    stats = read_profile(str(long)).stats
+    first = ('/site-packages/package/module_0.py', 0, 'function_0')
+    assert stats[first][:2] == (10, 10)
+
+    # frames from other tools, such as perf's script output
+    frames = ';'.join(f'lib.so`function_{i}' for i in range(40))
+    long.write(f'{frames} 7\n')
+    assert profile_format(str(long)) == 'folded'
+
+
+def test_load_folded(folded):
+    stats = read_profile(folded).stats
+    assert stats[MAIN][:4] == pytest.approx((50, 50, 0.05, 0.5))
+    assert stats[WORK][:4] == pytest.approx((40, 40, 0.1, 0.4))
+    assert stats[PARSE][4] == {WORK: pytest.approx((30, 30, 0.3, 0.3))}
+
+    # recursive calls don't count twice towards cumulative time
+    assert stats[REC][:4] == pytest.approx((5, 10, 5 * FOLDED_INTERVAL,
+                                            5 * FOLDED_INTERVAL))
+
+
+def test_load_trace_events(trace):
+    stats = read_profile(trace).stats
+    assert stats[MAIN][:4] == pytest.approx((1, 1, 20e-6, 100e-6))
+    assert stats[WORK][:4] == pytest.approx((2, 2, 80e-6, 110e-6))
+    assert stats[PARSE][4] == {WORK: pytest.approx((1, 1, 30e-6, 30e-6))}
+    assert stats[('~', 0, 'io')][4] == {
+        MAIN: pytest.approx((1, 1, 20e-6, 20e-6))}
+
+
+def test_merge_formats(folded, trace):
+    stats = read_profiles([folded, trace]).stats
+    assert stats[MAIN][1] == 51
+
+
+@pytest.mark.parametrize('text', [
+    '[{"a": 1}, {"b": [2, 3]}, {"c": "]"}]',
+    '{"other": 1, "events": [{"a": 1}, {"b": [2, 3]}, {"c": "]"}]}',
+    # unterminated, as written by a program that was stopped
+    '[{"a": 1}, {"b": [2, 3]}, {"c": "]"},\n{"d"',
+])
+def test_iter_json_list(text):
+    items = list(iter_json_list(io.StringIO(text), 'events', chunk_size=4))
+    assert items == [{'a': 1}, {'b': [2, 3]}, {'c': ']'}]
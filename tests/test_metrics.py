@@ -0,0 +1,44 @@
+import pytest
+
+from snakeviz.metrics import Metrics
+
+
+def test_record():
+    metrics = Metrics()
+    metrics.record('TableHandler', 200, 0.02, {'load': 0.01}, 100)
+    metrics.record('TableHandler', 304, 0.001, {}, 0)
+    metrics.record('TableHandler', 200, 0.03, {'load': 0.02}, 50)
+
+    table = metrics.to_json()['TableHandler']
+    assert table['requests'] == 3
+    assert table['statuses'] == {'200': 2, '304': 1}
+    assert table['seconds'] == pytest.approx(0.051)
+    assert table['bytes_sent'] == 150
+    assert table['phases']['load']['count'] == 2
+    assert table['phases']['load']['seconds'] == pytest.approx(0.03)
+
+
+def test_to_prometheus():
+    metrics = Metrics()
+    metrics.record('TableHandler', 200, 0.02, {'load': 0.01}, 100)
+    metrics.record('TableHandler', 200, 20, {'load': 10}, 100)
+    lines = metrics.to_prometheus({'hits': 3, 'entries': 1}).splitlines()
+
+    assert '# TYPE snakeviz_requests_total counter' in lines
+    assert ('snakeviz_requests_total{handler="TableHandler",code="200"} 2'
+            in lines)
+    # histogram buckets are cumulative
+    assert ('snakeviz_request_duration_seconds_bucket'
+            '{handler="TableHandler",le="0.01"} 0' in lines)
+    assert ('snakeviz_request_duration_seconds_bucket'
+            '{handler="TableHandler",le="0.025"} 1' in lines)
+    assert ('snakeviz_request_duration_seconds_bucket'
+            '{handler="TableHandler",le="+Inf"} 2' in lines)
+    assert ('snakeviz_request_duration_seconds_count'
+            '{handler="TableHandler"} 2' in lines)
+    assert ('snakeviz_request_phase_seconds_count'
+            '{handler="TableHandler",phase="load"} 2' in lines)
+    assert ('snakeviz_response_bytes_total{handler="TableHandler"} 200'
+            in lines)
+    assert 'snakeviz_cache_hits_total 3' in lines
+    assert '# TYPE snakeviz_cache_entries gauge' in lines
@@ -0,0 +1,127 @@
+import asyncio
+import os
+import threading
+from pstats import Stats
+
+import pytest
+
+import snakeviz
+from snakeviz.profiler import Profiler
+
+
+def work():
+    return sorted(range(1000))
+
+
+def calls(fname, name):
+    return sum(v[1] for k, v in Stats(fname).stats.items() if k[2] == name)
+
+
+def test_profile(tmpdir):
+    fname = str(tmpdir.join('work.prof'))
+    profiler = snakeviz.profile(fname)
+    assert snakeviz.profile(fname) is profiler
+
+    for _ in range(3):
+        with snakeviz.profile(fname):
+            work()
+    assert not os.path.exists(fname)
+
+    profiler.flush()
+    assert calls(fname, 'work') == 3
+
+
+def test_profile_sample_rate(tmpdir):
+    fname = str(tmpdir.join('never.prof'))
+    profiler = Profiler(fname, sample_rate=0)
+    for _ in range(10):
+        with profiler:
+            work()
+    profiler.flush()
+    assert profiler.sampled == 0
+    assert not os.path.exists(fname)
+
+    with pytest.raises(ValueError):
+        Profiler(fname, sample_rate=2)
+
+
+def test_profile_flush_interval(tmpdir):
+    fname = str(tmpdir.join('flushed.prof'))
+    with Profiler(fname, flush_interval=0):
+        work()
+    assert calls(fname, 'work') == 1
+
+
+def test_profile_flush_outside_lock(tmpdir, monkeypatch):
+    fname = str(tmpdir.join('slow.prof'))
+    profiler = Profiler(fname)
+    with profiler:
+        work()
+
+    # runs are added while the file is being written
+    replace = os.replace
+
+    def slow_replace(src, dst):
+        with profiler:
+            work()
+        replace(src, dst)
+    monkeypatch.setattr(os, 'replace', slow_replace)
+    profiler.flush()
+    assert profiler.sampled == 2
+    assert calls(fname, 'work') == 1
+
+    monkeypatch.setattr(os, 'replace', replace)
+    profiler.flush()
+    assert calls(fname, 'work') == 2
+
+
+def test_profile_nested(tmpdir):
+    # only the outermost profiler runs
+    outer = Profiler(str(tmpdir.join('outer.prof')))
+    inner = Profiler(str(tmpdir.join('inner.prof')))
+    with outer:
+        with inner:
+            work()
+        with outer:
+            work()
+    assert (outer.sampled, inner.sampled) == (1, 0)
+
+
+def test_profiled(tmpdir):
+    fname = str(tmpdir.join('decorated.prof'))
+
+    @snakeviz.profiled(fname)
+    def decorated(n):
+        return [work() for _ in range(n)]
+
+    assert len(decorated(2)) == 2
+    threads = [threading.Thread(target=decorated, args=(1,))
+               for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    snakeviz.profile(fname).flush()
+    profiler = snakeviz.profile(fname)
+    assert calls(fname, 'decorated') == profiler.sampled
+    assert 1 <= profiler.sampled <= 5
+
+
+def test_profiled_coroutine(tmpdir):
+    fname = str(tmpdir.join('async.prof'))
+
+    @snakeviz.profiled(fname)
+    async def handle(n):
+        await asyncio.sleep(0)
+        return work()
+
+    async def main():
+        return await asyncio.gather(*[handle(i) for i in range(3)])
+
+    assert len(asyncio.run(main())) == 3
+    profiler = snakeviz.profile(fname)
+    # the first run is profiled and the others overlap it
+    assert profiler.sampled >= 1
+    profiler.flush()
+    assert calls(fname, 'work') >= 1
@@ -0,0 +1,127 @@
+from pstats import Stats
+
+import pytest
+
+from snakeviz.profiles import _StatsDict
+from snakeviz.prune import COLLAPSED_NAME, file_matcher, prune_stats
+from snakeviz.stats import build_hierarchy, find_root
+
+STDLIB = '/usr/lib/python3.11/json/decoder.py'
+
+MAIN = ('/app/main.py', 1, 'main')
+OTHER = ('/app/main.py', 10, 'other')
+DECODE = (STDLIB, 5, 'decode')
+SCAN = (STDLIB, 20, 'scan')
+HOOK = ('/app/util.py', 1, 'hook')
+
+
+@pytest.fixture
+def stats():
+    # main calls decode and other, decode calls scan and hook
+    return Stats(_StatsDict({
+        MAIN: (1, 1, 1.0, 11.0, {}),
+        OTHER: (2, 2, 4.0, 4.0, {MAIN: (2, 2, 4.0, 4.0)}),
+        DECODE: (3, 3, 2.0, 6.0, {MAIN: (3, 3, 2.0, 6.0)}),
+        SCAN: (4, 4, 3.0, 3.0, {DECODE: (4, 4, 3.0, 3.0)}),
+        HOOK: (5, 5, 1.0, 1.0, {DECODE: (5, 5, 1.0, 1.0)}),
+    }))
+
+
+def total_time(stats):
+    return sum(v[2] for v in stats.stats.values())
+
+
+def test_file_matcher():
+    matches = file_matcher(['stdlib', 'builtins'])
+    assert matches(STDLIB)
+    assert matches('~')
+    assert matches('<frozen importlib._bootstrap>')
+    assert not matches('/usr/lib/python3.11/site-packages/numpy/core.py')
+    assert not matches('/app/main.py')
+
+    assert file_matcher(['site-packages'])(
+        '/usr/lib/python3.11/site-packages/numpy/core.py')
+    assert file_matcher(['*/app/*'])('/app/main.py')
+    assert not file_matcher(['*/app/*'])(STDLIB)
+
+
+@pytest.mark.parametrize('options', [
+    {'exclude': ['stdlib']},
+    {'include': ['/app/*']},
+])
+def test_exclude(stats, options):
+    pruned = prune_stats(stats, **options)
+    assert set(pruned.stats) == {MAIN, OTHER, HOOK}
+    # the time of decode and scan moves to main
+    assert pruned.stats[MAIN][2] == 6.0
+    assert pruned.stats[MAIN][3] == 11.0
+    assert total_time(pruned) == 11.0
+    # hook is called by main in place of decode
+    assert pruned.stats[HOOK][4] == {MAIN: (5, 5, 1.0, 1.0)}
+    assert find_root(pruned) == MAIN
+
+
+def test_min_fraction(stats):
+    pruned = prune_stats(stats, min_fraction=0.2)
+    assert set(pruned.stats) == {MAIN, OTHER, DECODE, SCAN}
+    assert pruned.stats[DECODE][2] == 3.0
+    assert pruned.stats[DECODE][4][MAIN][2] == 3.0
+    assert total_time(pruned) == 11.0
+
+
+def test_max_functions(stats):
+    pruned = prune_stats(stats, max_functions=3)
+    assert set(pruned.stats) == {MAIN, OTHER, DECODE}
+    assert pruned.stats[DECODE][2] == 6.0
+    assert total_time(pruned) == 11.0
+
+
+def test_collapse(stats):
+    pruned = prune_stats(stats, collapse=['stdlib'])
+    collapsed = (STDLIB, 0, COLLAPSED_NAME)
+    assert set(pruned.stats) == {MAIN, OTHER, collapsed, HOOK}
+    # the calls and time of the file are those of calls from outside it
+    assert pruned.stats[collapsed][:4] == (3, 3, 5.0, 6.0)
+    assert pruned.stats[collapsed][4] == {MAIN: (3, 3, 5.0, 6.0)}
+    assert pruned.stats[HOOK][4] == {collapsed: (5, 5, 1.0, 1.0)}
+    assert total_time(pruned) == 11.0
+
+    tree = build_hierarchy(pruned, MAIN, 10, 0)
+    assert [c['name'] for c in tree['children']] == [
+        '/app/main.py:10(other)', f'{STDLIB}:0({COLLAPSED_NAME})',
+        '/app/main.py:1(main)']
+
+
+def test_collapse_reentrant():
+    # main calls decode, which calls hook, which calls decode's file again
+    scan = (STDLIB, 20, 'scan')
+    stats = Stats(_StatsDict({
+        MAIN: (1, 1, 1.0, 10.0, {}),
+        DECODE: (1, 1, 2.0, 9.0, {MAIN: (1, 1, 2.0, 9.0)}),
+        HOOK: (1, 1, 3.0, 7.0, {DECODE: (1, 1, 3.0, 7.0)}),
+        scan: (1, 1, 4.0, 4.0, {HOOK: (1, 1, 4.0, 4.0)}),
+    }))
+    pruned = prune_stats(stats, collapse=['stdlib'])
+    collapsed = (STDLIB, 0, COLLAPSED_NAME)
+    # the call from hook is counted like a recursive call
+    assert pruned.stats[collapsed][:4] == (1, 2, 6.0, 9.0)
+    assert set(pruned.stats[collapsed][4]) == {MAIN, HOOK}
+    assert total_time(pruned) == 10.0
+    assert find_root(pruned) == MAIN
+
+
+def test_root_kept(stats):
+    pruned = prune_stats(stats, include=['/app/util.py'])
+    assert set(pruned.stats) == {MAIN, HOOK}
+    assert pruned.stats[MAIN][2] == 10.0
+
+
+def test_uncalled_kept(stats):
+    # a thread started in the standard library
+    thread = (STDLIB, 50, 'run')
+    stats.stats[thread] = (1, 1, 2.0, 3.0, {})
+    stats.stats[HOOK][4][thread] = (1, 1, 1.0, 1.0)
+    pruned = prune_stats(stats, exclude=['stdlib'])
+    assert thread in pruned.stats
+    assert find_root(pruned) == MAIN
+    assert total_time(pruned) == 13.0
@@ -1,6 +1,8 @@
+import asyncio
 import cProfile
 import os
 import glob
+import re
 import shlex
 import subprocess as sp
 import tempfile
@@ -85,3 +87,172 @@ def test_version():
     # in Python <= 3.3 this comes out on stderr, otherwise on stdout
     assert VERSION in out.decode('utf-8') or \
         VERSION in err.decode('utf-8')
+
+
+def test_snakeviz_cache_info(prof):
+    url = snakeviz_url('api/table/' + prof, None)
+    with snakeviz(prof):
+        requests.get(url).raise_for_status()
+        requests.get(url).raise_for_status()
+        result = requests.get('http://localhost:8080/snakeviz/api/cache')
+    result.raise_for_status()
+    info = result.json()
+    # the profile is loaded once, by the command line interface
+    assert info['hits'] == 2
+    assert info['misses'] == 1
+
+
+def test_snakeviz_metrics(prof):
+    url = snakeviz_url('api/table/' + prof, None)
+    with snakeviz(prof):
+        response = requests.get(url)
+        response.raise_for_status()
+        json_metrics = requests.get(
+            'http://localhost:8080/snakeviz/metrics').json()
+        text_metrics = requests.get(
+            'http://localhost:8080/snakeviz/metrics',
+            headers={'Accept': 'text/plain'}).text
+
+    assert 'load;dur=' in response.headers['Server-Timing']
+    assert 'convert;dur=' in response.headers['Server-Timing']
+
+    table = json_metrics['handlers']['TableHandler']
+    assert table['requests'] == 1
+    assert table['statuses'] == {'200': 1}
+    assert table['bytes_sent'] > 0
+    assert set(table['phases']) >= {'load', 'convert', 'send'}
+    assert json_metrics['cache']['hits'] == 1
+
+    assert ('snakeviz_requests_total{handler="TableHandler",code="200"} 1'
+            in text_metrics)
+    assert 'snakeviz_cache_hits_total 1' in text_metrics
+
+
+def test_snakeviz_static(prof):
+    with snakeviz(prof):
+        page = requests.get(snakeviz_url(prof, None)).text
+        url = re.search(r'src="(/static/snakeviz.js\?v=\w+)"', page).group(1)
+        response = requests.get(
+            'http://localhost:8080' + url, headers={'Accept-Encoding': 'gzip'})
+    response.raise_for_status()
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'immutable' in response.headers['Cache-Control']
+    assert 'sv_draw_vis' in response.text
+
+
+def test_invalid_profile(tmpdir):
+    fname = tmpdir.join('invalid.prof')
+    fname.write('{not a profile')
+    result = sp.run(['snakeviz', '-s', str(fname)], stderr=sp.PIPE)
+    assert result.returncode == 2
+    assert b'not a valid profile' in result.stderr
+
+
+def test_snakeviz_api(prof):
+    table_url = snakeviz_url('api/table/' + prof, None)
+    callees_url = snakeviz_url('api/callees/' + prof, None)
+
+    with snakeviz(prof):
+        table = requests.get(table_url)
+        callees = requests.get(callees_url)
+        etag = callees.headers['Etag']
+        cached = requests.get(callees_url, headers={'If-None-Match': etag})
+        since = requests.get(
+            table_url,
+            headers={'If-Modified-Since': table.headers['Last-Modified']})
+
+    table.raise_for_status()
+    callees.raise_for_status()
+    assert any('glob' in row[5] for row in table.json())
+    assert any('glob' in name for name in callees.json())
+    assert cached.status_code == 304
+    assert since.status_code == 304
+
+
+def test_snakeviz_hierarchy(prof):
+    url = snakeviz_url('api/hierarchy/' + prof, None)
+
+    with snakeviz(prof):
+        root = requests.get(url, params={'depth': 3, 'cutoff': 0})
+        root.raise_for_status()
+        child = root.json()['children'][0]
+        sub = requests.get(
+            url, params={'name': child['name'], 'parent_name': child['parent_name']})
+        callers = requests.get(
+            url, params={'name': child['name'], 'callers': 1, 'cutoff': 0})
+        missing = requests.get(url, params={'name': 'nope'})
+
+    sub.raise_for_status()
+    assert sub.json()['name'] == child['name']
+    assert sub.json()['parent_name'] == root.json()['name']
+    callers.raise_for_status()
+    assert callers.json()['name'] == child['name']
+    assert root.json()['name'] in [
+        c['name'] for c in callers.json()['children']]
+    assert missing.status_code == 404
+
+
+def test_snakeviz_table_server_side(prof):
+    url = snakeviz_url('api/table/' + prof, None)
+    params = {
+        'draw': 3, 'start': 0, 'length': 2,
+        'order[0][column]': 3, 'order[0][dir]': 'desc',
+        'search[value]': 'glob'}
+
+    with snakeviz(prof):
+        result = requests.get(url, params=params)
+    result.raise_for_status()
+
+    page = result.json()
+    assert page['draw'] == 3
+    assert page['recordsTotal'] >= page['recordsFiltered'] > 0
+    assert len(page['data']) == 2
+    assert all('glob' in row[5] for row in page['data'])
+
+
+def test_snakeviz_merged(tmpdir):
+    profs = [str(tmpdir.join(f'{i}.prof')) for i in range(2)]
+    for p in profs:
+        cProfile.runctx('glob.glob("*")', {}, {'glob': glob}, p)
+    url = snakeviz_url('api/table/' + str(tmpdir.join('*.prof')), None)
+
+    with snakeviz(' '.join(profs)):
+        result = requests.get(url)
+    result.raise_for_status()
+
+    assert any('glob' in row[5] for row in result.json())
+
+
+def test_snakeviz_diff(prof, tmpdir):
+    base = str(tmpdir.join('base.prof'))
+    cProfile.runctx('sorted(range(10))', {}, {}, base)
+    url = 'http://localhost:8080/snakeviz/api/diff/table?base={}&new={}'.format(
+        quote(base, safe=''), quote(prof, safe=''))
+
+    with snakeviz('--diff {} {}'.format(base, prof)):
+        result = requests.get(url)
+    result.raise_for_status()
+
+    assert all(len(row) == 11 for row in result.json())
+
+
+def test_snakeviz_live(tmpdir):
+    from tornado.ioloop import IOLoop
+    from tornado.websocket import websocket_connect
+
+    fname = str(tmpdir.join('live.prof'))
+    cProfile.runctx('glob.glob("*")', {}, {'glob': glob}, fname)
+    url = 'ws://localhost:8080/snakeviz/api/live/' + quote(fname, safe='')
+
+    async def changed():
+        conn = await websocket_connect(url)
+        # give the server time to start watching
+        await asyncio.sleep(1)
+        cProfile.runctx('sorted(range(10))', {}, {}, fname)
+        message = await conn.read_message()
+        conn.close()
+        return message
+
+    with snakeviz(fname):
+        message = IOLoop.current().run_sync(changed, timeout=10)
+    assert '"changed"' in message
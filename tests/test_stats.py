@@ -0,0 +1,211 @@
+import cProfile
+import json
+from pstats import Stats
+
+import pytest
+
+import snakeviz.stats
+from snakeviz.stats import (
+    CallerHierarchy, Hierarchy, build_hierarchy, compact_stats, diff_columns,
+    find_root, iter_diff_rows, iter_json_stats, iter_table_rows,
+    json_array_chunks, json_object_chunks, json_stats, stats_columns,
+    table_rows)
+
+
+def recurse(n):
+    if n:
+        recurse(n - 1)
+    sorted(range(1000))
+
+
+def program():
+    recurse(5)
+    sum(range(10000))
+
+
+@pytest.fixture(scope='module')
+def stats(tmpdir_factory):
+    fname = str(tmpdir_factory.mktemp('stats').join('program.prof'))
+    cProfile.runctx('program()', globals(), {}, fname)
+    return Stats(fname)
+
+
+def walk(node):
+    yield node
+    for child in node.get('children', []):
+        yield from walk(child)
+
+
+def test_find_root(stats):
+    root = find_root(stats)
+    assert stats.stats[root][3] == max(v[3] for v in stats.stats.values())
+    assert all(root not in v for v in stats.all_callees.values())
+
+
+def test_build_hierarchy(stats):
+    root = find_root(stats)
+    tree = build_hierarchy(stats, root, 10, 0)
+    assert tree['time'] == tree['cumulative'] == stats.stats[root][3]
+    assert tree['parent_name'] is None
+
+    names = [n['display_name'] for n in walk(tree)]
+    assert any('(program)' in n for n in names)
+
+    # recursion is cut off after the first call
+    # (the other node is the self-time filler for the first call)
+    assert sum('(recurse)' in n for n in names) == 2
+
+    # with no cutoff the children account for all of their parent's time
+    for node in walk(tree):
+        if 'children' in node:
+            total = sum(c['time'] for c in node['children'])
+            assert total == pytest.approx(node['time'])
+
+
+def test_build_hierarchy_depth_and_cutoff(stats):
+    root = find_root(stats)
+    shallow = build_hierarchy(stats, root, 1, 0)
+    assert all('children' not in c for c in shallow['children'])
+
+    full = list(walk(build_hierarchy(stats, root, 10, 0)))
+    pruned = list(walk(build_hierarchy(stats, root, 10, 0.5)))
+    assert len(pruned) < len(full)
+
+
+def test_hierarchy_expands_incrementally(stats):
+    root = find_root(stats)
+    tree = Hierarchy(stats, root, 0)
+    assert tree.tree(2) == build_hierarchy(stats, root, 2, 0)
+    assert tree.depth == 2
+
+    nodes = tree.nodes
+    assert tree.tree(10) == build_hierarchy(stats, root, 10, 0)
+    assert tree.nodes > nodes
+
+    # shallower trees are cut from the levels already built
+    nodes = tree.nodes
+    assert tree.tree(1) == build_hierarchy(stats, root, 1, 0)
+    assert tree.nodes == nodes
+
+
+def test_caller_hierarchy(stats):
+    sorted_key, = [k for k in stats.stats if 'builtins.sorted' in k[2]]
+    tree = build_hierarchy(stats, sorted_key, 10, 0, callers=True)
+    assert tree['time'] == stats.stats[sorted_key][3]
+
+    # the only caller is recurse, whose calls to itself are left out
+    recurse, = tree['children']
+    assert '(recurse)' in recurse['display_name']
+    assert recurse['time'] == pytest.approx(tree['time'])
+    assert recurse['parent_name'] == tree['name']
+    names = [n['display_name'] for n in walk(tree)]
+    assert sum('(recurse)' in n for n in names) == 1
+    assert any('(program)' in n for n in names)
+
+    for node in walk(tree):
+        if 'children' in node:
+            total = sum(c['time'] for c in node['children'])
+            assert total == pytest.approx(node['time'])
+
+    incremental = CallerHierarchy(stats, sorted_key, 0)
+    assert incremental.tree(1) == build_hierarchy(
+        stats, sorted_key, 1, 0, callers=True)
+    assert incremental.tree(10) == tree
+
+    # only the stats are needed, not the call graph
+    fresh = Stats().add(stats)
+    assert fresh.all_callees is None
+    assert build_hierarchy(fresh, sorted_key, 10, 0, callers=True) == tree
+    assert fresh.all_callees is None
+
+
+def test_compact_stats_matches_json_stats(stats):
+    nested = json_stats(stats)
+    compact = compact_stats(stats)
+
+    names = [
+        '{}:{}({})'.format(compact['files'][f][0], line, func)
+        for f, line, func in compact['functions']]
+    assert names == list(nested)
+
+    callees = compact['callees']
+    callers = compact['callers']
+    for i, name in enumerate(names):
+        assert compact['stats'][4 * i:4 * i + 4] == nested[name]['stats']
+
+        start, end = callees['offsets'][i:i + 2]
+        children = {
+            names[c]: callees['stats'][4 * e:4 * e + 4]
+            for e, c in zip(range(start, end), callees['ids'][start:end])}
+        assert children == {
+            k: v[:4] for k, v in nested[name]['children'].items()}
+
+        start, end = callers['offsets'][i:i + 2]
+        parents = {
+            names[p]: callees['stats'][4 * e:4 * e + 4]
+            for p, e in zip(callers['ids'][start:end],
+                            callers['edges'][start:end])}
+        assert parents == {
+            k: v[:4] for k, v in nested[name]['callers'].items()
+            if k in nested}
+
+
+def test_table_rows(stats):
+    rows = table_rows(stats)
+    assert len(rows) == len(stats.stats)
+    row = next(r for r in rows if r[6].endswith('(recurse)'))
+    assert row[0] == ['6/1', 6]
+    assert row[5].startswith('test_stats.py:')
+
+
+def test_table_rows_without_numpy(stats, monkeypatch):
+    pytest.importorskip('numpy')
+    rows = table_rows(stats)
+    monkeypatch.setattr(snakeviz.stats, 'np', None)
+    assert table_rows(stats) == rows
+
+
+@pytest.mark.parametrize('n', [0, 3, 4])
+def test_json_chunks(n):
+    values = [[i, 'x' * i, {'y': i / 3}] for i in range(n)]
+    chunks = list(json_array_chunks(values, batch_size=3))
+    assert json.loads(''.join(chunks)) == values
+
+    items = [('k%d' % i, v) for i, v in enumerate(values)]
+    chunks = list(json_object_chunks(items, batch_size=3))
+    assert json.loads(''.join(chunks)) == dict(items)
+
+
+def test_streamed_payloads_match(stats):
+    rows = ''.join(json_array_chunks(iter_table_rows(stats), batch_size=2))
+    assert json.loads(rows) == json.loads(json.dumps(table_rows(stats)))
+
+    nested = ''.join(json_object_chunks(iter_json_stats(stats), batch_size=2))
+    assert json.loads(nested) == json.loads(json.dumps(json_stats(stats)))
+
+
+def test_diff_columns(stats, tmpdir):
+    fname = str(tmpdir.join('other.prof'))
+    cProfile.runctx('recurse(2)', globals(), {}, fname)
+    base = stats_columns(Stats(fname))
+    new = stats_columns(stats)
+
+    same = diff_columns(new, new)
+    assert not any(same['delta_cumtime'])
+    assert list(same['new_ncalls']) == list(new['ncalls'])
+
+    diff = diff_columns(base, new)
+    assert diff['keys'][:len(new['keys'])] == list(new['keys'])
+    assert set(diff['keys']) == set(base['keys']) | set(new['keys'])
+    rows = {r[-1]: r for r in iter_diff_rows(diff)}
+    row = next(r for k, r in rows.items() if k.endswith('(recurse)'))
+    assert row[7:10] == ['3', '6', '+3']
+
+
+def test_diff_columns_without_numpy(stats, monkeypatch):
+    pytest.importorskip('numpy')
+    columns = stats_columns(stats)
+    rows = list(iter_diff_rows(diff_columns(columns, columns)))
+    monkeypatch.setattr(snakeviz.stats, 'np', None)
+    columns = stats_columns(stats)
+    assert list(iter_diff_rows(diff_columns(columns, columns))) == rows